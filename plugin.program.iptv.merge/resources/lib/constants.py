@@ -4,6 +4,15 @@ IPTV_SIMPLE_ID = 'pvr.iptvsimple'
 METHOD_PLAYLIST = 'playlist'
 METHOD_EPG = 'epg'
 MERGE_SETTING_FILE = '.iptv_merge'
+BULK_INSERT_ROWS = 5000
+MERGE_WORKERS = 4 # keep in sync with the merge_workers default in settings.xml
+OUTPUT_CHANGED_KEY = '_iptv_merge_output_changed'
+HTTP_API_PORT = 52104
+HTTP_API_CACHE_DIR = 'http_api'
+HTTP_API_FILES = {
+    PLAYLIST_FILE_NAME: 'audio/x-mpegurl; charset=utf-8',
+    EPG_FILE_NAME: 'application/xml; charset=utf-8',
+}
 
 TYPE_IPTV_MERGE = 1
 TYPE_IPTV_MANAGER = 2
@@ -0,0 +1,310 @@
+import os
+import re
+import gzip
+import shutil
+import socket
+import hashlib
+import threading
+
+from kodi_six import xbmc
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from slyguy import settings, userdata
+from slyguy.log import log
+from slyguy.util import FileIO, remove_file
+from slyguy.constants import ADDON_PROFILE, CHUNK_SIZE
+
+from .constants import *
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class Snapshot(object):
+    def __init__(self, key, etag, path, gz_path):
+        self.key = key
+        self.etag = etag
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.gz_path = gz_path
+        self.gz_size = os.path.getsize(gz_path)
+
+class Outputs(object):
+    """Serves copies of the merged files so merges never wait on (or break) a client download.
+    Copies are rebuilt in the background once a merge publishes and the previous copy is served until then"""
+    def __init__(self, working_path=ADDON_PROFILE):
+        self._working_path = working_path
+        self._cache_path = os.path.join(working_path, HTTP_API_CACHE_DIR)
+        self._snapshots = {}
+        self._locks = dict((name, threading.Lock()) for name in HTTP_API_FILES)
+
+        if not os.path.exists(self._cache_path):
+            os.makedirs(self._cache_path)
+
+    def _key(self, name):
+        try:
+            stat = os.stat(os.path.join(self._working_path, name))
+        except OSError:
+            return None
+
+        return (stat.st_size, stat.st_mtime)
+
+    def get(self, name):
+        snapshot = self._snapshots.get(name)
+        if not snapshot:
+            # nothing to serve yet, so the first request has to wait
+            self.refresh(name, wait=True)
+            return self._snapshots.get(name)
+
+        if snapshot.key != self._key(name):
+            self.refresh(name)
+
+        return snapshot
+
+    def refresh(self, name=None, wait=False):
+        for name in ([name] if name else HTTP_API_FILES):
+            lock = self._locks[name]
+            if not lock.acquire(wait):
+                # already being rebuilt
+                continue
+
+            if wait:
+                self._update(name, lock)
+            else:
+                thread = threading.Thread(target=self._update, args=(name, lock))
+                thread.daemon = True
+                thread.start()
+
+    def _update(self, name, lock):
+        try:
+            key = self._key(name)
+            current = self._snapshots.get(name)
+            if key and (not current or current.key != key):
+                self._snapshots[name] = self._snapshot(name, os.path.join(self._working_path, name), key, current)
+        except Exception as e:
+            log.debug('HTTP API: {} failed to update: {}'.format(name, e))
+        finally:
+            lock.release()
+
+    def _snapshot(self, name, path, key, current=None):
+        tmp_path = os.path.join(self._cache_path, name + '_tmp')
+        md5 = hashlib.md5()
+
+        # copy, hash and compress in a single pass
+        with FileIO(path, 'rb') as _in, FileIO(tmp_path, 'wb') as _out, FileIO(tmp_path + '.gz', 'wb') as _gz_out:
+            with gzip.GzipFile(filename=name, mode='wb', fileobj=_gz_out, compresslevel=6, mtime=0) as _gz:
+                while True:
+                    chunk = _in.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    _out.write(chunk)
+                    _gz.write(chunk)
+
+        etag = md5.hexdigest()
+        if current and current.etag == etag:
+            remove_file(tmp_path)
+            remove_file(tmp_path + '.gz')
+            current.key = key
+            return current
+
+        # new content gets new file names, old ones may still be streaming to a client
+        out_path = os.path.join(self._cache_path, '{}.{}'.format(etag, name))
+        shutil.move(tmp_path, out_path)
+        shutil.move(tmp_path + '.gz', out_path + '.gz')
+        log.debug('HTTP API: {} updated ({})'.format(name, etag))
+
+        self._clean(name, out_path)
+        return Snapshot(key, etag, out_path, out_path + '.gz')
+
+    def _clean(self, name, keep):
+        for file_name in os.listdir(self._cache_path):
+            path = os.path.join(self._cache_path, file_name)
+            if path not in (keep, keep + '.gz') and file_name.split('.', 1)[-1] in (name, name + '.gz'):
+                try: os.remove(path)
+                except: pass
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        name = self.path.split('?')[0].lstrip('/')
+        if name not in HTTP_API_FILES:
+            self._send_status(404)
+            return
+
+        snapshot = self.server.outputs.get(name)
+        if not snapshot:
+            self._send_status(404)
+            return
+
+        etag = '"{}"'.format(snapshot.etag)
+        headers = {
+            'Content-Type': HTTP_API_FILES[name],
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [x.strip() for x in if_none_match.split(',')]):
+            self._send_status(304, headers)
+            return
+
+        path, offset, length = snapshot.path, 0, snapshot.size
+
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', etag) != etag:
+            byte_range = None
+
+        if byte_range:
+            _range = self._parse_range(byte_range, snapshot.size)
+            if not _range:
+                headers['Content-Range'] = 'bytes */{}'.format(snapshot.size)
+                self._send_status(416, headers)
+                return
+
+            offset, length = _range[0], _range[1] - _range[0] + 1
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(_range[0], _range[1], snapshot.size)
+            status = 206
+
+        else:
+            status = 200
+            if self._accepts_gzip():
+                path, length = snapshot.gz_path, snapshot.gz_size
+                headers['Content-Encoding'] = 'gzip'
+
+        headers['Content-Length'] = str(length)
+        self.send_response(status)
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+
+        if body:
+            try:
+                self._send_file(path, offset, length)
+            except (socket.error, IOError) as e:
+                log.debug('HTTP API: {} failed to send: {}'.format(name, e))
+                self.close_connection = True
+
+    def _send_status(self, status, headers=None):
+        headers = dict(headers or {})
+        if status == 304:
+            headers.pop('Content-Type', None)
+        else:
+            headers['Content-Length'] = '0'
+
+        self.send_response(status)
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+
+    def _accepts_gzip(self):
+        for encoding in self.headers.get('Accept-Encoding', '').split(','):
+            params = [x.strip() for x in encoding.split(';')]
+            if params[0].lower() == 'gzip':
+                return 'q=0' not in params and 'q=0.0' not in params
+        return False
+
+    def _parse_range(self, byte_range, size):
+        match = RANGE_PATTERN.match(byte_range.strip())
+        if not match or size == 0:
+            return None
+
+        start, end = match.groups()
+        if not start:
+            # suffix range eg. bytes=-500
+            if not end:
+                return None
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+
+        if start >= size or start > end:
+            return None
+
+        return start, end
+
+    def _send_file(self, path, offset, length):
+        with FileIO(path, 'rb') as f:
+            self.wfile.flush()
+
+            # zero-copy on python3 (os.sendfile where available)
+            if hasattr(self.connection, 'sendfile'):
+                self.connection.sendfile(f, offset, length)
+                return
+
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Server(object):
+    started = False
+
+    def sync(self):
+        """Starts, restarts or stops the server to match the current settings"""
+        if not settings.getBool('http_api', False):
+            self.stop()
+            return
+
+        remote = settings.getBool('http_api_remote', False)
+        port = settings.getInt('http_api_port', HTTP_API_PORT)
+        if self.started and (remote, port) == self._config:
+            return
+
+        self.stop()
+        self.start(remote, port)
+
+    def start(self, remote, port):
+        if self.started:
+            return
+
+        host = '0.0.0.0' if remote else '127.0.0.1'
+
+        self._server = ThreadedHTTPServer((host, port), RequestHandler)
+        self._server.outputs = Outputs()
+        self._server.outputs.refresh()
+        self._httpd_thread = threading.Thread(target=self._server.serve_forever)
+        self._httpd_thread.start()
+        self._config = (remote, port)
+        self.started = True
+
+        path = 'http://{}:{}/'.format(xbmc.getIPAddress() if remote else host, port)
+        userdata.set('_playlist_url', path + PLAYLIST_FILE_NAME)
+        userdata.set('_epg_url', path + EPG_FILE_NAME)
+        log.info('HTTP API Started: {}'.format(path))
+
+    def refresh(self):
+        if self.started:
+            self._server.outputs.refresh()
+
+    def stop(self):
+        # also clears urls left behind by a service that didn't shut down cleanly
+        userdata.delete('_playlist_url')
+        userdata.delete('_epg_url')
+
+        if not self.started:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._httpd_thread.join()
+        self.started = False
+        log.debug('HTTP API: Stopped')
@@ -1,37 +1,59 @@
+import sys
+import re
 import socket
 import json
 import codecs
+import time
 import arrow
 from xml.sax.saxutils import escape
 
 from kodi_six import xbmc
+from six import string_types
 from six.moves.urllib.parse import parse_qsl, urlparse, urlencode, urlunparse
 
 from slyguy.log import log
 from slyguy.constants import CHUNK_SIZE, KODI_VERSION
 
+ISO_PATTERN = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})[T ](\d{2}):?(\d{2})(?::?(\d{2})(?:[.,]\d+)?)?\s*(Z|[+-]\d{2}(?::?\d{2})?)?$')
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
 def process_path(path, file_path):
     if not path.lower().startswith('plugin://'):
         raise Exception('Not implemented')
 
-    data = _get_data(path)
-
-    if not isinstance(data, dict):
-        _write_raw(file_path, data)
-        return
-
-    if data.get('version', 1) > 1:
-        raise Exception('Unsupported version')
-
-    if 'epg' in data:
-        _write_epg(file_path, data)
-    elif 'streams' in data:
-        channels = _fix_channels(data)
-        _write_playlist(file_path, channels)
-    else:
-        raise Exception('Unsupported data')
+    conn = _connect(path)
+    try:
+        stream = JSONStream(conn.recv)
+        if stream.peek() == '':
+            raise Exception('No data returned from plugin')
+
+        if stream.peek() != '{':
+            _write_raw(file_path, stream.value())
+            return
+
+        found = False
+        for key in stream.iter_object():
+            if key == 'version':
+                if stream.value() > 1:
+                    raise Exception('Unsupported version')
+            elif key == 'epg' and not found:
+                # programmes are written as they are parsed
+                _write_epg(file_path, ((channel_id, stream.iter_array()) for channel_id in stream.iter_object()))
+                found = True
+            elif key == 'streams' and not found:
+                channels = _fix_channels({'streams': stream.value()})
+                _write_playlist(file_path, channels)
+                found = True
+            else:
+                stream.value()
+
+        if not found:
+            raise Exception('Unsupported data')
+    finally:
+        conn.close()
 
-def _get_data(plugin_url):
+def _connect(plugin_url):
+    # every call listens on its own port so several addons can be queried at once
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.bind(('localhost', 0))
     sock.listen(1)
@@ -49,22 +71,118 @@ def _get_data(plugin_url):
     try:
         conn, addr = sock.accept()
         conn.settimeout(None)
-
-        data = ''
-        while True:
-            chunk = conn.recv(CHUNK_SIZE)
-            if not chunk:
-                break
-            data += chunk.decode()
     except socket.timeout:
         raise Exception('Timout waiting for reply on port {}'.format(port))
     finally:
         sock.close()
 
-    if not data:
-        raise Exception('No data returned from plugin')
+    return conn
+
+class JSONStream(object):
+    """Incremental utf8 decode and JSON parse of a reply so large EPGs never need to be fully in memory"""
+    def __init__(self, read_func, chunk_size=CHUNK_SIZE):
+        self._read = read_func
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf8')()
+        self._json = json.JSONDecoder()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        if self._eof:
+            return False
+
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+        chunk = self._read(size)
+        if not chunk:
+            self._eof = True
+            self._buffer += self._decoder.decode(b'', final=True)
+            return False
+
+        self._buffer += self._decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._fill(self._chunk_size):
+                return ''
+
+    def _expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of "{}" at position {}'.format(chars, self._pos))
+
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                value, end = None, None
+
+            # a value ending at the buffer end may be cut off (eg. numbers)
+            if end is not None and (end < len(self._buffer) or self._eof):
+                self._pos = end
+                return value
+
+            # grow reads with the buffer so a large value is not re-decoded once per chunk
+            if not self._fill(max(self._chunk_size, len(self._buffer) - self._pos)) and end is None:
+                raise ValueError('Invalid JSON at position {}'.format(self._pos))
+
+    def iter_object(self):
+        # yields keys. the caller must read each value before the next key
+        self._expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        self._expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield self.value()
+
+            if self._expect(',]') == ']':
+                return
+
+def xmltv_time(value):
+    match = ISO_PATTERN.match(value) if isinstance(value, string_types) else None
+    if not match:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return time.strftime('%Y%m%d%H%M%S +0000', time.gmtime(value))
+        return arrow.get(value).format('YYYYMMDDHHmmss Z')
+
+    year, month, day, hour, minute, second, offset = match.groups()
+    if not offset or offset == 'Z':
+        offset = '+0000'
+    else:
+        offset = offset.replace(':', '')
+        if len(offset) == 3:
+            offset += '00'
 
-    return json.loads(data)
+    return u'{}{}{}{}{}{} {}'.format(year, month, day, hour, minute, second or '00', offset)
 
 def _fix_channels(data):
     channels = []
@@ -94,13 +212,13 @@ def _write_raw(file_path, data):
     with codecs.open(file_path, 'w', encoding='utf8') as f:
         f.write(data)
 
-def _write_epg(file_path, data):
+def _write_epg(file_path, epg):
     with codecs.open(file_path, 'w', encoding='utf8') as f:
         f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
 
-        for channel_id in data['epg']:
+        for channel_id, items in epg:
             f.write(u'<channel id="{}"></channel>'.format(escape(channel_id)))
-            for item in data['epg'][channel_id]:
+            for item in items:
                 try:
                     if not item.get('title') or not item.get('start') or not item.get('stop'):
                         log.debug('IPTV Manager - Skipping item as missing data: {}'.format(item))
@@ -111,8 +229,8 @@ def _write_epg(file_path, data):
                         title = u'{} [COLOR green]\u2022[/COLOR][COLOR vod="{}"][/COLOR]'.format(title, item['stream'])
 
                     f.write(u'<programme start="{start}" stop="{stop}" channel="{channel}"{vod}><title>{title}</title>'.format(
-                        start = arrow.get(item['start']).format('YYYYMMDDHHmmss Z'),
-                        stop = arrow.get(item['stop']).format('YYYYMMDDHHmmss Z'),
+                        start = xmltv_time(item['start']),
+                        stop = xmltv_time(item['stop']),
                         channel = escape(channel_id),
                         vod = ' catchup-id="{}"'.format(escape(item['stream'])) if item.get('stream') else '',
                         title = escape(title),
@@ -102,5 +102,12 @@ class Language(BaseLanguage):
     MERGE_AT_HOUR          = 30098
     MERGE_HOUR             = 30099
     MANUALLY_SETUP         = 30100
+    MERGE_WORKERS          = 30101
+    STREAM_EPGS            = 30102
+    EPG_PAST_HOURS         = 30103
+    EPG_FUTURE_DAYS        = 30104
+    EPG_STRIP_ELEMENTS     = 30105
+    HTTP_API_PORT          = 30106
+    HTTP_API_REMOTE        = 30107
 
 _ = Language()
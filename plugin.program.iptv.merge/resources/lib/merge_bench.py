@@ -0,0 +1,399 @@
+"""Merge pipeline benchmark.
+
+Generates synthetic M3U playlists and XMLTV feeds, serves them from a local HTTP stand-in and runs
+Merger.playlists / Merger.epgs end to end with the Kodi modules stubbed out.
+Only uses the standard library and the repo's own modules so it can be run from a desktop python 3.
+
+    python3 merge_bench.py
+    python3 merge_bench.py --channels 100000 --playlists 4 --epg-mb 1000 --runs 2 --json results.json
+
+Each stage reports wall time, peak RSS, time spent in sqlite and bytes written.
+The second and later runs exercise the unchanged source path.
+Generated sources are kept in the work dir and re-used when the same options are given again.
+"""
+import argparse
+import gzip
+import json
+import lzma
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from http.server import SimpleHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+ADDON_ID = 'plugin.program.iptv.merge'
+ADDON_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+REPO_ROOT = os.path.dirname(ADDON_ROOT)
+ARCHIVES = ['', '.gz', '.xz']
+
+def stub_kodi(work_dir, settings):
+    # just enough of the Kodi api for slyguy + iptv merge to import and merge
+    xbmc = types.ModuleType('xbmc')
+    xbmc.LOGDEBUG, xbmc.LOGINFO, xbmc.LOGWARNING, xbmc.LOGERROR, xbmc.LOGFATAL, xbmc.LOGNONE = range(6)
+    xbmc.log = lambda msg, level=0: None
+    xbmc.translatePath = lambda path: path.replace('special://', work_dir + '/')
+    xbmc.getInfoLabel = lambda label: '19.0'
+    xbmc.getCondVisibility = lambda condition: False
+    xbmc.getIPAddress = lambda: '127.0.0.1'
+    xbmc.executebuiltin = lambda *args, **kwargs: None
+    xbmc.executeJSONRPC = lambda data: '{"result":{}}'
+    xbmc.sleep = lambda ms: None
+    xbmc.Monitor = type('Monitor', (object,), {'abortRequested': lambda self: False, 'waitForAbort': lambda self, timeout=0: False})
+    xbmc.Player = type('Player', (object,), {})
+
+    class Addon(object):
+        def __init__(self, id=''):
+            self._id = id or ADDON_ID
+
+        def getAddonInfo(self, key):
+            return {'id': self._id, 'version': '0.0.0', 'name': self._id, 'path': os.path.join(REPO_ROOT, self._id),
+                'profile': os.path.join(work_dir, 'profile', self._id), 'icon': '', 'fanart': ''}[key]
+
+        def getSetting(self, key):
+            return settings.get(key, '') if self._id == ADDON_ID else ''
+
+        def setSetting(self, key, value):
+            if self._id == ADDON_ID:
+                settings[key] = value
+
+        def getLocalizedString(self, id):
+            return str(id)
+
+    xbmcaddon = types.ModuleType('xbmcaddon')
+    xbmcaddon.Addon = Addon
+
+    properties = {}
+    class Window(object):
+        def __init__(self, id=0): pass
+        def setProperty(self, key, value): properties[key] = value
+        def getProperty(self, key): return properties.get(key, '')
+        def clearProperty(self, key): properties.pop(key, None)
+
+    xbmcgui = types.ModuleType('xbmcgui')
+    xbmcgui.Window = Window
+    for name in ('ListItem', 'Dialog', 'DialogProgress', 'DialogProgressBG'):
+        setattr(xbmcgui, name, type(name, (object,), {}))
+
+    def mkdirs(path):
+        os.makedirs(path, exist_ok=True)
+        return True
+
+    def delete(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def copy(src, dst):
+        shutil.copy(src, dst)
+        return True
+
+    xbmcvfs = types.ModuleType('xbmcvfs')
+    xbmcvfs.exists = os.path.exists
+    xbmcvfs.delete = delete
+    xbmcvfs.copy = copy
+    xbmcvfs.mkdirs = mkdirs
+    xbmcvfs.listdir = lambda path: ([], [])
+    xbmcvfs.translatePath = xbmc.translatePath
+
+    for module in (xbmc, xbmcaddon, xbmcgui, xbmcvfs, types.ModuleType('xbmcplugin'), types.ModuleType('xbmcdrm')):
+        sys.modules[module.__name__] = module
+
+    os.environ['ADDON_ID'] = ADDON_ID
+    sys.path[:0] = [ADDON_ROOT, os.path.join(REPO_ROOT, 'script.module.slyguy', 'resources', 'modules'), os.path.join(REPO_ROOT, 'slyguy.dependencies', 'resources', 'modules')]
+
+def write_playlist(path, index, channels, rand):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('#EXTM3U x-tvg-url="" tvg-shift="0"\n\n#EXTGRP:"Top";Other\n\n')
+        for i in range(channels):
+            attribs = 'tvg-id="bench{}.{}"'.format(index, i) if i % 7 else 'tvg-name="Bench {}.{}"'.format(index, i)
+            if i % 3 == 0: attribs += ' tvg-chno="{}"'.format(i + 100)
+            if i % 11 == 0: attribs += ' radio="true"'
+            if i % 5 == 0: attribs += ' group-title="Group {};Group {}"'.format(i % 20, rand.randint(0, 50))
+            if i % 13 == 0: attribs += ' tvg-logo="http://logos.local/{}.png" catchup="default"'.format(i)
+            f.write(u'#EXTINF:-1 {},Channel é {}.{}\n'.format(attribs, index, i))
+            if i % 4 == 0: f.write('#EXTGRP:Extra {}\n'.format(i % 3))
+            if i % 6 == 0: f.write('#KODIPROP:inputstream.adaptive.manifest_type=mpd\n#KODIPROP:inputstream=inputstream.adaptive\n#EXTVLCOPT:http-user-agent=bench\n')
+            if i % 19 == 0: f.write('#EXT-X-PLAYLIST-TYPE:VOD\n')
+            f.write('http://streams.local/{}/{}.m3u8\n'.format(index, i))
+
+def write_epg(path, index, channels, size, rand):
+    archive = os.path.splitext(path)[1]
+    opener = {'.gz': gzip.open, '.xz': lzma.open}.get(archive, open)
+    start = int(time.time()) // 3600 * 3600 - 86400
+
+    def timestamp(value):
+        return time.strftime('%Y%m%d%H%M%S +0000', time.gmtime(value))
+
+    with opener(path, 'wb') as f:
+        written = f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="merge_bench">\n')
+        for i in range(channels):
+            written += f.write('<channel id="bench{}.{}"><display-name>Channel {}</display-name><icon src="http://logos.local/{}.png"/></channel>\n'.format(index, i, i, i).encode('utf8'))
+
+        # an hour of programmes for every channel until the (uncompressed) size is reached
+        hour = 0
+        while written < size:
+            begin, end = timestamp(start + hour * 3600), timestamp(start + (hour + 1) * 3600)
+            for i in range(channels):
+                programme = u'<programme start="{}" stop="{}" channel="bench{}.{}"><title lang="en">Programme é {}</title>' \
+                    u'<desc lang="en">{}</desc><category lang="en">Cat {}</category><icon src="http://images.local/{}.jpg"/>' \
+                    u'<credits><actor>Actor {}</actor></credits><episode-num system="onscreen">S1E{}</episode-num></programme>\n'.format(
+                    begin, end, index, i, hour, 'Lorem ipsum &amp; dolor ' * rand.randint(1, 8), i % 10, hour, rand.randint(0, 999), hour)
+                written += f.write(programme.encode('utf8'))
+            hour += 1
+
+        f.write(b'</tv>\n')
+
+def generate(args, www_dir):
+    config = [args.channels, args.playlists, args.epgs, args.epg_mb, args.seed]
+    config_path = os.path.join(www_dir, 'config.json')
+    if os.path.exists(config_path) and json.load(open(config_path)) == config:
+        print('Re-using sources in {}'.format(www_dir))
+        return
+
+    shutil.rmtree(www_dir, ignore_errors=True)
+    os.makedirs(www_dir)
+    rand = random.Random(args.seed)
+
+    start = time.time()
+    per_playlist = args.channels // args.playlists
+    for i in range(args.playlists):
+        write_playlist(os.path.join(www_dir, 'playlist{}.m3u'.format(i)), i, per_playlist, rand)
+
+    # epgs cover the playlist channels and are spread over plain, gz and xz
+    for i in range(args.epgs):
+        write_epg(os.path.join(www_dir, 'epg{}.xml{}'.format(i, ARCHIVES[i % len(ARCHIVES)])), i % args.playlists, per_playlist,
+            args.epg_mb * 1024 * 1024 // args.epgs, rand)
+
+    json.dump(config, open(config_path, 'w'))
+    print('Generated sources in {:.1f}s'.format(time.time() - start))
+
+class SourceHandler(SimpleHTTPRequestHandler):
+    latency = 0
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleHTTPRequestHandler.do_GET(self)
+
+class SourceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Stats(object):
+    def __init__(self):
+        self.db_time = 0
+        self.db_calls = 0
+
+class TimedCursor(object):
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def _timed(self, name, *args):
+        start = time.time()
+        try:
+            return getattr(self._cursor, name)(*args)
+        finally:
+            self._stats.db_time += time.time() - start
+            self._stats.db_calls += 1
+
+    def execute(self, *args): return self._timed('execute', *args) and self
+    def executemany(self, *args): return self._timed('executemany', *args) and self
+    def fetchone(self): return self._timed('fetchone')
+    def fetchmany(self, *args): return self._timed('fetchmany', *args)
+    def fetchall(self): return self._timed('fetchall')
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def reset_peak_rss():
+    # linux only. lets each stage report its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+    except ImportError:
+        return None
+
+def bytes_written():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        return None
+
+def measure(name, stats, func):
+    reset_peak_rss()
+    stats.db_time, stats.db_calls = 0, 0
+    written = bytes_written()
+    start = time.time()
+
+    output = func()
+
+    result = {
+        'stage': name,
+        'wall_time': round(time.time() - start, 3),
+        'db_time': round(stats.db_time, 3),
+        'db_calls': stats.db_calls,
+        'peak_rss': peak_rss(),
+        'bytes_written': bytes_written() - written if written is not None else None,
+    }
+    result.update(output or {})
+    return result
+
+def run(args):
+    work_dir = os.path.abspath(args.work_dir or os.path.join(tempfile.gettempdir(), 'iptv_merge_bench'))
+    www_dir = os.path.join(work_dir, 'www')
+    profile_dir = os.path.join(work_dir, 'profile')
+    output_dir = os.path.join(work_dir, 'output')
+
+    generate(args, www_dir)
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    settings = {
+        'merge_workers': str(args.workers),
+        'stream_epgs': 'true' if args.stream_epgs else 'false',
+        'remove_epg_orphans': 'true' if args.remove_orphans else 'false',
+    }
+    stub_kodi(work_dir, settings)
+
+    from slyguy import database
+    from resources.lib.models import Playlist, EPG, Channel, Override
+    from resources.lib.merger import Merger
+
+    SourceHandler.latency = args.latency / 1000.0
+    SourceHandler.directory = www_dir
+    server = SourceServer(('127.0.0.1', 0), lambda *a, **k: SourceHandler(*a, directory=www_dir, **k))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    database.connect()
+    for i in range(args.playlists):
+        Playlist.create(source_type=Playlist.TYPE_URL, path=base_url + 'playlist{}.m3u'.format(i), order=i+1)
+    for i in range(args.epgs):
+        EPG.create(source_type=EPG.TYPE_URL, path=base_url + 'epg{}.xml{}'.format(i, ARCHIVES[i % len(ARCHIVES)]))
+    database.close()
+
+    stats = Stats()
+    cursor = database.db.cursor
+    database.db.cursor = lambda *args, **kwargs: TimedCursor(cursor(*args, **kwargs), stats)
+
+    def errors(source_cls):
+        database.connect()
+        try:
+            return sum(1 for source in source_cls.select() if not source.results or source.results[0][1] != source_cls.OK)
+        finally:
+            database.close()
+
+    def merge_playlists():
+        path = merger.playlists()
+        database.connect()
+        count = Channel.select().count()
+        database.close()
+        return {'channels': count, 'output_bytes': os.path.getsize(path), 'errors': errors(Playlist)}
+
+    def merge_epgs():
+        path = merger.epgs()
+        return {'output_bytes': os.path.getsize(path), 'errors': errors(EPG)}
+
+    def list_channels():
+        # what the channel manager does: page through every channel with overrides applied
+        database.connect()
+        try:
+            pages = 0
+            while True:
+                pages += 1
+                if len(list(Channel.channel_list(radio=0, page=pages, page_size=args.page_size))) < args.page_size:
+                    break
+            playlist_count = sum(1 for channel in Channel.playlist_list())
+        finally:
+            database.close()
+        return {'pages': pages, 'channels': playlist_count}
+
+    results = []
+    for run_index in range(args.runs):
+        merger = Merger(output_path=output_dir, forced=False)
+        results.append(measure('playlists', stats, merge_playlists))
+        results.append(measure('epgs', stats, merge_epgs))
+
+        if run_index == 0 and args.overrides:
+            database.connect()
+            rows = Channel.select(Channel.slug, Channel.playlist).order_by(Channel.slug).limit(args.overrides).tuples()
+            with database.db.atomic():
+                for i, (slug, playlist_id) in enumerate(rows):
+                    Override.create(playlist=playlist_id, slug=slug, attribs={'catchup': 'bench'},
+                        fields={'name': 'Override {}'.format(i), 'chno': 9000 + i} if i % 2 else {'visible': False})
+            database.close()
+
+        results.append(measure('channels', stats, list_channels))
+        for result in results[-3:]:
+            result['run'] = run_index + 1
+
+    server.shutdown()
+
+    print('{:<4} {:<10} {:>9} {:>9} {:>9} {:>10} {:>11} {:>7}'.format('Run', 'Stage', 'Wall (s)', 'DB (s)', 'DB calls', 'Peak RSS', 'Written', 'Errors'))
+    for result in results:
+        print('{:<4} {:<10} {:>9.2f} {:>9.2f} {:>9} {:>9.1f}M {:>10.1f}M {:>7}'.format(result['run'], result['stage'], result['wall_time'], result['db_time'],
+            result['db_calls'], (result['peak_rss'] or 0) / 1024.0 / 1024, (result['bytes_written'] or 0) / 1024.0 / 1024, result.get('errors', '')))
+
+    output = {
+        'options': vars(args),
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+    if args.json == '-':
+        print(json.dumps(output, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+        print('Results written to {}'.format(args.json))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the IPTV Merge playlist / EPG pipeline')
+    parser.add_argument('--channels', type=int, default=10000, help='total channels across all playlists (default: 10000)')
+    parser.add_argument('--playlists', type=int, default=4, help='number of playlists (default: 4)')
+    parser.add_argument('--epgs', type=int, default=3, help='number of XMLTV feeds, alternating plain / gz / xz (default: 3)')
+    parser.add_argument('--epg-mb', type=int, default=100, help='total uncompressed XMLTV size in MB (default: 100)')
+    parser.add_argument('--overrides', type=int, default=1000, help='channel overrides added after the first merge (default: 1000)')
+    parser.add_argument('--page-size', type=int, default=200, help='channel manager page size (default: 200)')
+    parser.add_argument('--workers', type=int, default=4, help='merge_workers setting (default: 4)')
+    parser.add_argument('--stream-epgs', action='store_true', help='enable the stream_epgs setting')
+    parser.add_argument('--remove-orphans', action='store_true', help='enable the remove_epg_orphans setting')
+    parser.add_argument('--latency', type=int, default=0, help='source server latency per request in ms (default: 0)')
+    parser.add_argument('--runs', type=int, default=1, help='merge runs. runs after the first hit the unchanged path (default: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the generated sources (default: 1)')
+    parser.add_argument('--work-dir', help='where sources, the profile and outputs are kept (default: <tmp>/iptv_merge_bench)')
+    parser.add_argument('--json', help='write machine readable results to this file ("-" for stdout)')
+    run(parser.parse_args())
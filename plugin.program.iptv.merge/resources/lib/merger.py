@@ -2,27 +2,235 @@ import os
 import shutil
 import time
 import codecs
+import hashlib
+import calendar
+import threading
+import zlib
 import xml.parsers.expat
 
 import arrow
 from kodi_six import xbmc, xbmcvfs
+from six import PY2
 from six.moves.urllib.parse import unquote_plus
 
 from slyguy import settings, database, gui, userdata
 from slyguy.log import log
-from slyguy.util import remove_file, hash_6, FileIO, gzip_extract, xz_extract, run_plugin, safe_copy, unique
+from slyguy.util import remove_file, hash_6, md5sum, FileIO, gzip_extract, xz_extract, run_plugin, safe_copy, unique, set_kodi_string
 from slyguy.session import Session, gdrivedl
 from slyguy.constants import ADDON_PROFILE, CHUNK_SIZE
 from slyguy.exceptions import Error
 
 from .constants import *
-from .models import Source, Playlist, EPG, Channel, merge_info, parse_attribs, strip_quotes
+from .models import Source, Playlist, EPG, Channel, SourceState, merge_info, parse_attribs, parse_extinf, strip_quotes
 from .language import _
 from . import iptv_manager
 
 class AddonError(Error):
     pass
 
+class SourceUnchanged(Exception):
+    pass
+
+class PlaylistChannel(object):
+    __slots__ = ('slug', 'url', 'name', 'radio', 'chno', 'groups', 'epg_id', 'logo', 'attribs', 'properties', 'is_live')
+
+    def __init__(self):
+        self.slug = self.url = self.name = self.chno = self.epg_id = self.logo = None
+        self.radio = False
+        self.is_live = True
+        self.groups = []
+        self.attribs = {}
+        self.properties = {}
+
+def detect_archive_type(data):
+    if data == b'\xfd\x37\x7a\x58\x5a\00':
+        log.debug('Detected XZ archive')
+        return Source.ARCHIVE_XZ
+    elif data[0:2] == b'\x1f\x8b':
+        log.debug('Detected gz archive')
+        return Source.ARCHIVE_GZIP
+    else:
+        return Source.ARCHIVE_NONE
+
+class StreamReader(object):
+    """File-like wrapper around a response stream that hashes what is read and lets the start be peeked"""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._buffer = b''
+        self.md5 = hashlib.md5()
+
+    def peek(self, size):
+        while len(self._buffer) < size:
+            chunk = self._fileobj.read(size - len(self._buffer))
+            if not chunk:
+                break
+            self.md5.update(chunk)
+            self._buffer += chunk
+
+        return self._buffer[:size]
+
+    def read(self, size=-1):
+        if self._buffer:
+            if size < 0:
+                size = len(self._buffer)
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+
+        data = self._fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+class SourceFetcher(object):
+    """Fetches sources in order in worker threads while earlier ones are merged.
+    A fetched file holds its worker slot until done() is called, so at most workers files are on disk at once"""
+    def __init__(self, sources, fetch, workers):
+        self._ids = set(id(x) for x in sources)
+        self._started = []
+        self._results = {}
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(workers)
+        self._closed = False
+
+        thread = threading.Thread(target=self._dispatch, args=(sources, fetch))
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self, sources, fetch):
+        for index, source in enumerate(sources):
+            self._slots.acquire()
+            with self._cond:
+                if self._closed:
+                    return
+                self._started.append(source)
+
+            thread = threading.Thread(target=self._fetch, args=(fetch, index, source))
+            thread.daemon = True
+            thread.start()
+
+    def _fetch(self, fetch, index, source):
+        try:
+            result = fetch(index, source)
+        except Exception as e:
+            result = (None, e, 0)
+
+        with self._cond:
+            self._results[id(source)] = result
+            self._cond.notify_all()
+
+    def get(self, source):
+        """Waits for the source and returns (file_path, error, fetch_time). None if it isn't fetched here"""
+        if id(source) not in self._ids:
+            return None
+
+        with self._cond:
+            while id(source) not in self._results:
+                self._cond.wait()
+            return self._results[id(source)]
+
+    def done(self, source):
+        result = self.get(source)
+        if result is None:
+            return
+
+        self._ids.discard(id(source))
+        remove_file(result[0])
+        self._slots.release()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            started = list(self._started)
+        self._slots.release()
+
+        # wait for running fetches so their files can be removed
+        for source in started:
+            self.done(source)
+
+class GzipReader(object):
+    """Decompresses a gzip stream as it is read. GzipFile needs tell() and seek() on python 2"""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._eof = False
+
+    def _decompress(self, data):
+        out = self._decompressor.decompress(data)
+
+        # concatenated gzip members, trailing zero padding is ignored like GzipFile
+        unused = self._decompressor.unused_data.lstrip(b'\x00')
+        while unused:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self._decompressor.decompress(unused)
+            unused = self._decompressor.unused_data.lstrip(b'\x00')
+
+        return out
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+            else:
+                self._buffer += self._decompress(chunk)
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._buffer = b''
+
+class HashedWriter(object):
+    """File-like wrapper that hashes what is written. Seeking back to an offset returned by tell() restores the hash"""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._marks = {}
+        self.name = getattr(fileobj, 'name', '')
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        if self.md5:
+            self.md5.update(data)
+        return self._fileobj.write(data)
+
+    def tell(self):
+        index = self._fileobj.tell()
+        if self.md5:
+            self._marks[index] = self.md5.copy()
+        return index
+
+    def seek(self, index, whence=os.SEEK_SET):
+        self._fileobj.seek(index, whence)
+        index = self._fileobj.tell()
+        mark = self._marks.get(index)
+        self.md5 = mark.copy() if mark else None
+        return index
+
+    def truncate(self, size=None):
+        return self._fileobj.truncate(size)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def close(self):
+        self._fileobj.close()
+
+    def hexdigest(self):
+        return self.md5.hexdigest() if self.md5 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 def copy_partial_data(file_path, _out, start_index, end_index):
     if start_index < 1 or end_index < start_index:
         return
@@ -51,8 +259,28 @@ def _seek_file(f, index, truncate=True):
         if truncate:
             f.truncate()
 
+def xmltv_timestamp(value):
+    # YYYYMMDDhhmmss +zzzz
+    try:
+        value = value.strip()
+        timestamp = calendar.timegm((int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[8:10] or 0), int(value[10:12] or 0), int(value[12:14] or 0), 0, 0, 0))
+        offset = value[14:].strip()
+        if offset:
+            sign = -1 if offset[0] == '-' else 1
+            offset = offset.lstrip('+-')
+            timestamp -= sign * (int(offset[0:2]) * 3600 + int(offset[2:4]) * 60)
+        return timestamp
+    except:
+        return None
+
 class XMLParser(object):
-    def __init__(self, out, epg_ids=None):
+    """Splices <channel> / <programme> elements from the input straight to out.
+
+    Input is kept in a bytearray that is only compacted once per chunk, elements are written
+    as memoryview slices of it. Programmes outside of min_stop / max_start are dropped and
+    strip_elements child elements (eg. icon, credits) are cut out.
+    """
+    def __init__(self, out, epg_ids=None, min_stop=None, max_start=None, strip_elements=None):
         self._out = out
 
         if epg_ids is None:
@@ -62,9 +290,13 @@ class XMLParser(object):
             self._epg_ids = set(epg_ids)
             self._check_orphans = True
 
+        self._min_stop = min_stop
+        self._max_start = max_start
+        self._strip_elements = set(strip_elements or [])
+
         self._counts = {
             'channel': {'added': 0, 'skipped': 0},
-            'programme': {'added': 0, 'skipped': 0},
+            'programme': {'added': 0, 'skipped': 0, 'pruned': 0},
         }
 
         self._parser = xml.parsers.expat.ParserCreate()
@@ -72,44 +304,114 @@ class XMLParser(object):
         self._parser.StartElementHandler = self._start_element
         self._parser.EndElementHandler = self._end_element
 
-        self._buffer = b''
+        self._buffer = bytearray()
         self._offset = 0
+        self._keep = 0
         self._add = False
+        self._element = None
+        self._start = None
+        self._depth = 0
+        self._cut_start = None
+        self._cuts = []
 
     def epg_count(self):
         if self._check_orphans:
-            return 'Added {added} / Skipped {skipped}'.format(**self._counts['programme'])
+            text = 'Added {added} / Skipped {skipped}'.format(**self._counts['programme'])
         else:
-            return 'Added {added}'.format(**self._counts['programme'])
+            text = 'Added {added}'.format(**self._counts['programme'])
+
+        if self._counts['programme']['pruned']:
+            text += ' / Pruned {pruned}'.format(**self._counts['programme'])
+
+        return text
+
+    def _in_window(self, attrs):
+        if self._min_stop:
+            stop = xmltv_timestamp(attrs.get('stop', ''))
+            if stop and stop < self._min_stop:
+                return False
+
+        if self._max_start:
+            start = xmltv_timestamp(attrs.get('start', ''))
+            if start and start > self._max_start:
+                return False
+
+        return True
 
     def _start_element(self, name, attrs):
+        if self._element:
+            self._depth += 1
+            if self._depth == 1 and self._add and self._element == 'programme' and name in self._strip_elements:
+                self._cut_start = self._parser.CurrentByteIndex
+            return
+
         if name not in ('channel', 'programme'):
             return
 
-        self._buffer = self._buffer[self._parser.CurrentByteIndex-self._offset:]
-        self._offset = self._parser.CurrentByteIndex
+        self._element = name
+        self._start = self._keep = self._parser.CurrentByteIndex
+        self._depth = 0
+        self._cuts = []
 
-        if not self._check_orphans:
+        if self._check_orphans:
+            if name == 'programme':
+                self._add = 'channel' in attrs and attrs['channel'] in self._epg_ids
+            else:
+                self._add = 'id' in attrs and attrs['id'] in self._epg_ids
+        else:
             self._add = True
-            return
 
-        if name == 'programme':
-            self._add = 'channel' in attrs and attrs['channel'] in self._epg_ids
-        elif name == 'channel':
-            self._add = 'id' in attrs and attrs['id'] in self._epg_ids
+        if not self._add:
+            self._counts[name]['skipped'] += 1
+        elif name == 'programme' and (self._min_stop or self._max_start) and not self._in_window(attrs):
+            self._add = False
+            self._counts[name]['pruned'] += 1
+
+    def _end_index(self, name):
+        # end handler index is the start of the closing tag, or the end of an empty (<tag/>) element
+        index = self._parser.CurrentByteIndex - self._offset
+        if self._buffer.startswith(b'</' + name.encode('utf8'), index):
+            return index, self._buffer.index(b'>', index) + 1
+        return index, index
 
     def _end_element(self, name):
-        if name not in ('channel', 'programme'):
+        if not self._element:
+            return
+
+        if self._depth:
+            if self._depth == 1 and self._cut_start is not None:
+                self._cuts.append([self._cut_start, self._offset + self._end_index(name)[1]])
+                self._cut_start = None
+            self._depth -= 1
             return
 
+        end, close_end = self._end_index(name)
+        self._keep = self._offset + close_end
+
         if self._add:
             self._counts[name]['added'] += 1
-            self._out.write(self._buffer[:self._parser.CurrentByteIndex-self._offset] + (b'</programme>' if name == 'programme' else b'</channel>'))
-        else:
-            self._counts[name]['skipped'] += 1
 
-        self._buffer = self._buffer[self._parser.CurrentByteIndex-self._offset:]
-        self._offset = self._parser.CurrentByteIndex
+            pos = self._start - self._offset
+            for cut_start, cut_end in self._cuts:
+                self._write(pos, cut_start - self._offset)
+                pos = cut_end - self._offset
+            self._write(pos, close_end)
+
+        self._element = None
+        self._start = None
+
+    def _write(self, start, end):
+        if end <= start:
+            return
+
+        if PY2:
+            self._out.write(bytes(self._buffer[start:end]))
+        else:
+            view = memoryview(self._buffer)
+            try:
+                self._out.write(view[start:end])
+            finally:
+                view.release()
 
     def parse(self, _in, epg):
         epg.start_index = self._out.tell()
@@ -119,9 +421,16 @@ class XMLParser(object):
             if not chunk:
                 break
 
-            self._buffer += chunk
+            self._buffer.extend(chunk)
             self._parser.Parse(chunk)
 
+            # drop everything before the current element (or the end of the last one)
+            # expat may not have reported the tag at the end of the chunk yet
+            keep = self._keep - self._offset
+            if keep:
+                del self._buffer[:keep]
+                self._offset += keep
+
         self._out.flush()
         epg.end_index = self._out.tell()
 
@@ -176,7 +485,16 @@ class Merger(object):
         if not result:
             raise AddonError(msg)
 
-    def _process_source(self, source, method_name, file_path):
+    def _process_source(self, source, method_name, file_path, state=None):
+        self._process_source_path(source, method_name, file_path, state)
+
+        if state:
+            content_hash = md5sum(file_path)
+            if content_hash and content_hash == state.content_hash:
+                raise SourceUnchanged()
+            state.content_hash = content_hash
+
+    def _process_source_path(self, source, method_name, file_path, state=None):
         remove_file(file_path)
 
         path = source.path.strip()
@@ -184,7 +502,7 @@ class Merger(object):
         archive_type = source.archive_type
 
         if source_type != Source.TYPE_ADDON:
-            self._process_path(path, archive_type, file_path)
+            self._process_path(path, archive_type, file_path, state)
             return
 
         addon_id = path
@@ -210,7 +528,7 @@ class Merger(object):
             path = path.replace('$IP', xbmc.getIPAddress()).replace('%24IP', xbmc.getIPAddress())
             self._process_path(path.strip(), archive_type, file_path)
 
-    def _process_path(self, path, archive_type, file_path):
+    def _process_path(self, path, archive_type, file_path, state=None):
         if path.lower().startswith('plugin://'):
             self._call_addon_method(path, file_path)
             return
@@ -221,7 +539,15 @@ class Merger(object):
                 path = gdrivedl(path, file_path)
             else:
                 log.debug('Downloading: {} > {}'.format(path, file_path))
-                resp = Session().chunked_dl(path, file_path)
+                resp = Session().chunked_dl(path, file_path, headers=state.conditional_headers() if state else None)
+                if resp.status_code == 304:
+                    log.debug('Not modified: {}'.format(path))
+                    raise SourceUnchanged()
+
+                if state:
+                    state.etag = resp.headers.get('etag')
+                    state.last_modified = resp.headers.get('last-modified')
+
                 path = resp.url
 
         elif not xbmcvfs.exists(path):
@@ -232,13 +558,7 @@ class Merger(object):
         if archive_type == Source.ARCHIVE_AUTO:
             try:
                 with open(file_path, 'rb') as f:
-                    data = f.read(6)
-                    if data == b'\xfd\x37\x7a\x58\x5a\00':
-                        archive_type = Source.ARCHIVE_XZ
-                        log.debug('Detected XZ archive')
-                    elif data[0:2] == b'\x1f\x8b':
-                        archive_type = Source.ARCHIVE_GZIP
-                        log.debug('Detected gz archive')
+                    archive_type = detect_archive_type(f.read(6))
             except Exception as e:
                 log.debug('Failed to detect file type')
                 log.exception(e)
@@ -248,9 +568,103 @@ class Merger(object):
         elif archive_type == Source.ARCHIVE_XZ:
             xz_extract(file_path)
 
+    def _can_stream(self, source):
+        path = source.path.strip().lower()
+        return source.source_type == Source.TYPE_URL and path.startswith(('http://', 'https://')) and 'drive.google.com' not in path
+
+    def _stream_source(self, source, state=None):
+        path = source.path.strip()
+        log.debug('Streaming: {}'.format(path))
+
+        resp = Session().request('GET', path, stream=True, headers=state.conditional_headers() if state else None)
+        resp.raise_for_status()
+        if resp.status_code == 304:
+            log.debug('Not modified: {}'.format(path))
+            resp.close()
+            raise SourceUnchanged()
+
+        if state:
+            state.etag = resp.headers.get('etag')
+            state.last_modified = resp.headers.get('last-modified')
+
+        # undo any transport (content-encoding) compression
+        resp.raw.decode_content = True
+        reader = StreamReader(resp.raw)
+
+        archive_type = source.archive_type
+        if archive_type == Source.ARCHIVE_AUTO:
+            archive_type = detect_archive_type(reader.peek(6))
+
+        if archive_type == Source.ARCHIVE_GZIP:
+            return reader, GzipReader(reader)
+        elif archive_type == Source.ARCHIVE_XZ:
+            if PY2:
+                raise Error(_.XZ_ERROR)
+            import lzma
+            return reader, lzma.LZMAFile(reader)
+        else:
+            return reader, reader
+
+    def _open_epg(self, epg, fetched, state, stream=False):
+        if stream:
+            reader, _in = self._stream_source(epg, state)
+            return reader, _in, self.tmp_file
+
+        file_path = self._get_source(epg, METHOD_EPG, fetched, state)
+        return None, FileIO(file_path, 'rb'), file_path
+
+    def _fetch_sources(self, sources, method_name, states):
+        workers = settings.getInt('merge_workers', MERGE_WORKERS)
+        if workers < 2 or len(sources) < 2:
+            return None
+
+        def fetch(index, source):
+            # each source gets its own tmp file so they can be fetched at the same time
+            file_path = '{}_{}'.format(self.tmp_file, index)
+            start = time.time()
+            try:
+                log.debug('Fetching: {}'.format(source.path))
+                self._process_source(source, method_name, file_path, states.get(id(source)))
+            except Exception as e:
+                error = e
+            else:
+                error = None
+
+            return file_path, error, time.time() - start
+
+        return SourceFetcher(sources, fetch, workers)
+
+    def _fetched(self, fetched, source):
+        return fetched.get(source) if fetched else None
+
+    def _get_source(self, source, method_name, fetched, state=None):
+        result = self._fetched(fetched, source)
+        if result is None:
+            self._process_source(source, method_name, self.tmp_file, state)
+            return self.tmp_file
+
+        file_path, error, fetch_time = result
+        if error:
+            raise error
+
+        return file_path
+
+    def _playlist_config(self, playlist, hide_groups):
+        return hash_6([playlist.path, playlist.archive_type, playlist.skip_playlist_chno, playlist.use_start_chno, playlist.start_chno,
+            playlist.default_visible, playlist.skip_playlist_groups, playlist.group_name, hide_groups])
+
+    def _unchanged_playlist(self, playlist, state):
+        count = Channel.select().where(Channel.playlist == playlist).count()
+        if count != state.data.get('count'):
+            return None
+
+        self._playlist_epgs.extend(state.data.get('epgs', []))
+        self._extgroups.extend(state.data.get('extgroups', []))
+        return count
+
     def _process_playlist(self, playlist, file_path):
         channel     = None
-        to_create   = set()
+        rows        = []
         slugs       = set()
         added_count = 0
 
@@ -261,6 +675,7 @@ class Merger(object):
 
         default_attribs = {}
         hide_groups = [x.strip() for x in settings.get('hide_groups', '').split(';') if x.strip()]
+        group_names = playlist.group_name.split(';') if playlist.group_name else []
 
         def is_visible(channel):
             if not playlist.default_visible:
@@ -273,119 +688,152 @@ class Merger(object):
 
             return True
 
-        with codecs.open(file_path, 'r', encoding='utf8', errors='replace') as infile:
-            for line in infile:
-                line = line.strip()
-
-                if '#EXTM3U' in line:
-                    #if not playlist.ignore_playlist_epg:
-                    attribs = parse_attribs(line)[0]
-                    xml_urls = attribs.get('x-tvg-url', '').split(',')
-                    xml_urls.extend(attribs.get('url-tvg', '').split(','))
-
-                    for url in xml_urls:
-                        url = url.strip()
-                        if url:
-                            self._playlist_epgs.append(url)
-
-                    if 'tvg-shift' in attribs:
-                        default_attribs['tvg-shift'] = attribs['tvg-shift']
-                    if 'catchup-correction' in attribs:
-                        default_attribs['catchup-correction'] = attribs['catchup-correction']
-
-                if not channel:
-                    channel = Channel()
-                    extgroups = []
-
-                if line.startswith('#EXTINF'):
-                    channel.load_extinf(line)
-                    for key in default_attribs:
-                        if key not in channel.attribs:
-                            channel.attribs[key] = default_attribs[key]
-
-                elif line.startswith('#EXTGRP'):
-                    value = line.split(':',1)[1].strip()
-                    if value:
-                        extgroups.extend([strip_quotes(x) for x in value.split(';')])
-
-                elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
-                    value = line.split(':',1)[1].strip()
-                    if value and '=' in value:
-                        key, value = value.split('=', 1)
-                        channel.properties[key] = value
-
-                elif line.startswith('#EXT-X-PLAYLIST-TYPE'):
-                    value = line.split(':',1)[1].strip()
-                    if value and value.upper() == 'VOD':
-                        channel.is_live = False
-
-                elif not line.startswith('#'):
-                    if not line:
-                        self._extgroups.extend(extgroups)
-                        channel = None
-                        continue
+        # rows are plain tuples inserted with executemany instead of Channel instances
+        fields = [Channel.slug, Channel.playlist, Channel.url, Channel.order, Channel.chno, Channel.name, Channel.custom, Channel.groups, Channel.radio,
+            Channel.epg_id, Channel.logo, Channel.attribs, Channel.properties, Channel.visible, Channel.is_live, Channel.modified]
+        sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(Channel._meta.table_name, ', '.join('"{}"'.format(x.column_name) for x in fields), ', '.join(['?']*len(fields)))
+        cursor = database.db.cursor()
+        json_value = Channel.attribs.db_value
+
+        # the playlist's old channels are already deleted, indexes are rebuilt before the transaction commits
+        with database.bulk_load(Channel):
+            with codecs.open(file_path, 'r', encoding='utf8', errors='replace') as infile:
+                for line in infile:
+                    line = line.strip()
+
+                    if '#EXTM3U' in line:
+                        #if not playlist.ignore_playlist_epg:
+                        attribs = parse_attribs(line)[0]
+                        xml_urls = attribs.get('x-tvg-url', '').split(',')
+                        xml_urls.extend(attribs.get('url-tvg', '').split(','))
+
+                        for url in xml_urls:
+                            url = url.strip()
+                            if url:
+                                self._playlist_epgs.append(url)
+
+                        if 'tvg-shift' in attribs:
+                            default_attribs['tvg-shift'] = attribs['tvg-shift']
+                        if 'catchup-correction' in attribs:
+                            default_attribs['catchup-correction'] = attribs['catchup-correction']
+
+                    if not channel:
+                        channel = PlaylistChannel()
+                        extgroups = []
+
+                    if line.startswith('#EXTINF'):
+                        channel.name, channel.radio, channel.chno, groups, channel.epg_id, channel.logo, channel.attribs = parse_extinf(line, channel.name)
+                        if groups:
+                            channel.groups = groups
+
+                        for key in default_attribs:
+                            if key not in channel.attribs:
+                                channel.attribs[key] = default_attribs[key]
+
+                    elif line.startswith('#EXTGRP'):
+                        value = line.split(':',1)[1].strip()
+                        if value:
+                            extgroups.extend([strip_quotes(x) for x in value.split(';')])
+
+                    elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
+                        value = line.split(':',1)[1].strip()
+                        if value and '=' in value:
+                            key, value = value.split('=', 1)
+                            channel.properties[key] = value
+
+                    elif line.startswith('#EXT-X-PLAYLIST-TYPE'):
+                        value = line.split(':',1)[1].strip()
+                        if value and value.upper() == 'VOD':
+                            channel.is_live = False
+
+                    elif not line.startswith('#'):
+                        if not line:
+                            self._extgroups.extend(extgroups)
+                            channel = None
+                            continue
+
+                        channel.url = line
+                        channel.groups.extend(extgroups)
+
+                        if playlist.skip_playlist_groups:
+                            channel.groups = []
+
+                        channel.groups.extend(group_names)
+
+                        if playlist.skip_playlist_chno:
+                            channel.chno = None
+
+                        if playlist.use_start_chno:
+                            if channel.radio:
+                                if channel.chno is None:
+                                    channel.chno = chnos['radio']
+
+                                chnos['radio'] = channel.chno + 1
+                            else:
+                                if channel.chno is None:
+                                    channel.chno = chnos['tv']
 
-                    channel.url = line
-                    channel.playlist = playlist
-                    channel.groups.extend(extgroups)
+                                chnos['tv'] = channel.chno + 1
 
-                    if playlist.skip_playlist_groups:
-                        channel.groups = []
+                        channel.groups = [x for x in channel.groups if x.strip()]
 
-                    if playlist.group_name:
-                        channel.groups.extend(playlist.group_name.split(';'))
+                        channel_id = channel.attribs.get('channel-id') or channel.attribs.get('channelid') or channel.epg_id or channel.url.lower().strip()
+                        channel.slug = slug = '{}.{}'.format(playlist.id, hash_6(channel_id))
 
-                    if playlist.skip_playlist_chno:
-                        channel.chno = None
+                        count = 1
+                        while channel.slug in slugs:
+                            channel.slug = '{}.{}'.format(slug, count)
+                            count += 1
 
-                    if playlist.use_start_chno:
-                        if channel.radio:
-                            if channel.chno is None:
-                                channel.chno = chnos['radio']
+                        slugs.add(channel.slug)
+                        added_count += 1
 
-                            chnos['radio'] = channel.chno + 1
-                        else:
-                            if channel.chno is None:
-                                channel.chno = chnos['tv']
+                        rows.append((channel.slug, playlist.id, channel.url, added_count, channel.chno, channel.name, False, json_value(channel.groups), channel.radio,
+                            channel.epg_id, channel.logo, json_value(channel.attribs), json_value(channel.properties), is_visible(channel), channel.is_live, False))
 
-                            chnos['tv'] = channel.chno + 1
+                        if len(rows) >= BULK_INSERT_ROWS:
+                            cursor.executemany(sql, rows)
+                            rows = []
 
-                    channel.groups = [x for x in channel.groups if x.strip()]
-                    channel.visible = is_visible(channel)
+                        channel = None
 
-                    channel_id = channel.attribs.get('channel-id') or channel.attribs.get('channelid') or channel.epg_id or channel.url.lower().strip()
-                    channel.slug = slug = '{}.{}'.format(playlist.id, hash_6(channel_id))
-                    channel.order = added_count + 1
+            if rows:
+                cursor.executemany(sql, rows)
 
-                    count = 1
-                    while channel.slug in slugs:
-                        channel.slug = '{}.{}'.format(slug, count)
-                        count += 1
+        slugs.clear()
 
-                    slugs.add(channel.slug)
-                    to_create.add(channel)
+        return added_count
 
-                    if Channel.bulk_create_lazy(to_create):
-                        to_create.clear()
+    def _publish(self, working_path, output_path, content_hash=None):
+        content_hash = content_hash or md5sum(working_path)
+        size = os.path.getsize(working_path)
 
-                    channel = None
-                    added_count += 1
+        outputs = userdata.get('outputs', {})
+        name = os.path.basename(output_path)
+        output = {'hash': content_hash, 'size': size, 'path': output_path}
 
-        Channel.bulk_create_lazy(to_create, force=True)
-        to_create.clear()
-        slugs.clear()
+        if outputs.get(name) == output and xbmcvfs.exists(output_path):
+            log.debug('Output unchanged: {}'.format(output_path))
+            return False
 
-        return added_count
+        safe_copy(working_path, output_path)
+        outputs[name] = output
+        userdata.set('outputs', outputs)
+        set_kodi_string(OUTPUT_CHANGED_KEY, '1')
+        log.debug('Output changed: {} ({} bytes)'.format(output_path, size))
+        return True
 
     def playlists(self, refresh=True):
         playlist_path = os.path.join(self.output_path, PLAYLIST_FILE_NAME)
         working_path = os.path.join(self.working_path, PLAYLIST_FILE_NAME)
+        playlist_path_tmp = os.path.join(self.working_path, PLAYLIST_FILE_NAME+'_tmp')
 
         if not refresh and xbmcvfs.exists(playlist_path) and xbmcvfs.exists(working_path):
             return working_path
 
         start_time = time.time()
         database.connect()
+        fetched = None
 
         try:
             progress = gui.progressbg() if self.forced else None
@@ -394,26 +842,57 @@ class Merger(object):
             Playlist.update({Playlist.results: []}).where(Playlist.enabled == False).execute()
             Channel.delete().where(Channel.custom == False, Channel.playlist.not_in(playlists)).execute()
 
+            sources = [x for x in playlists if x.source_type != Playlist.TYPE_CUSTOM]
+            hide_groups = settings.get('hide_groups', '')
+            states = dict((id(x), SourceState.for_source(x, self._playlist_config(x, hide_groups))) for x in sources)
+            SourceState.clean(Playlist, sources)
+
+            fetched = self._fetch_sources(sources, METHOD_PLAYLIST, states)
+
             for count, playlist in enumerate(playlists):
                 count += 1
 
                 if progress: progress.update(int(count*(100/len(playlists))), 'Merging Playlist ({}/{})'.format(count, len(playlists)), _(playlist.label, _bold=True))
 
-                playlist_start = time.time()
+                playlist_start = time.time() - (self._fetched(fetched, playlist) or [0, 0, 0])[2]
+                file_path = self.tmp_file
+                unchanged = False
+                ingest_rate = None
 
                 error = None
                 try:
                     log.debug('Processing: {}'.format(playlist.path))
 
                     if playlist.source_type != Playlist.TYPE_CUSTOM:
-                        self._process_source(playlist, METHOD_PLAYLIST, self.tmp_file)
-
-                        with database.db.atomic() as transaction:
-                            try:
-                                added = self._process_playlist(playlist, self.tmp_file)
-                            except:
-                                transaction.rollback()
-                                raise
+                        state = states[id(playlist)]
+                        added = None
+
+                        try:
+                            file_path = self._get_source(playlist, METHOD_PLAYLIST, fetched, state)
+                        except SourceUnchanged:
+                            added = self._unchanged_playlist(playlist, state)
+                            if added is None:
+                                log.debug('Previous channels missing. Re-fetching: {}'.format(playlist.path))
+                                state.reset()
+                                file_path = self._get_source(playlist, METHOD_PLAYLIST, None, state)
+                            else:
+                                unchanged = True
+                                # identical content can still come with new validators
+                                state.commit(**state.data)
+
+                        if added is None:
+                            epgs_index, extgroups_index = len(self._playlist_epgs), len(self._extgroups)
+
+                            ingest_start = time.time()
+                            with database.db.atomic() as transaction:
+                                try:
+                                    added = self._process_playlist(playlist, file_path)
+                                except:
+                                    transaction.rollback()
+                                    raise
+                            ingest_rate = added / max(time.time() - ingest_start, 0.001)
+
+                            state.commit(count=added, epgs=self._playlist_epgs[epgs_index:], extgroups=self._extgroups[extgroups_index:])
                     else:
                         added = len(playlist.channels)
                 except AddonError as e:
@@ -425,7 +904,11 @@ class Merger(object):
                     error = e
                     log.exception(e)
                 else:
-                    playlist.results.insert(0, [int(time.time()), Playlist.OK, '{} Channels ({:.2f}s)'.format(added, time.time() - playlist_start)])
+                    if ingest_rate:
+                        timing = '{:.2f}s - {:.0f} ch/s'.format(time.time() - playlist_start, ingest_rate)
+                    else:
+                        timing = '{:.2f}s'.format(time.time() - playlist_start)
+                    playlist.results.insert(0, [int(time.time()), Playlist.OK, '{} Channels{} ({})'.format(added, ' - Unchanged' if unchanged else '', timing)])
                     error = None
 
                 if error:
@@ -435,7 +918,8 @@ class Merger(object):
                     else:
                         playlist.results.insert(0, result)
 
-                remove_file(self.tmp_file)
+                remove_file(file_path)
+                if fetched: fetched.done(playlist)
 
                 playlist.results = playlist.results[:3]
                 playlist.save()
@@ -444,7 +928,8 @@ class Merger(object):
             starting_ch_no = settings.getInt('start_ch_no', 1)
             groups_disabled = settings.getBool('disable_groups', False)
 
-            with codecs.open(working_path, 'w', encoding='utf8') as outfile:
+            hashed = HashedWriter(FileIO(playlist_path_tmp, 'wb'))
+            with codecs.getwriter('utf8')(hashed) as outfile:
                 outfile.write(u'#EXTM3U\n')
 
                 groups = []
@@ -504,12 +989,16 @@ class Merger(object):
                 outfile.write(u'\n')
 
             log.debug('Wrote {} Channels'.format(count))
+            remove_file(working_path)
+            shutil.move(playlist_path_tmp, working_path)
             Playlist.after_merge()
-            safe_copy(working_path, playlist_path)
+            self._publish(working_path, playlist_path, hashed.hexdigest())
         finally:
             database.close()
             if progress: progress.close()
             remove_file(self.tmp_file)
+            remove_file(playlist_path_tmp)
+            if fetched: fetched.close()
 
         log.debug('Playlist Merge Time: {0:.2f}'.format(time.time() - start_time))
 
@@ -525,6 +1014,7 @@ class Merger(object):
 
         start_time = time.time()
         database.connect()
+        fetched = None
 
         try:
             progress = gui.progressbg() if self.forced else None
@@ -545,7 +1035,25 @@ class Merger(object):
                         epgs.append(epg)
                         epg_urls.append(url.lower())
 
-            with FileIO(epg_path_tmp, 'wb') as _out:
+            # streamed sources go straight from the response into the merged file
+            stream_epgs = settings.getBool('stream_epgs', False)
+            streamed = set(id(x) for x in epgs if stream_epgs and self._can_stream(x))
+
+            past_hours = settings.getInt('epg_past_hours', 0)
+            future_days = settings.getInt('epg_future_days', 0)
+            min_stop = int(time.time() - past_hours*3600) if past_hours > 0 else None
+            max_start = int(time.time() + future_days*86400) if future_days > 0 else None
+            strip_elements = [x.strip() for x in settings.get('epg_strip_elements', '').split(';') if x.strip()]
+
+            epg_ids_hash = hash_6(sorted(x for x in epg_ids if x)) if epg_ids is not None else None
+            config = [epg_ids_hash, past_hours, future_days, strip_elements]
+            states = dict((id(x), SourceState.for_source(x, hash_6([x.path, x.archive_type, id(x) in streamed] + config))) for x in epgs)
+            SourceState.clean(EPG, epgs)
+            to_commit = []
+
+            fetched = self._fetch_sources([x for x in epgs if id(x) not in streamed], METHOD_EPG, states)
+
+            with HashedWriter(FileIO(epg_path_tmp, 'wb')) as _out:
                 _out.write(b'<?xml version="1.0" encoding="UTF-8"?><tv>')
 
                 for count, epg in enumerate(epgs):
@@ -554,20 +1062,48 @@ class Merger(object):
                     if progress: progress.update(int(count*(100/len(epgs))), 'Merging EPG ({}/{})'.format(count, len(epgs)), _(epg.label, _bold=True))
 
                     file_index = _out.tell()
+                    file_path = self.tmp_file
 
-                    epg_start = time.time()
+                    epg_start = time.time() - (self._fetched(fetched, epg) or [0, 0, 0])[2]
+                    state = states[id(epg)]
                     try:
                         log.debug('Processing: {}'.format(epg.path))
-                        self._process_source(epg, METHOD_EPG, self.tmp_file)
-                        with FileIO(self.tmp_file, 'rb') as _in:
-                            parser = XMLParser(_out, epg_ids)
-                            parser.parse(_in, epg)
+                        epg_count = None
+                        unchanged = False
+
+                        try:
+                            reader, _in, file_path = self._open_epg(epg, fetched, state, id(epg) in streamed)
+                        except SourceUnchanged:
+                            if copy_partial_data(working_path, _out, state.data.get('start_index', 0), state.data.get('end_index', 0)):
+                                epg.start_index = file_index
+                                epg.end_index = _out.tell()
+                                epg_count = state.data.get('count')
+                                unchanged = True
+                            else:
+                                log.debug('Failed to load unchanged XML data. Re-fetching: {}'.format(epg.path))
+                                _seek_file(_out, file_index)
+                                state.reset()
+                                reader, _in, file_path = self._open_epg(epg, None, state, id(epg) in streamed)
+
+                        if epg_count is None:
+                            try:
+                                parser = XMLParser(_out, epg_ids, min_stop=min_stop, max_start=max_start, strip_elements=strip_elements)
+                                parser.parse(_in, epg)
+                            finally:
+                                _in.close()
+                                if reader: reader.close()
+
+                            if reader:
+                                state.content_hash = reader.md5.hexdigest()
+                            epg_count = parser.epg_count()
                     except Exception as e:
                         log.exception(e)
                         result = [int(time.time()), EPG.ERROR, str(e)]
                     else:
-                        result = [int(time.time()), EPG.OK, '{} ({:.2f}s)'.format(parser.epg_count(), time.time() - epg_start)]
+                        result = [int(time.time()), EPG.OK, '{}{} ({:.2f}s)'.format(epg_count, ' - Unchanged' if unchanged else '', time.time() - epg_start)]
                         epg.results.insert(0, result)
+                        # only valid once the new epg file is in place
+                        to_commit.append([state, {'start_index': epg.start_index, 'end_index': epg.end_index, 'count': epg_count}])
 
                     if result[1] == EPG.ERROR:
                         _seek_file(_out, file_index)
@@ -591,19 +1127,24 @@ class Merger(object):
                     epg.results = epg.results[:3]
                     if epg.id:
                         epg.save()
-                    remove_file(self.tmp_file)
+                    remove_file(file_path)
+                    if fetched: fetched.done(epg)
 
                 _out.write(b'</tv>')
 
             remove_file(working_path)
             shutil.move(epg_path_tmp, working_path)
 
-            safe_copy(working_path, epg_path)
+            for state, data in to_commit:
+                state.commit(**data)
+
+            self._publish(working_path, epg_path, _out.hexdigest())
         finally:
             database.close()
             if progress: progress.close()
             remove_file(self.tmp_file)
             remove_file(epg_path_tmp)
+            if fetched: fetched.close()
 
         log.debug('EPG Merge Time: {0:.2f}'.format(time.time() - start_time))
 
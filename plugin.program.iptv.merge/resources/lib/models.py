@@ -38,6 +38,40 @@ def parse_attribs(line):
         line = line[match.end():]
     return attribs, line
 
+def parse_extinf(extinf, name=None):
+    attribs, extinf = parse_attribs(extinf)
+    chunks = extinf.split(',', 1)
+    if len(chunks) == 2:
+        name = chunks[1].strip() or name
+
+    radio = attribs.pop('radio', 'false').lower() == 'true'
+
+    try:
+        chno = int(attribs.pop('tvg-chno'))
+    except:
+        chno = None
+
+    groups = attribs.pop('group-title', '').strip()
+    groups = groups.split(';') if groups else None
+
+    epg_id = attribs.pop('tvg-id', None) or attribs.get('tvg-name') or name
+    logo = attribs.pop('tvg-logo', None)
+
+    return name, radio, chno, groups, epg_id, logo, attribs
+
+_json1 = []
+def _has_json1():
+    if not _json1:
+        try:
+            database.db.execute_sql("SELECT json('{}')")
+        except peewee.OperationalError:
+            log.debug('SQLite json1 not available. Using fallback channel overrides')
+            _json1.append(False)
+        else:
+            _json1.append(True)
+
+    return _json1[0]
+
 @plugin.route()
 def play_channel(slug, **kwargs):
     channel = Channel.get_by_id(slug)
@@ -540,16 +574,18 @@ class Channel(database.Model):
 
     @classmethod
     def epg_ids(cls):
-        query = cls.select(cls.epg_id).where(cls.visible == True).distinct()
+        columns = cls.resolved_columns()
+        query = cls.resolved_select(columns['epg_id'].alias('epg_id')).where(columns['visible'] == True).distinct()
         with cls.merged():
             return [x[0] for x in query.tuples()]
 
     @classmethod
     def playlist_list(cls, radio=None):
-        query = cls.select(cls).join(Playlist).where(cls.visible == True).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+        columns = cls.resolved_columns()
+        query = cls.resolved_select().join_from(cls, Playlist).where(columns['visible'] == True).order_by(columns['chno'].asc(nulls='LAST'), Playlist.order, cls.order)
 
         if radio is not None:
-            query = query.where(cls.radio == radio)
+            query = query.where(columns['radio'] == radio)
 
         with cls.merged():
             for channel in query:
@@ -557,10 +593,11 @@ class Channel(database.Model):
 
     @classmethod
     def channel_list(cls, radio=None, playlist_id=0, page=1, page_size=0, search=None):
-        query = cls.select(cls).join(Playlist).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+        columns = cls.resolved_columns()
+        query = cls.resolved_select().join_from(cls, Playlist).order_by(columns['chno'].asc(nulls='LAST'), Playlist.order, cls.order)
 
         if radio is not None:
-            query = query.where(cls.radio == radio)
+            query = query.where(columns['radio'] == radio)
 
         if playlist_id is None:
             query = query.where(cls.playlist_id.is_null())
@@ -568,7 +605,7 @@ class Channel(database.Model):
             query = query.where(cls.playlist_id == playlist_id)
 
         if search:
-            query = query.where(cls.name.concat(' ').concat(cls.url) ** '%{}%'.format(search))
+            query = query.where(columns['name'].concat(' ').concat(cls.url) ** '%{}%'.format(search))
 
         if page_size > 0:
             query = query.paginate(page, page_size)
@@ -577,9 +614,46 @@ class Channel(database.Model):
             for channel in query.prefetch(Playlist):
                 yield(channel)
 
+    @classmethod
+    def resolved_columns(cls):
+        columns = {field.name: field for field in cls._meta.sorted_fields}
+        if not _has_json1():
+            return columns
+
+        # resolve overrides in the query instead of writing them to the channel table
+        for field in cls._meta.sorted_fields:
+            if field.name in ('slug', 'playlist', 'custom', 'modified'):
+                continue
+
+            if field.name in ('attribs', 'properties'):
+                columns[field.name] = peewee.fn.json_patch(field, peewee.fn.COALESCE(getattr(Override, field.name), '{}'))
+            else:
+                path = '$.{}'.format(field.name)
+                columns[field.name] = peewee.Case(None, [(peewee.fn.json_type(Override.fields, path).is_null(False), peewee.fn.json_extract(Override.fields, path))], field)
+
+        columns['modified'] = Override.slug.is_null(False) & (cls.custom == False)
+        return columns
+
+    @classmethod
+    def resolved_select(cls, *selection):
+        columns = cls.resolved_columns()
+        if not selection:
+            selection = [columns[field.name].alias(field.name) for field in cls._meta.sorted_fields]
+
+        query = cls.select(*selection)
+        if _has_json1():
+            query = query.join_from(cls, Override, peewee.JOIN.LEFT_OUTER, on=(cls.slug == Override.slug))
+
+        return query
+
     @classmethod
     @contextmanager
     def merged(cls):
+        # fallback for sqlite builds without json1, overrides are resolved by resolved_select otherwise
+        if _has_json1():
+            yield
+            return
+
         channel_updates = set()
 
         for override in Override.select(Override, Channel).join(Channel, on=(Channel.slug == Override.slug), attr='channel'):
@@ -623,27 +697,9 @@ class Channel(database.Model):
         )
 
     def load_extinf(self, extinf):
-        attribs, extinf = parse_attribs(extinf)
-        chunks = extinf.split(',', 1)
-        if len(chunks) == 2:
-            name = chunks[1].strip()
-            if name:
-                self.name = name
-
-        self.radio = attribs.pop('radio', 'false').lower() == 'true'
-
-        try:
-            self.chno = int(attribs.pop('tvg-chno'))
-        except:
-            self.chno = None
-
-        groups = attribs.pop('group-title', '').strip()
+        self.name, self.radio, self.chno, groups, self.epg_id, self.logo, self.attribs = parse_extinf(extinf, self.name)
         if groups:
-            self.groups = groups.split(';')
-
-        self.epg_id = attribs.pop('tvg-id', None) or attribs.get('tvg-name') or self.name
-        self.logo = attribs.pop('tvg-logo', None)
-        self.attribs = attribs
+            self.groups = groups
 
 class Override(database.Model):
     playlist = peewee.ForeignKeyField(Playlist, backref="overrides", on_delete='cascade')
@@ -739,4 +795,57 @@ class Override(database.Model):
     def clean(cls):
         cls.delete().where((cls.fields=={}) & (cls.attribs=={}) & (cls.properties=={}) & (cls.headers=={})).execute()
 
-database.tables.extend([Playlist, EPG, Channel, Override])
+class SourceState(database.Model):
+    key = peewee.CharField(primary_key=True)
+    config = peewee.CharField(null=True)
+    etag = peewee.CharField(null=True)
+    last_modified = peewee.CharField(null=True)
+    content_hash = peewee.CharField(null=True)
+    data = database.JSONField(default=dict)
+
+    @classmethod
+    def get_key(cls, source):
+        return '{}.{}'.format(source.__class__.__name__.lower(), source.path.strip().lower())
+
+    @classmethod
+    def for_source(cls, source, config):
+        key = cls.get_key(source)
+
+        try:
+            state = cls.get_by_id(key)
+        except cls.DoesNotExist:
+            state = cls(key=key)
+
+        # options that change the parsed result have changed, start fresh
+        if state.config != config:
+            state.reset()
+            state.config = config
+
+        return state
+
+    def reset(self):
+        self.etag = self.last_modified = self.content_hash = None
+        self.data = {}
+
+    def conditional_headers(self):
+        headers = {}
+        if not self.content_hash:
+            return headers
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+    def commit(self, **data):
+        self.data = data
+        SourceState.set(key=self.key, config=self.config, etag=self.etag, last_modified=self.last_modified, content_hash=self.content_hash, data=self.data)
+
+    @classmethod
+    def clean(cls, source_cls, sources):
+        keys = [cls.get_key(x) for x in sources]
+        cls.delete().where(cls.key.startswith(source_cls.__name__.lower()+'.'), cls.key.not_in(keys)).execute()
+
+database.tables.extend([Playlist, EPG, Channel, Override, SourceState])
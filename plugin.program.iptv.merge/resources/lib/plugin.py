@@ -51,7 +51,7 @@ def home(**kwargs):
         path  = plugin.url_for(merge),
     )
 
-    if settings.getBool('http_api'):
+    if settings.getBool('http_api') and userdata.get('_playlist_url'):
         folder.add_item(
             label = "HTTP API Running",
             path = plugin.url_for(http_info),
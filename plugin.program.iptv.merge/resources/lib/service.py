@@ -4,20 +4,34 @@ from kodi_six import xbmc, xbmcvfs, xbmcaddon
 from six.moves.urllib.parse import unquote_plus
 
 
-from slyguy import router, settings, gui, userdata
+from slyguy import router, settings, gui, userdata, signals
+from slyguy.monitor import monitor
 from slyguy.util import get_kodi_string, set_kodi_string, kodi_rpc
 from slyguy.log import log
 
 from .constants import *
 from .merger import check_merge_required
+from .http_api import Server
 
 
 def start():
-    monitor = xbmc.Monitor()
     restart_queued = False
 
     set_kodi_string('_iptv_merge_force_run')
 
+    # serves the last merged files. never triggers a merge
+    server = Server()
+
+    @signals.on(signals.ON_SETTINGS_CHANGE)
+    def sync_server():
+        try:
+            server.sync()
+        except Exception as e:
+            log.error('Failed to start HTTP API')
+            log.exception(e)
+
+    sync_server()
+
     delay = settings.getInt('service_delay', 0)
     if delay:
         log.debug('Service delay: {}s'.format(delay))
@@ -34,12 +48,16 @@ def start():
 
         if forced or merge_required:
             set_kodi_string('_iptv_merge_force_run', '1')
+            set_kodi_string(OUTPUT_CHANGED_KEY)
 
             url = router.url_for('run_merge', forced=int(forced))
             _, files = xbmcvfs.listdir(url)
             result, _ = int(files[0][0]), unquote_plus(files[0][1:])
-            if result:
+            if result and get_kodi_string(OUTPUT_CHANGED_KEY):
                 restart_queued = True
+                server.refresh()
+            elif result:
+                log.info('Merge complete. Playlist and EPG unchanged. Skipping IPTV Simple reload')
             set_kodi_string('_iptv_merge_force_run')
 
         if not restart_queued:
@@ -81,3 +99,5 @@ def start():
             if forced:
                 progress.update(100)
                 progress.close()
+
+    server.stop()
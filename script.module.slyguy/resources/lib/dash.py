@@ -0,0 +1,743 @@
+import re
+from collections import OrderedDict
+from xml.parsers import expat
+
+import arrow
+from six.moves.urllib.parse import urljoin
+
+from slyguy.log import get_logger
+from slyguy.util import lang_allowed, fix_language, replace_kids
+
+from .language import _
+
+log = get_logger('proxy')
+
+H264 = 'H.264'
+H265 = 'H.265'
+VP9 = 'VP9'
+HDR = 'H.265 HDR'
+DOLBY_VISION = 'H.265 Dolby Vision'
+
+CODECS = [
+    ['mp4v', 'MPEG-4'],
+    ['mp4s', 'MPEG-4'],
+    ['avc', H264],
+    ['hvc', H265],
+    ['hev', H265],
+    ['vp0?9', VP9],
+    ['av0?1', 'AV1'],
+    ['hdr', HDR],
+    ['dvh', DOLBY_VISION],
+    ['vp0?9\.0?2', 'VP9 HDR'],
+    ['av0?1.*09\.16\.09\.0', 'AV1 HDR'],
+]
+CODECS = [[re.compile(x[0], re.IGNORECASE), x[1]] for x in CODECS]
+
+def codec_rank(_codecs):
+    highest = -1
+
+    for codec in _codecs:
+        for rank, _codec in enumerate(CODECS):
+            if _codec[0].search(codec):
+                if not highest or rank > highest:
+                    highest = rank
+
+    return highest
+
+# Only these elements are kept as nodes. Everything else (SegmentTimeline, S, SegmentBase etc)
+# is serialized to strings as it is parsed
+NODE_TAGS = ('MPD', 'Period', 'AdaptationSet', 'Representation', 'BaseURL', 'Location', 'SegmentTemplate',
+    'ContentProtection', 'cenc:pssh', 'Role', 'Accessibility', 'SupplementalProperty', 'AudioChannelConfiguration')
+TEXT_TAGS = ('BaseURL', 'Location', 'cenc:pssh')
+URL_TAGS = ('SegmentTemplate', 'SegmentURL')
+
+WIDEVINE_SCHEME = 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed'
+
+class DashFallback(Exception):
+    pass
+
+def escape(data):
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+def iter_nodes(nodes, tag):
+    for node in nodes:
+        if not isinstance(node, Node):
+            continue
+
+        if node.tag == tag:
+            yield node
+
+        for elem in node.iter(tag):
+            yield elem
+
+class Node(object):
+    __slots__ = ('tag', 'attrs', 'children', 'text', 'parent')
+
+    def __init__(self, tag, attrs=None, text=None):
+        self.tag = tag
+        self.attrs = attrs if attrs is not None else OrderedDict()
+        self.children = []
+        self.text = text
+        self.parent = None
+
+    def append(self, child):
+        if isinstance(child, Node):
+            child.parent = self
+        self.children.append(child)
+
+    def remove(self, child):
+        self.children.remove(child)
+        child.parent = None
+
+    def get(self, key):
+        return self.attrs.get(key, '')
+
+    def clone(self):
+        node = Node(self.tag, OrderedDict(self.attrs), self.text)
+        for child in self.children:
+            node.append(child.clone() if isinstance(child, Node) else child)
+        return node
+
+    def iter(self, tag):
+        return iter_nodes(self.children, tag)
+
+    def render(self, parts):
+        parts.append(u'<' + self.tag)
+        for key in self.attrs:
+            parts.append(u' {}="{}"'.format(key, escape(self.attrs[key])))
+
+        if self.text is None and not self.children:
+            parts.append(u'/>')
+            return
+
+        parts.append(u'>')
+        if self.text is not None:
+            parts.append(escape(self.text))
+
+        for child in self.children:
+            if isinstance(child, Node):
+                child.render(parts)
+            else:
+                parts.append(child)
+
+        parts.append(u'</{}>'.format(self.tag))
+
+class Frame(object):
+    __slots__ = ('tag', 'node', 'out', 'pending', 'base_url', 'templates')
+
+    def __init__(self, tag, node, out):
+        self.tag = tag
+        self.node = node
+        self.out = out
+        self.pending = False
+        self.base_url = None
+        self.templates = []
+
+class DashRewriter(object):
+    """Rewrites a MPD in a single expat pass.
+
+    Unlike the minidom parser, only the elements the fixes need to inspect or move are kept as nodes.
+    Everything else (mostly SegmentTimelines) is turned straight back into strings as it is parsed.
+    Raises DashFallback for layouts it doesn't handle so the caller can use the minidom parser instead.
+    """
+    def __init__(self, handler, url):
+        self._handler = handler
+        self._session = handler._session
+        self._proxy_path = handler.proxy_path
+        self._url = url
+
+        self._root = None
+        self._stack = []
+        self._periods = []
+        self._all_streams = OrderedDict()
+        self._video_sets = []
+        self._audio_sets = []
+        self._adap_parent = None
+        self._locations = []
+        self._prolog = []
+        self._double_templates = []
+        # only live manifests whose output doesn't depend on the current time can be reused
+        self.cacheable = False
+
+    def rewrite(self, data):
+        parser = expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._text
+        parser.CommentHandler = self._comment
+        parser.ProcessingInstructionHandler = self._pi
+
+        try:
+            parser.Parse(data, True)
+        except expat.ExpatError as e:
+            raise DashFallback('Failed to parse dash: {}'.format(e))
+
+        if self._root is None:
+            raise DashFallback('No MPD element found')
+
+        self._finish()
+
+        parts = [u'<?xml version="1.0" encoding="utf-8"?>'] + self._prolog
+        self._root.render(parts)
+
+        if self._locations:
+            self._session['manifest'] = self._locations[-1]
+        else:
+            # by default, wipe out the manifest so not parsed again
+            self._session['manifest'] = None
+
+        return u''.join(parts).encode('utf8')
+
+    ## Parsing ##
+    def _write(self, data):
+        frame = self._stack[-1]
+        if frame.pending:
+            frame.out.append(u'>')
+            frame.pending = False
+        frame.out.append(data)
+
+    def _start(self, tag, attribs):
+        attrs = OrderedDict(zip(attribs[::2], attribs[1::2]))
+
+        if not self._stack:
+            if tag != 'MPD':
+                raise DashFallback('Root element is not MPD')
+
+            self._root = Node(tag, attrs)
+            self.cacheable = attrs.get('type') == 'dynamic'
+            self._fix_mpd(self._root)
+            self._stack.append(Frame(tag, self._root, self._root.children))
+            return
+
+        parent = self._stack[-1]
+        if tag in URL_TAGS:
+            parent_template = self._fix_url_attribs(tag, attrs)
+
+        if tag not in NODE_TAGS:
+            self._write(u'<' + tag + u''.join(u' {}="{}"'.format(key, escape(attrs[key])) for key in attrs))
+            frame = Frame(tag, None, parent.out)
+            frame.pending = True
+            self._stack.append(frame)
+            return
+
+        node = Node(tag, attrs, u'' if tag in TEXT_TAGS else None)
+
+        if tag == 'Period':
+            self._periods.append(node)
+            self._all_streams[len(self._periods)-1] = []
+
+        elif tag == 'AdaptationSet':
+            if parent.tag != 'Period':
+                raise DashFallback('AdaptationSet outside of Period')
+
+        elif tag == 'Representation':
+            if parent.tag != 'AdaptationSet':
+                raise DashFallback('Representation outside of AdaptationSet')
+
+        elif tag == 'SegmentTemplate':
+            if parent_template is not None:
+                self._double_templates.append([node, parent_template])
+            parent.templates.append(node)
+
+        if tag != 'AdaptationSet':
+            # adaptation sets are re-added to their parent once sorted
+            if parent.node is None:
+                raise DashFallback('{} inside non-node element {}'.format(tag, parent.tag))
+            parent.node.append(node)
+        else:
+            node.parent = parent.node
+
+        self._stack.append(Frame(tag, node, node.children))
+
+    def _end(self, tag):
+        frame = self._stack.pop()
+
+        if frame.node is None:
+            frame.out.append(u'/>' if frame.pending else u'</{}>'.format(tag))
+            return
+
+        node = frame.node
+        if tag == 'BaseURL':
+            self._fix_base_url(node)
+        elif tag == 'Location':
+            self._fix_location(node)
+        elif tag == 'AdaptationSet':
+            self._process_adap_set(node)
+
+    def _text(self, data):
+        if not self._stack:
+            return
+
+        frame = self._stack[-1]
+        if frame.node is not None and frame.node.text is not None:
+            frame.node.text += data
+        else:
+            self._write(escape(data))
+
+    def _comment(self, data):
+        if self._stack:
+            self._write(u'<!--{}-->'.format(data))
+        elif self._root is None:
+            self._prolog.append(u'<!--{}-->'.format(data))
+
+    def _pi(self, target, data):
+        if self._stack:
+            self._write(u'<?{} {}?>'.format(target, data))
+        elif self._root is None:
+            self._prolog.append(u'<?{} {}?>'.format(target, data))
+
+    ## Fixes applied while parsing ##
+    def _fix_mpd(self, mpd):
+        ## Remove publishTime PR: https://github.com/xbmc/inputstream.adaptive/pull/564
+        if mpd.attrs.pop('publishTime', None) is not None:
+            log.debug('Dash Fix: publishTime removed')
+
+        ## Fix mpd overalseconds bug issue: https://github.com/xbmc/inputstream.adaptive/issues/731 / https://github.com/xbmc/inputstream.adaptive/pull/881
+        if mpd.get('type') == 'dynamic' and 'timeShiftBufferDepth' not in mpd.attrs and 'mediaPresentationDuration' not in mpd.attrs:
+            buffer_seconds = (arrow.now() - arrow.get(mpd.get('availabilityStartTime'))).total_seconds()
+            mpd.attrs['mediaPresentationDuration'] = 'PT{}S'.format(buffer_seconds)
+            self.cacheable = False
+            log.debug('Dash Fix: {}S mediaPresentationDuration added'.format(buffer_seconds))
+
+    def _fix_base_url(self, node):
+        parent = self._stack[-1]
+        if parent.base_url is not None:
+            log.debug('Non-1st BaseURL removed: {}'.format(node.text))
+            parent.node.remove(node)
+            return
+
+        url = node.text
+        if url.startswith('/'):
+            url = urljoin(self._url, url)
+
+        if '://' in url:
+            node.text = self._proxy_path + url
+
+        parent.base_url = node
+
+    def _fix_location(self, node):
+        url = node.text
+        if '://' not in url:
+            url = urljoin(self._url, url)
+
+        node.text = self._proxy_path + url
+        # update our manifest url to the location url
+        self._locations.append(url)
+
+    def _fix_url_attribs(self, tag, attrs):
+        parent_template = None
+
+        for attrib in ('initialization', 'media'):
+            if attrib not in attrs:
+                continue
+
+            url = attrs[attrib]
+            if '://' in url:
+                attrs[attrib] = self._proxy_path + url
+                continue
+
+            ## Fixed with https://github.com/xbmc/inputstream.adaptive/pull/606
+            for frame in reversed(self._stack):
+                if frame.base_url is not None:
+                    if not frame.base_url.text.endswith('/'):
+                        frame.base_url.text += '/'
+                        log.debug('Dash Fix: base_url / fixed')
+                    break
+
+            # Fixed with https://github.com/xbmc/inputstream.adaptive/pull/668
+            # our siblings or our parents siblings
+            for frame in self._stack[-2:][::-1]:
+                if frame.templates:
+                    parent_template = frame.templates[0]
+                    break
+
+        ## Remove presentationTimeOffset PR: https://github.com/xbmc/inputstream.adaptive/pull/564/
+        if attrs.pop('presentationTimeOffset', None) is not None:
+            log.debug('Dash Fix: presentationTimeOffset removed')
+
+        if tag != 'SegmentTemplate' and parent_template is not None:
+            # SegmentURLs are not kept as nodes so merge now
+            self._merge_template(attrs, parent_template)
+            return None
+
+        return parent_template
+
+    def _merge_template(self, attrs, parent_template):
+        if parent_template.parent is None:
+            return
+
+        for key in parent_template.attrs:
+            if key not in attrs:
+                attrs[key] = parent_template.attrs[key]
+
+        parent_template.parent.remove(parent_template)
+        log.debug('Dash Fix: Double SegmentTemplate removed')
+
+    def _process_adap_set(self, adap_set):
+        session = self._session
+        remove_framerate = session.get('remove_framerate', False)
+        h265_enabled = session.get('h265', False)
+        vp9_enabled = session.get('vp9', False)
+        av1_enabled = session.get('av1', False)
+        hdr_enabled = session.get('hdr10', False)
+        dolby_vision_enabled = session.get('dolby_vision', False)
+        atmos_enabled = session.get('dolby_atmos', False)
+        ac3_enabled = session.get('ac3', False)
+        ec3_enabled = session.get('ec3', False)
+        max_width = session.get('max_width') or float('inf')
+        max_height = session.get('max_height') or float('inf')
+        max_channels = session.get('max_channels') or 0
+
+        adap_parent = adap_set.parent
+        self._adap_parent = adap_parent
+
+        streams = [x for x in adap_set.children if isinstance(x, Node) and x.tag == 'Representation']
+        others = [x for x in adap_set.children if x not in streams]
+        kept = []
+
+        highest_bandwidth = 0
+        is_video = False
+        is_trick = False
+
+        for index, stream in enumerate(streams):
+            attribs = OrderedDict(adap_set.attrs)
+            attribs.update(stream.attrs)
+
+            if remove_framerate:
+                adap_set.attrs.pop('frameRate', None)
+                stream.attrs.pop('frameRate', None)
+
+            bandwidth = 0
+            if 'bandwidth' in attribs:
+                bandwidth = int(attribs['bandwidth'])
+
+            if 'maxPlayoutRate' in attribs:
+                is_trick = True
+
+            if 'audio' in attribs.get('mimeType', ''):
+                is_atmos = False
+                atmos_channels = None
+                codecs = attribs.get('codecs', '')
+                channels = 0
+
+                for supplem in stream.iter('AudioChannelConfiguration'):
+                    if 'audio_channel_configuration' in supplem.get('schemeIdUri'):
+                        try:
+                            channels = int(supplem.get('value').replace('F801','6').replace('FE01','8'))
+                        except:
+                            channels = 0
+
+                for supplem in stream.iter('SupplementalProperty'):
+                    if supplem.get('value') == 'JOC':
+                        is_atmos = True
+                    if 'EC3_ExtensionComplexityIndex' in supplem.get('schemeIdUri'):
+                        atmos_channels = supplem.get('value')
+
+                if (not atmos_enabled and is_atmos) or (not ac3_enabled and codecs == 'ac-3') or (not ec3_enabled and codecs == 'ec-3') or (max_channels and channels > max_channels):
+                    continue
+
+                if is_atmos:
+                    new_set = Node(adap_set.tag, OrderedDict(adap_set.attrs))
+                    new_set.parent = adap_parent
+                    for child in others:
+                        new_set.append(child.clone() if isinstance(child, Node) else child)
+
+                    new_set.attrs['name'] = 'ATMOS'
+                    new_set.attrs['id'] = '{}-atmos'.format(attribs.get('id',''))
+                    new_set.attrs['lang'] = _(_.ATMOS, name=attribs.get('lang',''))
+                    new_set.append(stream)
+
+                    if atmos_channels:
+                        for elem in [x for x in stream.children if isinstance(x, Node) and x.tag == 'AudioChannelConfiguration']:
+                            stream.remove(elem)
+
+                        elem = Node('AudioChannelConfiguration')
+                        elem.attrs['schemeIdUri'] = 'urn:mpeg:dash:23003:3:audio_channel_configuration:2011'
+                        elem.attrs['value'] = atmos_channels
+                        stream.append(elem)
+
+                    self._audio_sets.append([bandwidth, new_set, adap_parent])
+                    log.debug('Dash Fix: Atmos representation moved to own adaption set')
+                    continue
+
+            if bandwidth > highest_bandwidth:
+                highest_bandwidth = bandwidth
+
+            if 'video' in attribs.get('mimeType', '') and not is_trick:
+                is_hdr = False
+                for supplem in iter_nodes(others + kept + streams[index+1:], 'SupplementalProperty'):
+                    if supplem.get('schemeIdUri') == 'http://dashif.org/metadata/hdr':
+                        is_hdr = True
+                        break
+
+                is_video = True
+
+                frame_rate = ''
+                if 'frameRate' in attribs:
+                    frame_rate = attribs['frameRate']
+                    try:
+                        if '/' in str(frame_rate):
+                            split = frame_rate.split('/')
+                            frame_rate = float(split[0]) / float(split[1])
+                    except:
+                        frame_rate = ''
+
+                codecs = [x for x in attribs.get('codecs', '').split(',') if x]
+
+                if attribs.get('hdr') == 'true':
+                    is_hdr = True
+
+                if is_hdr:
+                    codecs.append('hdr')
+
+                rank = codec_rank(codecs)
+                codec_string = CODECS[rank][1] if rank >= 0 else ''
+                if 'hdr' in codec_string.lower():
+                    codecs.append('hdr')
+
+                stream_data = {'bandwidth': bandwidth, 'width': int(attribs.get('width','0')), 'height': int(attribs.get('height','0')), 'frame_rate': frame_rate, 'codecs': codecs, 'elem': stream, 'res_ok': True, 'compatible': True}
+                if stream_data['width'] > max_width or stream_data['height'] > max_height:
+                    stream_data['res_ok'] = False
+
+                if not dolby_vision_enabled and codec_string.lower().endswith('dolby vision'):
+                    stream_data['compatible'] = False
+
+                if not hdr_enabled and codec_string.lower().endswith('hdr'):
+                    stream_data['compatible'] = False
+
+                if not h265_enabled and codec_string.lower().startswith('h.265'):
+                    stream_data['compatible'] = False
+
+                if not av1_enabled and codec_string.lower().startswith('av1'):
+                    stream_data['compatible'] = False
+
+                if not vp9_enabled and codec_string.lower().startswith('vp9'):
+                    stream_data['compatible'] = False
+
+                stream_data['codec'] = codec_string
+                self._all_streams[len(self._periods)-1].append(stream_data)
+
+            kept.append(stream)
+
+        ## Make sure Representation are last in adaptionset
+        adap_set.children = []
+        for child in others + kept:
+            adap_set.append(child)
+
+        if is_trick:
+            return
+
+        if is_video:
+            self._video_sets.append([highest_bandwidth, adap_set, adap_parent])
+        else:
+            self._audio_sets.append([highest_bandwidth, adap_set, adap_parent])
+
+    ## Fixes applied once the whole manifest has been read ##
+    def _finish(self):
+        session = self._session
+        subs_forced = session.get('subs_forced', True)
+        subs_non_forced = session.get('subs_non_forced', True)
+        audio_description = session.get('audio_description', True)
+        original_language = session.get('original_language', '')
+        audio_whitelist = [x.strip().lower() for x in session.get('audio_whitelist', '').split(',') if x]
+        subs_whitelist = [x.strip().lower() for x in session.get('subs_whitelist', '').split(',') if x]
+        default_languages = [x.strip().lower() for x in session.get('default_language', '').split(',') if x]
+        default_subtitles = [x.strip().lower() for x in session.get('default_subtitle', '').split(',') if x]
+
+        buckets = OrderedDict()
+        for period_index in self._all_streams:
+            for stream in self._all_streams[period_index]:
+                key = '{}-{}-{}-{}'.format(stream['codec'], stream['height'], stream['width'], stream['frame_rate'])
+                if key not in buckets:
+                    buckets[key] = []
+                buckets[key].append(stream)
+
+        streams = []
+        for key in buckets:
+            streams.append(sorted(buckets[key], key=lambda x: x['bandwidth'])[-1])
+
+        ## Get selected quality
+        selected = self._handler._quality_select(streams)
+        if selected:
+            for period_index in self._all_streams:
+                for stream in sorted(self._all_streams[period_index], key=lambda x: (x == selected, x['compatible'] == selected['compatible'], x['codec'] == selected['codec'], x['bandwidth'] <= selected['bandwidth'], x['bandwidth']))[:-1]:
+                    stream['elem'].parent.remove(stream['elem'])
+
+        self._video_sets.sort(key=lambda x: x[0], reverse=True)
+        self._audio_sets.sort(key=lambda x: x[0], reverse=True)
+
+        for elem in self._video_sets:
+            elem[2].append(elem[1])
+
+        for elem in self._audio_sets:
+            elem[2].append(elem[1])
+
+        def adap_sets():
+            return [x for period in self._periods for x in period.children if isinstance(x, Node) and x.tag == 'AdaptationSet']
+
+        def is_subs(adap_set):
+            return adap_set.get('contentType').lower() == 'text' or adap_set.get('mimeType').lower().startswith('text/')
+
+        def is_audio(adap_set):
+            return adap_set.get('contentType').lower() == 'audio' or adap_set.get('mimeType').lower().startswith('audio/')
+
+        ## Insert subtitles
+        overwrite_subs = session.get('subtitles') or []
+        if overwrite_subs and self._adap_parent is not None:
+            # remove all built-in subs
+            for adap_set in adap_sets():
+                if is_subs(adap_set):
+                    adap_set.parent.remove(adap_set)
+
+            # add our subs
+            for idx, subtitle in enumerate(overwrite_subs):
+                elem = Node('AdaptationSet')
+                elem.attrs['contentType'] = 'text'
+                elem.attrs['mimeType'] = subtitle[0]
+                elem.attrs['lang'] = subtitle[1]
+                elem.attrs['id'] = 'caption_{}'.format(idx)
+
+                if subtitle[4] == 'impaired':
+                    elem.attrs['impaired'] = 'true'
+
+                if subtitle[3] == 'forced':
+                    elem.attrs['forced'] = 'true'
+
+                elem2 = Node('Representation')
+                elem2.attrs['id'] = 'caption_rep_{}'.format(idx)
+
+                if 'ttml' in subtitle[0]:
+                    elem2.attrs['codecs'] = 'ttml'
+
+                url = subtitle[2]
+                if url.startswith('/'):
+                    url = urljoin(self._url, url)
+                if '://' in url:
+                    url = self._proxy_path + url
+
+                elem2.append(Node('BaseURL', text=url))
+                elem.append(elem2)
+                self._adap_parent.append(elem)
+        ##################
+
+        ## Fix up languages
+        subs = []
+        audios = []
+        for adap_set in adap_sets():
+            language = adap_set.get('lang')
+            if not language:
+                continue
+
+            adap_set.attrs['lang'] = fix_language(language)
+
+            if is_audio(adap_set):
+                if adap_set.get('default') == 'true':
+                    default_languages.append(language)
+                    adap_set.attrs.pop('default')
+
+                for elem in list(adap_set.iter('Role')):
+                    if elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'main':
+                        default_languages.append(language)
+                        elem.parent.remove(elem)
+
+                if lang_allowed(language, [original_language]):
+                    adap_set.attrs['original'] = 'true'
+
+                # only remove languages that are not original and not in whitelist or default languages
+                if audio_whitelist and not lang_allowed(language, audio_whitelist + default_languages + [original_language]):
+                    adap_set.parent.remove(adap_set)
+                    log.debug('Removed audio adapt set: {}'.format(adap_set.get('id')))
+                    continue
+
+                is_audio_description = any([elem for elem in adap_set.iter('Accessibility') if elem.get('schemeIdUri') == 'urn:tva:metadata:cs:AudioPurposeCS:2007'])
+                if is_audio_description:
+                    if not audio_description:
+                        log.debug('Removed audio description adapt set: {}'.format(adap_set.get('id')))
+                        adap_set.parent.remove(adap_set)
+                        continue
+                    else:
+                        adap_set.attrs['impaired'] = 'true'
+
+                audios.append([language, adap_set])
+
+            elif is_subs(adap_set):
+                if adap_set.get('default') == 'true':
+                    default_subtitles.append(language)
+                    adap_set.attrs.pop('default')
+
+                for elem in list(adap_set.iter('Role')):
+                    if elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'forced-subtitle':
+                        adap_set.attrs['forced'] = 'true'
+
+                    elif elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'main':
+                        default_subtitles.append(language)
+                        elem.parent.remove(elem)
+
+                forced = adap_set.get('forced') == 'true'
+                if (forced and not subs_forced) or (not forced and not subs_non_forced):
+                    adap_set.parent.remove(adap_set)
+                    log.debug('Removed subs: {}'.format(adap_set.get('id')))
+                    continue
+
+                if lang_allowed(language, [original_language]):
+                    adap_set.attrs['original'] = 'true'
+
+                # only remove subs that are not in whitelist or default subs
+                if subs_whitelist and not lang_allowed(language, subs_whitelist + default_subtitles):
+                    adap_set.parent.remove(adap_set)
+                    log.debug('Removed subtitle adapt set: {}'.format(adap_set.get('id')))
+                    continue
+
+                subs.append([language, adap_set])
+
+        def set_default_laguage(defaults, rows):
+            found = False
+            for default in defaults:
+                default = original_language if default == 'original' else default
+                if not default:
+                    continue
+
+                for row in rows:
+                    if lang_allowed(row[0], [default]):
+                        row[1].attrs['default'] = 'true'
+                        found = True
+
+                if found:
+                    break
+
+        #fallback to original if default languages not found
+        default_languages.append('original')
+        set_default_laguage(default_languages, audios)
+        set_default_laguage(default_subtitles, subs)
+        ################
+
+        ## Merge double SegmentTemplates that are still in use
+        if self._double_templates:
+            templates = list(self._root.iter('SegmentTemplate'))
+            for template, parent_template in self._double_templates:
+                if template in templates and parent_template in templates:
+                    self._merge_template(template.attrs, parent_template)
+        ###############
+
+        ## Remove empty adaption sets
+        for adap_set in adap_sets():
+            if not any(adap_set.iter('Representation')):
+                adap_set.parent.remove(adap_set)
+        #################
+
+        ## Fix of cenc pssh to only contain kids still present
+        protections = list(self._root.iter('ContentProtection'))
+        kids = [elem.get('cenc:default_KID') for elem in protections]
+
+        if kids:
+            for elem in protections:
+                if elem.get('schemeIdUri') == WIDEVINE_SCHEME:
+                    for elem2 in elem.iter('cenc:pssh'):
+                        current_cenc = elem2.text
+                        new_cenc = replace_kids(current_cenc, kids, version0=True)
+                        if current_cenc != new_cenc:
+                            elem2.text = new_cenc
+                            log.debug('Dash Fix: cenc:pssh {} -> {}'.format(current_cenc, new_cenc))
+        ################################################
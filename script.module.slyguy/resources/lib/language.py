@@ -28,5 +28,10 @@ class Language(BaseLanguage):
     ARCH_CHANGED      = 30036
     VIDEO_MENUS       = 30037
     FAST_UPDATES      = 30040
+    ADAPTIVE_CHUNKS   = 30041
+    PREFETCH_SEGMENTS = 30042
+    PROXY_SERVER_TYPE = 30043
+    PROXY_THREADED    = 30044
+    PROXY_WORKER_POOL = 30045
 
 _ = Language()
@@ -0,0 +1,230 @@
+import re
+import threading
+from collections import OrderedDict
+
+from six.moves import queue
+
+from slyguy.log import get_logger
+from slyguy.constants import PREFETCH_WORKERS, PREFETCH_MAX_BYTES, PREFETCH_IDLE_TIMEOUT, REMOVE_OUT_HEADERS
+
+log = get_logger('proxy')
+
+TEMPLATE_PATTERN = re.compile(r'\$(RepresentationID|Number|Time|Bandwidth)(?:%0(\d+)d)?\$')
+TIMELINE_S_PATTERN = re.compile(br'<S\s([^>]*?)/?>')
+TIMELINE_ATTRIB_PATTERN = re.compile(br'(\w+)="(-?\d+)"')
+
+class Segment(object):
+    __slots__ = ('headers', 'content')
+
+    def __init__(self, headers, content):
+        self.headers = headers
+        self.content = content
+
+class SegmentPrefetcher(object):
+    """Fetches the next segments of whatever representation is being played.
+
+    HLS segment urls come from the media playlists. DASH segment urls are predicted from the
+    SegmentTemplate media attributes ($Number$ + 1 or the next SegmentTimeline $Time$).
+    Fetched segments are held in a byte capped LRU and handed out once.
+    """
+    def __init__(self, session, count, max_bytes=PREFETCH_MAX_BYTES, workers=PREFETCH_WORKERS):
+        self._session = session
+        self._count = count
+        self._max_bytes = max_bytes
+        self._max_workers = workers
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._workers = 0
+        self._cache = OrderedDict()
+        self._size = 0
+        self._pending = {}
+
+        self._playlists = {}
+        self._index = {}
+        self._templates = []
+        self._media = None
+        self._times = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.needs_timelines = False
+
+    def set_playlist(self, playlist_url, segments):
+        with self._lock:
+            for url in self._playlists.pop(playlist_url, []):
+                self._index.pop(url, None)
+
+            self._playlists[playlist_url] = segments
+            for i, url in enumerate(segments):
+                self._index[url] = (segments, i)
+
+    def set_templates(self, media):
+        if media == self._media:
+            return
+
+        templates = []
+        for template in media:
+            matches = list(TEMPLATE_PATTERN.finditer(template))
+            if len([m for m in matches if m.group(1) in ('Number', 'Time')]) != 1:
+                continue
+
+            pattern = ''
+            pos = 0
+            for match in matches:
+                pattern += re.escape(template[pos:match.start()])
+                if match.group(1) in ('Number', 'Time'):
+                    pattern += r'(?P<index>\d+)'
+                    field = match.group(1)
+                    width = int(match.group(2) or 0)
+                elif match.group(1) == 'Bandwidth':
+                    pattern += r'\d+'
+                else:
+                    pattern += r'[^/]+?'
+                pos = match.end()
+            pattern += re.escape(template[pos:]) + '$'
+
+            templates.append([re.compile(pattern), field, width])
+
+        with self._lock:
+            self._media = media
+            self._templates = templates
+            self.needs_timelines = any(template[1] == 'Time' for template in templates)
+
+    def set_timelines(self, timelines):
+        times = {}
+        for timeline in timelines:
+            segments = []
+            cur = 0
+            for match in TIMELINE_S_PATTERN.finditer(timeline):
+                attribs = dict(TIMELINE_ATTRIB_PATTERN.findall(match.group(1)))
+                if b't' in attribs:
+                    cur = int(attribs[b't'])
+                duration = int(attribs.get(b'd', 0))
+                if not duration:
+                    break
+
+                for i in range(max(int(attribs.get(b'r', 0)), 0) + 1):
+                    segments.append(cur)
+                    cur += duration
+            segments.append(cur)
+
+            for i in range(len(segments)-1):
+                times[segments[i]] = segments[i+1:i+1+self._count]
+
+        with self._lock:
+            self._times = times
+
+    def _next_urls(self, url):
+        with self._lock:
+            if url in self._index:
+                segments, i = self._index[url]
+                return segments[i+1:i+1+self._count]
+
+            for pattern, field, width in self._templates:
+                match = pattern.search(url)
+                if not match:
+                    continue
+
+                value = int(match.group('index'))
+                if field == 'Number':
+                    values = [value + i for i in range(1, self._count+1)]
+                else:
+                    values = self._times.get(value, [])
+
+                prefix = url[:match.start('index')]
+                suffix = url[match.end('index'):]
+                return [prefix + str(value).zfill(width) + suffix for value in values]
+
+        return []
+
+    def _is_segment(self, url):
+        return url in self._index or any(template[0].search(url) for template in self._templates)
+
+    def get(self, url, timeout=None):
+        with self._lock:
+            event = self._pending.get(url)
+            if not event and url not in self._cache and not self._is_segment(url):
+                return None
+
+        if event:
+            event.wait(timeout)
+
+        with self._lock:
+            segment = self._cache.pop(url, None)
+            if segment:
+                self._size -= len(segment.content)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            log.debug('Prefetch %s: %s (%s hits / %s misses)', 'hit' if segment else 'miss', url, self.hits, self.misses)
+            return segment
+
+    def schedule(self, url, headers):
+        urls = self._next_urls(url)
+        if not urls:
+            return
+
+        headers = dict(headers)
+        with self._lock:
+            for url in urls:
+                if url in self._cache or url in self._pending:
+                    continue
+
+                self._pending[url] = threading.Event()
+                self._queue.put([url, headers])
+
+            if self._workers < self._max_workers and not self._queue.empty():
+                self._workers += 1
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                url, headers = self._queue.get(timeout=PREFETCH_IDLE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._workers -= 1
+                        return
+                continue
+
+            try:
+                segment = self._fetch(url, headers)
+            except Exception as e:
+                log.debug('Prefetch failed: {} ({})'.format(url, e))
+                segment = None
+
+            with self._lock:
+                if segment:
+                    self._add(url, segment)
+                self._pending.pop(url).set()
+
+    def _fetch(self, url, headers):
+        session = self._session.get('session')
+        if not session:
+            return None
+
+        log.debug('PREFETCH OUT: %s', url)
+        response = session.request(method='GET', url=url, headers=headers, allow_redirects=False)
+        if response.status_code != 200 or 'location' in response.headers:
+            return None
+
+        headers = {}
+        for header in response.headers:
+            if header.lower() not in REMOVE_OUT_HEADERS + ['set-cookie', 'content-encoding', 'content-length']:
+                headers[header.lower()] = response.headers[header]
+
+        return Segment(headers, response.content)
+
+    def _add(self, url, segment):
+        if len(segment.content) > self._max_bytes:
+            return
+
+        self._cache[url] = segment
+        self._size += len(segment.content)
+        while self._size > self._max_bytes:
+            self._size -= len(self._cache.popitem(last=False)[1].content)
@@ -8,17 +8,19 @@ import binascii
 
 from xml.dom.minidom import parseString
 from functools import cmp_to_key
+from collections import OrderedDict
 
 import arrow
 from requests import ConnectionError
+from six import PY2
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from six.moves.socketserver import ThreadingMixIn
+from six.moves import queue
 from six.moves.urllib.parse import urlparse, urljoin, unquote_plus, parse_qsl
 from kodi_six import xbmc, xbmcaddon
-from pycaption import detect_format, WebVTTWriter
 
 from slyguy import settings, gui
-from slyguy.log import log
+from slyguy.log import get_logger
 from slyguy.constants import *
 from slyguy.util import check_port, remove_file, get_kodi_string, set_kodi_string, fix_url, run_plugin, lang_allowed, fix_language, replace_kids
 from slyguy.exceptions import Exit
@@ -26,30 +28,18 @@ from slyguy.session import RawSession
 from slyguy.router import add_url_args
 from slyguy.smart_urls import get_dns_rewrites
 
+from .dash import DashRewriter, DashFallback, CODECS, codec_rank
+from .prefetch import SegmentPrefetcher
 from .language import _
 
-H264 = 'H.264'
-H265 = 'H.265'
-VP9 = 'VP9'
-HDR = 'H.265 HDR'
-DOLBY_VISION = 'H.265 Dolby Vision'
-
-CODECS = [
-    ['mp4v', 'MPEG-4'],
-    ['mp4s', 'MPEG-4'],
-    ['avc', H264],
-    ['hvc', H265],
-    ['hev', H265],
-    ['vp0?9', VP9],
-    ['av0?1', 'AV1'],
-    ['hdr', HDR],
-    ['dvh', DOLBY_VISION],
-    ['vp0?9\.0?2', 'VP9 HDR'],
-    ['av0?1.*09\.16\.09\.0', 'AV1 HDR'],
-]
-CODECS = [[re.compile(x[0], re.IGNORECASE), x[1]] for x in CODECS]
+log = get_logger('proxy')
 
 ATTRIBUTELISTPATTERN = re.compile(r'''((?:[^,"']|"[^"]*"|'[^']*')+)''')
+TIMELINE_PATTERN = re.compile(br'(<SegmentTimeline[^>/]*>)(.*?)(</SegmentTimeline>)', re.DOTALL)
+TIMELINE_MARKER = '<?slyguy-timeline {}?>'
+TIMELINE_MARKER_PATTERN = re.compile(br'<\?slyguy-timeline ([0-9]+)\?>')
+PUBLISH_TIME_PATTERN = re.compile(br'\spublishTime="[^"]*"')
+MEDIA_PATTERN = re.compile(br'\smedia="([^"]+)"')
 
 DEFAULT_SESSION_NAME = 'playback'
 PROXY_GLOBAL = {
@@ -65,6 +55,8 @@ def middleware_regex(response, pattern, **kwargs):
         response.stream.content = match.group(1).encode('utf8')
 
 def middleware_convert_sub(response, **kwargs):
+    from pycaption import detect_format, WebVTTWriter
+
     data = response.stream.content.decode('utf8')
     reader = detect_format(data)
     if reader:
@@ -108,17 +100,6 @@ middlewares = {
     MIDDLEWARE_PLUGIN: middleware_plugin,
 }
 
-def codec_rank(_codecs):
-    highest = -1
-
-    for codec in _codecs:
-        for rank, _codec in enumerate(CODECS):
-            if _codec[0].search(codec):
-                if not highest or rank > highest:
-                    highest = rank
-
-    return highest
-
 class RequestHandler(BaseHTTPRequestHandler):
     def __init__(self, request, client_address, server):
         try:
@@ -135,7 +116,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
     def _get_url(self, method):
         self._url = url = self.path.lstrip('/').strip('\\')
-        log.debug('REQUEST IN: {} ({})'.format(url, method))
+        log.debug('REQUEST IN: %s (%s)', url, method)
 
         self.proxy_path = 'http://{}/'.format(self.headers.get('Host'))
 
@@ -164,6 +145,9 @@ class RequestHandler(BaseHTTPRequestHandler):
                 'addon_id': session_addonid,
                 'verify': settings.common_settings.getBool('verify_ssl', True),
                 'timeout': settings.common_settings.getInt('http_timeout', 30),
+                'adaptive_chunks': settings.common_settings.getBool('adaptive_chunks', True),
+                'prefetch_segments': settings.common_settings.getInt('prefetch_segments', 0),
+                'pool_size': settings.common_settings.getInt('proxy_pool_size', PROXY_POOL_MAXSIZE),
                 'dns_rewrites': get_dns_rewrites(addon_id=session_addonid),
                 'proxy_server': _settings.get('proxy_server') or settings.common_settings.get('proxy_server'),
             }
@@ -208,7 +192,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         return new_url
 
     def _plugin_request(self, url):
-        log.debug('PLUGIN REQUEST: {}'.format(url))
+        log.debug('PLUGIN REQUEST: %s', url)
 
         if self._post_data:
             path = 'special://temp/proxy.plugin_request'
@@ -243,7 +227,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         if _type not in middlewares:
             return
 
-        log.debug('MIDDLEWARE: {}'.format(_type))
+        log.debug('MIDDLEWARE: %s', _type)
         return middlewares[_type](response, **middleware)
 
     def do_GET(self):
@@ -279,6 +263,16 @@ class RequestHandler(BaseHTTPRequestHandler):
             self._output_response(response)
             return
 
+        prefetch = self._prefetcher()
+        if prefetch and 'range' not in self._headers and url not in self._session.get('middleware', {}):
+            prefetch.schedule(url, self._headers)
+            segment = prefetch.get(url, timeout=self._session.get('timeout'))
+            if segment:
+                response.headers = dict(segment.headers)
+                response.stream.content = segment.content
+                self._output_response(response)
+                return
+
         try:
             response = self._proxy_request('GET', url)
 
@@ -296,9 +290,11 @@ class RequestHandler(BaseHTTPRequestHandler):
 
             if self._session.get('type') == 'm3u8' and (url == manifest or parse.path.endswith('.m3u') or parse.path.endswith('.m3u8') or response.headers.get('content-type') == 'application/x-mpegURL'):
                 self._parse_m3u8(response)
+                self._warm_up(response.stream.content)
 
             elif self._session.get('type') == 'mpd' and url == manifest:
                 self._parse_dash(response)
+                self._warm_up(response.stream.content)
         except Exception as e:
             log.exception(e)
 
@@ -323,6 +319,34 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         self._output_response(response)
 
+    def _warm_up(self, data):
+        session = self._session.get('session')
+        if not session:
+            return
+
+        ## Open connections to the first hosts the player will request from while it's still parsing ##
+        hosts = []
+        for match in re.finditer(re.escape(self.proxy_path.encode('utf8')) + br'(https?://[^/"\'\s<]+)', data, flags=re.I):
+            host = match.group(1).decode('utf8').lower()
+            if host not in hosts:
+                hosts.append(host)
+                if len(hosts) >= WARM_UP_HOSTS:
+                    break
+
+        if not hosts:
+            return
+
+        def _warm_up():
+            for host in hosts:
+                try:
+                    session.warm_up(host + '/')
+                except Exception as e:
+                    log.debug('Warm up failed: {} ({})'.format(host, e))
+
+        thread = threading.Thread(target=_warm_up)
+        thread.daemon = True
+        thread.start()
+
     def _quality_select(self, qualities):
         def compare(a, b):
             if a['compatible'] > b['compatible']:
@@ -476,19 +500,71 @@ class RequestHandler(BaseHTTPRequestHandler):
             return None
 
     def _parse_dash(self, response):
-        data = response.stream.content.decode('utf8')
+        data = response.stream.content
         response.stream.content = b''
 
         ## SUPPORT NEW DOLBY FORMAT https://github.com/xbmc/inputstream.adaptive/pull/466
-        data = data.replace('tag:dolby.com,2014:dash:audio_channel_configuration:2011', 'urn:dolby:dash:audio_channel_configuration:2011')
+        data = data.replace(b'tag:dolby.com,2014:dash:audio_channel_configuration:2011', b'urn:dolby:dash:audio_channel_configuration:2011')
         ## SUPPORT EC-3 CHANNEL COUNT https://github.com/xbmc/inputstream.adaptive/pull/618
-        data = data.replace('urn:mpeg:mpegB:cicp:ChannelConfiguration', 'urn:mpeg:dash:23003:3:audio_channel_configuration:2011')
-        data = data.replace('dvb:', '') #showmax mpd has dvb: namespace without declaration
+        data = data.replace(b'urn:mpeg:mpegB:cicp:ChannelConfiguration', b'urn:mpeg:dash:23003:3:audio_channel_configuration:2011')
+        data = data.replace(b'dvb:', b'') #showmax mpd has dvb: namespace without declaration
+
+        # SegmentTimelines are never modified, so they are swapped out for markers and put back after rewriting.
+        # If nothing else in the manifest has changed since the last refresh, the previous output is reused
+        timelines = []
+        def _strip_timeline(match):
+            timelines.append(match.group(2))
+            return match.group(1) + TIMELINE_MARKER.format(len(timelines)-1).encode('utf8') + match.group(3)
+
+        skeleton = TIMELINE_PATTERN.sub(_strip_timeline, data)
+        key = [PUBLISH_TIME_PATTERN.sub(b'', skeleton), self.proxy_path]
+
+        prefetch = self._prefetcher()
+        if prefetch:
+            prefetch.set_templates([media.decode('utf8').replace('&amp;', '&') for media in MEDIA_PATTERN.findall(skeleton)])
+            if prefetch.needs_timelines:
+                prefetch.set_timelines(timelines)
+
+        cache = self._manifest_cache()
+        entry = cache.get(response.url)
+        if entry and entry['key'] == key:
+            log.debug('Dash Cache: Manifest unchanged. {} timelines updated'.format(len(timelines)))
+            mpd = entry['mpd']
+            self._session['manifest'] = entry['manifest']
+        else:
+            rewriter = DashRewriter(self, response.url)
+            try:
+                mpd = rewriter.rewrite(skeleton)
+            except Exit:
+                raise
+            except Exception as e:
+                if isinstance(e, DashFallback):
+                    log.debug('Dash Fallback: {}'.format(e))
+                else:
+                    log.exception(e)
+                log.debug('Dash: Using minidom parser')
+                mpd = self._parse_dash_minidom(skeleton, response.url)
+            else:
+                if rewriter.cacheable:
+                    cache.set(response.url, {'key': key, 'mpd': mpd, 'manifest': self._session['manifest']})
+                else:
+                    cache.pop(response.url)
+
+        mpd = TIMELINE_MARKER_PATTERN.sub(lambda match: timelines[int(match.group(1))], mpd)
 
+        if ADDON_DEV:
+            with open(xbmc.translatePath('special://temp/in.mpd'), 'wb') as f:
+                f.write(data)
+            with open(xbmc.translatePath('special://temp/out.mpd'), 'wb') as f:
+                f.write(mpd)
+
+        response.stream.content = mpd
+
+    def _parse_dash_minidom(self, data, response_url):
         try:
-            root = parseString(data.encode('utf8'))
+            root = parseString(data)
         except Exception as e:
-            log.error('Failed to parse dash: {}'.format(data))
+            log.error('Failed to parse dash: {}'.format(data.decode('utf8')))
             raise
 
         if ADDON_DEV:
@@ -877,7 +953,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                 continue
 
             if url.startswith('/'):
-                url = urljoin(response.url, url)
+                url = urljoin(response_url, url)
 
             if '://' in url:
                 elem.firstChild.nodeValue = self.proxy_path + url
@@ -891,7 +967,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         for elem in root.getElementsByTagName('Location'):
             url = elem.firstChild.nodeValue
             if '://' not in url:
-                url = urljoin(response.url, url)
+                url = urljoin(response_url, url)
 
             elem.firstChild.nodeValue = self.proxy_path + url
             # update our manifest url to the location url
@@ -976,48 +1052,97 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             mpd = root.toxml(encoding='utf-8')
 
-        response.stream.content = mpd
+        return mpd
 
-    def _parse_m3u8_sub(self, m3u8, url):
-        lines = []
-        segments = []
+    def _manifest_cache(self):
+        if 'manifest_cache' not in self._session:
+            self._session['manifest_cache'] = ManifestCache()
+        return self._session['manifest_cache']
 
-        def line_ok(line):
-            # Remove sample-aes apple streaming
-            # See https://github.com/xbmc/inputstream.adaptive/issues/1007
-            if 'com.apple.streamingkeydelivery' in line and 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed' in m3u8:
-                return False
+    def _prefetcher(self):
+        count = self._session.get('prefetch_segments', 0)
+        if not count:
+            return None
 
-            # Remove x-disc lines (BREAKS DISNEY)
-            # if line.startswith('#EXT-X-DISCONTINUITY'):
-            #     return False
+        if 'prefetch' not in self._session:
+            self._session['prefetch'] = SegmentPrefetcher(self._session, count)
+        return self._session['prefetch']
 
-            return True
+    def _parse_m3u8_sub(self, m3u8, url):
+        # Remove sample-aes apple streaming
+        # See https://github.com/xbmc/inputstream.adaptive/issues/1007
+        remove_apple = 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed' in m3u8
+        base_url = urljoin(url, '/')
 
+        # live playlists mostly repeat the previous refresh, so only new lines need rewriting
+        cache = self._manifest_cache()
+        key = [base_url, self.proxy_path, remove_apple]
+        entry = cache.get(url)
+        prev_lines = entry['lines'] if entry and entry['key'] == key else {}
+
+        lines = []
+        new_lines = {}
+        reused = 0
         for line in m3u8.splitlines():
             line = line.strip()
             if not line:
                 continue
 
-            if line.startswith('#'):
-                if not line_ok(line):
-                    log.debug('Removed: {}'.format(line))
-                    continue
+            if line in prev_lines:
+                new_line = prev_lines[line]
+                reused += 1
             else:
-                # below not needed with IA version >= 20.3.3 (https://github.com/xbmc/inputstream.adaptive/pull/1108)
-                segments.append(line.lower())
-                if '/beacon?' in line.lower() or '/beacon/' in line.lower():
-                    parse = urlparse(line)
-                    params = dict(parse_qsl(parse.query))
-                    for key in params:
-                        if key.lower() == 'redirect_path' or key.lower() == 'redirect_url':
-                            line = params[key]
-                            log.debug('M3U8 Fix: Beacon removed')
-
-            lines.append(line)
+                new_line = self._parse_m3u8_sub_line(line, base_url, remove_apple)
+
+            new_lines[line] = new_line
+            if new_line is not None:
+                lines.append(new_line)
+
+        if '#EXT-X-ENDLIST' not in m3u8:
+            cache.set(url, {'key': key, 'lines': new_lines})
+            log.debug('M3U8 Cache: %s lines reused', reused)
+
+        prefetch = self._prefetcher()
+        if prefetch and '#EXT-X-BYTERANGE' not in m3u8:
+            segments = []
+            for line in lines:
+                if line.startswith('#'):
+                    continue
+                if line.startswith(self.proxy_path):
+                    line = line[len(self.proxy_path):]
+                segments.append(urljoin(url, line))
+            prefetch.set_playlist(url, segments)
 
         return '\n'.join(lines)
 
+    def _parse_m3u8_sub_line(self, line, base_url, remove_apple):
+        if line.startswith('#'):
+            if remove_apple and 'com.apple.streamingkeydelivery' in line:
+                log.debug('Removed: %s', line)
+                return None
+
+            # Remove x-disc lines (BREAKS DISNEY)
+            # if line.startswith('#EXT-X-DISCONTINUITY'):
+            #     return None
+        else:
+            # below not needed with IA version >= 20.3.3 (https://github.com/xbmc/inputstream.adaptive/pull/1108)
+            if '/beacon?' in line.lower() or '/beacon/' in line.lower():
+                parse = urlparse(line)
+                params = dict(parse_qsl(parse.query))
+                for key in params:
+                    if key.lower() == 'redirect_path' or key.lower() == 'redirect_url':
+                        line = params[key]
+                        log.debug('M3U8 Fix: Beacon removed')
+
+        return self._m3u8_proxy_paths(line, base_url)
+
+    def _m3u8_proxy_paths(self, m3u8, base_url):
+        m3u8 = re.sub(r'^/', r'{}'.format(base_url), m3u8, flags=re.I|re.M)
+        m3u8 = re.sub(r'URI="/', r'URI="{}'.format(base_url), m3u8, flags=re.I|re.M)
+
+        ## Convert to proxy paths
+        return re.sub(r'(https?)://', r'{}\1://'.format(self.proxy_path), m3u8, flags=re.I)
+
     def _parse_m3u8_master(self, m3u8, manifest_url):
         def _remove_quotes(string):
             quotes = ('"', "'")
@@ -1263,17 +1388,11 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         if is_master:
             m3u8 = self._parse_m3u8_master(m3u8, response.url)
+            m3u8 = self._m3u8_proxy_paths(m3u8, urljoin(response.url, '/'))
         else:
+            # sub playlists have their paths converted line by line
             m3u8 = self._parse_m3u8_sub(m3u8, response.url)
 
-        base_url = urljoin(response.url, '/')
-
-        m3u8 = re.sub(r'^/', r'{}'.format(base_url), m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'URI="/', r'URI="{}'.format(base_url), m3u8, flags=re.I|re.M)
-
-        ## Convert to proxy paths
-        m3u8 = re.sub(r'(https?)://', r'{}\1://'.format(self.proxy_path), m3u8, flags=re.I)
-
         m3u8 = m3u8.encode('utf8')
 
         if ADDON_DEV:
@@ -1293,7 +1412,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             real_path = xbmc.translatePath(url)
 
             if os.path.exists(real_path):
-                log.debug('Reading response from local path: {}'.format(real_path))
+                log.debug('Reading response from local path: %s', real_path)
                 response.status_code = 200
                 with open(real_path, 'rb') as f:
                     response.stream.content = f.read()
@@ -1311,7 +1430,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                 f.write(self._post_data)
 
         if not self._session.get('session'):
-            self._session['session'] = RawSession(verify=self._session.get('verify'), timeout=self._session.get('timeout'), auto_close=False)
+            self._session['session'] = RawSession(verify=self._session.get('verify'), timeout=self._session.get('timeout'), auto_close=False, pool_maxsize=self._session.get('pool_size', PROXY_POOL_MAXSIZE))
             self._session['session'].set_dns_rewrites(self._session.get('dns_rewrites', []))
             self._session['session'].set_proxy(self._session.get('proxy_server'))
             self._session['session'].set_cert(self._session.get('cert'))
@@ -1326,7 +1445,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         retries = 3
         # some reason we get connection errors every so often when using a session. something to do with the socket
         for i in range(retries):
-            log.debug('REQUEST OUT: {} ({})'.format(url, method.upper()))
+            log.debug('REQUEST OUT: %s (%s)', url, method.upper())
             try:
                 response = self._session['session'].request(method=method, url=url, headers=self._headers, data=self._post_data, allow_redirects=False, stream=True)
             except ConnectionError as e:
@@ -1337,7 +1456,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                 log.exception(e)
                 raise
             else:
-                log.debug('RESPONSE IN: {} ({})'.format(url, response.status_code))
+                log.debug('RESPONSE IN: %s (%s)', url, response.status_code)
                 break
 
         response.stream = ResponseStream(response)
@@ -1359,7 +1478,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             response.stream.content = b''
 
         if 'set-cookie' in response.headers:
-            log.debug('set-cookie: {}'.format(response.headers['set-cookie']))
+            log.debug('set-cookie: %s', response.headers['set-cookie'])
             ## we handle cookies in the requests session
             response.headers.pop('set-cookie')
 
@@ -1376,7 +1495,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def _output_response(self, response):
-        log.debug('RESPONSE OUT: {} ({})'.format(self._url, response.status_code))
+        log.debug('RESPONSE OUT: %s (%s)', self._url, response.status_code)
         self._output_headers(response)
 
         if ADDON_DEV:
@@ -1385,7 +1504,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             f = None
 
         try:
-            for chunk in response.stream.iter_content():
+            for chunk in response.stream.iter_content(adaptive=self._adaptive_chunks(response)):
                 try:
                     self.wfile.write(chunk)
                 except Exception as e:
@@ -1394,6 +1513,17 @@ class RequestHandler(BaseHTTPRequestHandler):
         finally:
             if f: f.close()
 
+    def _adaptive_chunks(self, response):
+        if not self._session.get('adaptive_chunks', True):
+            return False
+
+        ## Keep small chunks for audio / shoutcast streams ##
+        content_type = response.headers.get('content-type', '').lower()
+        if content_type.startswith('audio/') or any(key.lower().startswith('icy-') for key in response.headers):
+            return False
+
+        return True
+
     def do_HEAD(self):
         url = self._get_url('HEAD')
         response = self._proxy_request('HEAD', url)
@@ -1439,6 +1569,27 @@ class Response(object):
     def ok(self):
         return self.status_code == 200
 
+class ManifestCache(object):
+    def __init__(self, size=MANIFEST_CACHE_SIZE):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            return self._data.get(url)
+
+    def set(self, url, entry):
+        with self._lock:
+            self._data.pop(url, None)
+            self._data[url] = entry
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def pop(self, url):
+        with self._lock:
+            return self._data.pop(url, None)
+
 class ResponseStream(object):
     def __init__(self, response):
         self._response = response
@@ -1461,14 +1612,17 @@ class ResponseStream(object):
         self._response.headers.pop('content-range', None)
         self._response.headers.pop('content-encoding', None)
 
-    def iter_content(self):
+    def iter_content(self, adaptive=False):
         if self._bytes is not None:
             yield self._bytes
+        elif adaptive:
+            for chunk in self._iter_adaptive():
+                yield chunk
         else:
             while True:
                 try:
                     # 4096 best for shoutcast streams and quick playback start
-                    chunk = self._response.raw.read(4096)
+                    chunk = self._response.raw.read(PROXY_CHUNK_MIN)
                 except:
                     chunk = None
 
@@ -1477,12 +1631,37 @@ class ResponseStream(object):
 
                 yield chunk
 
+    def _iter_adaptive(self):
+        # start small for quick playback start, then double up to PROXY_CHUNK_MAX
+        # chunks are views into a re-used buffer so must be consumed before next iteration
+        # urllib3 enforces content-length and releases the connection itself, including on errors
+        readinto = self._response.raw.readinto
+
+        buf = bytearray(PROXY_CHUNK_MAX)
+        view = memoryview(buf)
+        size = PROXY_CHUNK_MIN
+
+        while True:
+            try:
+                length = readinto(view[:size])
+            except Exception as e:
+                log.debug('Proxy: stream read failed (%s)', e)
+                break
+
+            if not length:
+                break
+
+            yield view[:length] if not PY2 else bytes(buf[:length])
+            size = min(size * 2, PROXY_CHUNK_MAX)
+
 def save_session():
     # persist session across service restarts
     session = PROXY_GLOBAL['sessions'].get(DEFAULT_SESSION_NAME)
     if not session:
         return
 
+    session.pop('manifest_cache', None)
+    session.pop('prefetch', None)
     requests_session = session.pop('session', None)
     if requests_session:
         session['cookies'] = requests_session.cookies.get_dict()
@@ -1493,6 +1672,51 @@ def save_session():
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
+class KeepAliveRequestHandler(RequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _output_headers(self, response):
+        ## Without a content-length the client can only find the end of the body by us closing the connection ##
+        if 'content-length' not in response.headers:
+            response.headers['connection'] = 'close'
+            self.close_connection = True
+
+        RequestHandler._output_headers(self, response)
+
+class WorkerPoolHTTPServer(HTTPServer):
+    # connections are handed to a fixed pool of threads instead of a new thread per request
+    def __init__(self, server_address, handler_class, workers=PROXY_WORKERS):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self._requests = queue.Queue()
+        self._workers = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def process_request(self, request, client_address):
+        self._requests.put([request, client_address])
+
+    def _worker(self):
+        while True:
+            request, client_address = self._requests.get()
+            if request is None:
+                break
+
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for thread in self._workers:
+            self._requests.put([None, None])
+
 class Proxy(object):
     started = False
 
@@ -1506,7 +1730,12 @@ class Proxy(object):
         if not port:
             port = check_port()
 
-        self._server = ThreadedHTTPServer((HOST, port), RequestHandler)
+        server_type = settings.getEnum('proxy_server_type', PROXY_SERVER_TYPES, default=PROXY_THREADED)
+        if server_type == PROXY_WORKER_POOL:
+            self._server = WorkerPoolHTTPServer((HOST, port), KeepAliveRequestHandler)
+        else:
+            self._server = ThreadedHTTPServer((HOST, port), RequestHandler)
+
         self._server.allow_reuse_address = True
         self._httpd_thread = threading.Thread(target=self._server.serve_forever)
         self._httpd_thread.start()
@@ -1514,7 +1743,7 @@ class Proxy(object):
 
         proxy_path = 'http://{}:{}/'.format(HOST, port)
         settings.set('_proxy_path', proxy_path)
-        log.info("Proxy Started: {}".format(proxy_path))
+        log.info("Proxy Started: {} ({})".format(proxy_path, server_type))
 
     def stop(self):
         if not self.started:
@@ -0,0 +1,172 @@
+"""Proxy load benchmark.
+
+Replays a segment request pattern against a local stub origin, either directly or through a running proxy.
+Only uses the standard library so it can be run from a desktop python 3 against Kodi's proxy.
+
+    python3 proxy_bench.py --proxy http://127.0.0.1:52103/
+    python3 proxy_bench.py --proxy http://127.0.0.1:52103/ --pattern recorded.json
+
+A recorded pattern is a JSON list of requests: [{"path": "/video/1.m4s", "size": 500000, "range": "0-1000"}, ...]
+The default pattern is a multi-audio / multi-subtitle DASH stream, which is where inputstream.adaptive
+fires the most parallel range requests.
+
+Run it once per proxy server setting to compare them.
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+def default_pattern(periods=30):
+    streams = [['video', 600000], ['audio_en', 32000], ['audio_es', 32000], ['audio_fr', 32000], ['sub_en', 2000], ['sub_es', 2000]]
+
+    pattern = []
+    for i in range(1, periods+1):
+        for name, size in streams:
+            if name.startswith('video'):
+                # video is fetched as a few range requests
+                for start in range(0, size, size // 3):
+                    pattern.append({'path': '/{}/{}.m4s'.format(name, i), 'size': size, 'range': '{}-{}'.format(start, min(start + size // 3, size) - 1)})
+            else:
+                pattern.append({'path': '/{}/{}.m4s'.format(name, i), 'size': size})
+
+    return pattern
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        size = int(self.headers.get('X-Bench-Size', 1000))
+        start, end = 0, size - 1
+
+        if self.headers.get('Range'):
+            start, end = [int(x) for x in self.headers['Range'].split('=')[1].split('-')]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.wfile.write(self.server.payload[start:end+1])
+
+class OriginServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Client(object):
+    def __init__(self, proxy, origin):
+        # the proxy takes the full origin url as its path
+        self._prefix = '/' + origin if proxy else '/'
+        parsed = urlparse(proxy or origin)
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._conn = None
+        self.connections = 0
+
+    def get(self, request):
+        headers = {'X-Bench-Size': str(request['size'])}
+        if request.get('range'):
+            headers['Range'] = 'bytes={}'.format(request['range'])
+
+        path = self._prefix + request['path'].lstrip('/')
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = HTTPConnection(self._host, self._port, timeout=30)
+                self.connections += 1
+
+            try:
+                self._conn.request('GET', path, headers=headers)
+                response = self._conn.getresponse()
+                length = len(response.read())
+            except (socket.error, IOError):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+                continue
+
+            if response.will_close:
+                self._conn.close()
+                self._conn = None
+
+            return response.status, length
+
+def run(args):
+    pattern = json.load(open(args.pattern)) if args.pattern else default_pattern()
+
+    OriginHandler.latency = args.latency / 1000.0
+    origin = OriginServer(('127.0.0.1', 0), OriginHandler)
+    origin.payload = os.urandom(max(x['size'] for x in pattern))
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    origin_url = 'http://127.0.0.1:{}/'.format(origin.server_port)
+
+    lock = threading.Lock()
+    queue = list(pattern)
+    timings = []
+    errors = []
+    total = [0, 0]
+
+    def worker():
+        client = Client(args.proxy, origin_url)
+        while True:
+            with lock:
+                if not queue:
+                    break
+                request = queue.pop(0)
+
+            start = time.time()
+            try:
+                status, length = client.get(request)
+            except Exception as e:
+                errors.append(e)
+                continue
+
+            with lock:
+                timings.append(time.time() - start)
+                total[0] += length
+                if status not in (200, 206):
+                    errors.append(status)
+
+        with lock:
+            total[1] += client.connections
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    timings.sort()
+    print('Target:      {}'.format(args.proxy or 'origin (direct)'))
+    print('Requests:    {} ({} errors) using {} connections'.format(len(timings), len(errors), total[1]))
+    print('Elapsed:     {:.2f}s ({:.1f} req/s, {:.1f} MB/s)'.format(elapsed, len(timings) / elapsed, total[0] / elapsed / 1024 / 1024))
+    if timings:
+        print('Latency:     p50 {:.1f}ms  p95 {:.1f}ms  max {:.1f}ms'.format(timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000, timings[-1] * 1000))
+
+    origin.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a segment request pattern through the proxy')
+    parser.add_argument('--proxy', help='proxy path eg. http://127.0.0.1:52103/ (default: hit origin directly)')
+    parser.add_argument('--pattern', help='JSON file with the recorded requests')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel connections (default: 8)')
+    parser.add_argument('--latency', type=int, default=20, help='origin latency per request in ms (default: 20)')
+    run(parser.parse_args())
@@ -5,7 +5,7 @@ from time import time
 
 from slyguy import settings, signals, gui
 from slyguy.session import Session
-from slyguy.log import log
+from slyguy.log import log, refresh as refresh_log
 from slyguy.monitor import monitor
 from slyguy.drm import set_drm_level
 from slyguy.donor import is_donor
@@ -102,6 +102,9 @@ def start():
 
             if monitor.waitForAbort(30):
                 break
+
+            # pick up kodi debug logging being toggled
+            refresh_log()
     except KeyboardInterrupt:
         pass
     except Exception as e:
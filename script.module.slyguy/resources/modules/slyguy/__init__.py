@@ -2,6 +2,7 @@ import sys
 
 from .log import log
 from .constants import ADDON_ID, COMMON_ADDON_ID, DEPENDENCIES_ADDON_ID
+from . import profiler
 
 log.debug('sys.path: {}'.format(sys.path))
 if ADDON_ID not in sys.path[0]:
@@ -15,3 +16,5 @@ if ADDON_ID not in sys.path[0]:
             paths[0] = path
     sys.path = [x for x in paths if x] + [x for x in sys.path if x not in paths]
     log.debug('Fixed sys.path: {}'.format(sys.path))
+
+profiler.start()
@@ -4,19 +4,30 @@ from functools import wraps
 import peewee
 
 from . import database, settings, signals, gui, router
-from .constants import CACHE_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, CACHE_CLEAN_INTERVAL, CACHE_CLEAN_KEY, ROUTE_CLEAR_CACHE
-from .util import hash_6
-from .log import log
+from .constants import ADDON_ID, CACHE_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, CACHE_CLEAN_INTERVAL, CACHE_CLEAN_KEY, ROUTE_CLEAR_CACHE
+from .constants import CACHE_GEN_KEY, CACHE_MEMORY_ITEMS, CACHE_MEMORY_BYTES
+from .util import hash_6, set_kodi_string, get_kodi_string, MemoryCache, background_refresh
+from .log import get_logger
 from .language import _
 
+log = get_logger('cache')
+
 funcs   = []
 
+# in-process tier in front of the sqlite table
+# the generation string is bumped on every write so other processes drop their copy
+_memory  = MemoryCache(max_items=CACHE_MEMORY_ITEMS, max_bytes=CACHE_MEMORY_BYTES)
+_gen_key = CACHE_GEN_KEY.format(ADDON_ID)
+_gen     = ['']
+_stats   = {'db_hits': 0, 'db_misses': 0}
+
 class Cache(database.Model):
     checksum = CACHE_CHECKSUM
 
     key     = database.HashField(unique=True)
     value   = database.PickleField()
     expires = peewee.IntegerField()
+    refresh = peewee.IntegerField(null=True)
 
     class Meta:
         table_name = CACHE_TABLENAME
@@ -59,7 +70,7 @@ def _build_key(func_name, *args, **kwargs):
     return hash_6(key)
 
 def cached(*args, **kwargs):
-    def decorator(f, expires=CACHE_EXPIRY, key=None):
+    def decorator(f, expires=CACHE_EXPIRY, key=None, hard_expires=None):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or _build_key(f.__name__, *args, **kwargs)
@@ -67,14 +78,16 @@ def cached(*args, **kwargs):
                 _key = _key(*args, **kwargs)
 
             if not kwargs.pop('_skip_cache', False):
-                value = get(_key)
+                value, stale = get_stale(_key)
                 if value != None:
-                    log('Cache Hit: {}'.format(_key))
+                    log('Cache %s: %s', 'Stale' if stale else 'Hit', _key)
+                    if stale:
+                        background_refresh(_key, lambda: _refresh(_key, f, args, kwargs, expires, hard_expires))
                     return value
 
             value = f(*args, **kwargs)
             if value != None:
-                set(_key, value, expires)
+                set(_key, value, expires, hard_expires)
 
             return value
 
@@ -83,31 +96,94 @@ def cached(*args, **kwargs):
 
     return lambda f: decorator(f, *args, **kwargs)
 
+def _refresh(key, f, args, kwargs, expires, hard_expires):
+    # runs in its own thread, peewee connections are per thread
+    with database.db.connection_context():
+        value = f(*args, **kwargs)
+        if value != None:
+            set(key, value, expires, hard_expires)
+
 def get(key, default=None):
+    return get_stale(key, default)[0]
+
+def get_stale(key, default=None):
     if not enabled():
-        return default
+        return default, False
+
+    value, stale = _memory.get_stale(key, default)
+    if value is not default:
+        return value, stale
 
     try:
-        return Cache.get(Cache.key == key, Cache.expires > time()).value
+        row = Cache.get(Cache.key == key, Cache.expires > time())
     except Cache.DoesNotExist:
-        return default
+        _stats['db_misses'] += 1
+        return default, False
+
+    _stats['db_hits'] += 1
+    _memory.set(key, row.value, row.expires, row.refresh)
+    return row.value, row.refresh != None and row.refresh < time()
 
-def set(key, value, expires=CACHE_EXPIRY):
+def set(key, value, expires=CACHE_EXPIRY, hard_expires=None):
+    # value is served stale (and refreshed) between expires and hard_expires
+    refresh = None
     expires = int(time() + expires)
-    Cache.set(key=key, value=value, expires=expires)
+    if hard_expires != None:
+        refresh, expires = expires, int(time() + hard_expires)
+
+    Cache.set(key=key, value=value, expires=expires, refresh=refresh)
+    _memory.set(key, value, expires, refresh)
+    _bump_gen()
 
 def delete(key):
+    _memory.delete(key)
+    _bump_gen()
     return Cache.delete_where(Cache.key == key)
 
 def empty():
+    _memory.clear()
+    _bump_gen()
     deleted = Cache.truncate()
     log('Cache: Deleted {} Rows'.format(deleted))
 
+def stats():
+    data = _memory.stats()
+    data.update(_stats)
+    return data
+
+def _bump_gen():
+    _gen[0] = str(time())
+    set_kodi_string(_gen_key, _gen[0])
+
+@signals.on(signals.BEFORE_DISPATCH)
+def _check_gen():
+    gen = get_kodi_string(_gen_key)
+    if gen != _gen[0]:
+        _gen[0] = gen
+        _memory.clear()
+
 @signals.on(signals.BEFORE_DISPATCH)
-def remove_expired():
-    deleted = Cache.delete_where(Cache.expires < int(time()))
+def remove_expired(force=False):
+    _time = int(time())
+
+    if not force:
+        try:
+            last_clean = int(database.KeyStore.get(database.KeyStore.key == CACHE_CLEAN_KEY).value)
+        except (database.KeyStore.DoesNotExist, ValueError):
+            last_clean = 0
+
+        if last_clean > _time - CACHE_CLEAN_INTERVAL:
+            return
+
+    deleted = Cache.delete_where(Cache.expires < _time)
+    database.KeyStore.set(key=CACHE_CLEAN_KEY, value=str(_time))
+    _memory.remove_expired()
     log('Cache: Deleted {} Expired Rows'.format(deleted))
 
+@signals.on(signals.AFTER_DISPATCH)
+def log_stats():
+    log.debug('Cache: {}'.format(stats()))
+
 @router.route(ROUTE_CLEAR_CACHE)
 def clear_cache(key, **kwargs):
     delete_count = delete(key)
@@ -28,6 +28,7 @@ REPO_DOMAIN = 'https://slyguy.uk'
 DB_PATH         = os.path.join(ADDON_PROFILE, 'data.db')
 DB_MAX_INSERTS  = 100
 DB_PRAGMAS      = {
+    'auto_vacuum': 2, #incremental (only applies to new databases)
     'journal_mode': 'wal',
     'cache_size': -1 * 10000,  #10MB
     'foreign_keys': 1,
@@ -35,22 +36,48 @@ DB_PRAGMAS      = {
     'synchronous': 0
 }
 DB_TABLENAME = '_db'
+DB_VACUUM_MIN_PAGES = 256
+DB_VACUUM_FREE_RATIO = 0.1
+DB_WAL_MAX_BYTES = 4*1024*1024 #4MB
+# only pragmas that can change inside a transaction
+DB_BULK_PRAGMAS = {
+    'cache_size': -1 * 64000, #64MB
+    'temp_store': 2, #memory
+}
 ###################
 
 ##### USERDATA ####
 USERDATA_KEY = '_userdata'
 ###############
 
+##### DNS CACHE #####
+DNS_CACHE_PATH    = os.path.join(xbmc.translatePath(COMMON_ADDON.getAddonInfo('profile')), 'dns.db')
+DNS_NEGATIVE_TTL  = 30
+DNS_STALE_TTL     = (60*60) # 1 Hour
+###################
+
 ##### CACHE #####
 CACHE_TABLENAME      = '_cache'
-CACHE_CHECKSUM       = ADDON_VERSION # Recreates cache when new addon version
+CACHE_CHECKSUM       = ADDON_VERSION + '.1' # Recreates cache when new addon version / table change
 CACHE_EXPIRY         = (60*60*24) # 24 Hours
 CACHE_CLEAN_INTERVAL = (60*60*4)  # 4 Hours
 CACHE_CLEAN_KEY      = '_cache_cleaned'
+CACHE_GEN_KEY        = '_slyguy_cache_gen_{}'
+CACHE_MEMORY_ITEMS   = 250
+CACHE_MEMORY_BYTES   = (10*1024*1024) # 10 MB
+CACHE_LOCK_TIMEOUT   = 60 # Abandoned background refresh lock
+CACHE_REFRESH_WAIT   = 5  # Background refresh wait before db maintenance on close
 #################
 
 IPTV_MERGE_ID        = 'plugin.program.iptv.merge'
 
+#### FAST CHANNELS ####
+FAST_ALL            = 'all'
+FAST_MY_CHANNELS    = 'my_channels'
+FAST_CHECK_INTERVAL = (60*15) # 15 Minutes
+FAST_IN_BATCH       = 500
+#################
+
 #### ROUTING ####
 ROUTE_TAG              = '_'
 ROUTE_RESET            = '_reset'
@@ -93,11 +120,15 @@ IA_LINUX_PACKAGE = 'kodi-inputstream-adaptive'
 
 #### MISC #####
 NOARG = object()
+STARTUP_BUDGET = 1.5 # seconds
+PROFILER_TOP_MODULES = 15
 #################
 
 #### LOG #####
 LOG_ID = ADDON_ID
 LOG_FORMAT = u'%(name)s - %(message)s'
+LOG_SUBSYSTEMS = ['proxy', 'session', 'db', 'cache']
+LOG_REFRESH_INTERVAL = 30
 #################
 
 ## QUALITY ##
@@ -124,6 +155,10 @@ WIDEVINE_PSSH = bytearray([112, 115, 115, 104])
 #DEFAULT_USERAGENT = 'Dalvik/2.1.0 (Linux; U; Android 9; SHIELD Android TV Build/PPR1.180610.011)'
 DEFAULT_USERAGENT = 'okhttp/4.9.3'
 DEFAULT_WORKERS = 5
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+POOL_IDLE_TIMEOUT = 30
+REWRITE_CACHE_SIZE = 256
 
 #### BOOKMARKS #####
 BOOKMARK_FILE = os.path.join(ADDON_PROFILE, 'bookmarks.json')
@@ -137,6 +172,18 @@ HOST = '127.0.0.1'
 ERROR_URL = 'error.m3u8'
 STOP_URL = 'stop.m3u8'
 EMPTY_TS = 'empty.ts' if KODI_VERSION < 19 else ''
+MANIFEST_CACHE_SIZE = 10
+PROXY_CHUNK_MIN = 4096
+PROXY_CHUNK_MAX = 256 * 1024
+PREFETCH_WORKERS = 2
+PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+PREFETCH_IDLE_TIMEOUT = 30
+PROXY_THREADED = 'threaded'
+PROXY_WORKER_POOL = 'worker_pool'
+PROXY_SERVER_TYPES = [PROXY_THREADED, PROXY_WORKER_POOL]
+PROXY_WORKERS = 10
+PROXY_POOL_MAXSIZE = 20
+WARM_UP_HOSTS = 2
 #################
 
 CHUNK_SIZE = 64 * 1024
@@ -1,14 +1,19 @@
 import os
 import json
 import codecs
+import hashlib
+from contextlib import contextmanager
 
 import peewee
 from six.moves import cPickle
 
 from . import userdata, signals
-from .log import log
-from .util import hash_6
-from .constants import DB_PATH, DB_PRAGMAS, DB_MAX_INSERTS, DB_TABLENAME, ADDON_DEV
+from .log import get_logger
+from .util import hash_6, wait_background_refresh
+from .constants import DB_PATH, DB_PRAGMAS, DB_MAX_INSERTS, DB_TABLENAME, ADDON_DEV, DB_BULK_PRAGMAS, ADDON_VERSION
+from .constants import DB_VACUUM_MIN_PAGES, DB_VACUUM_FREE_RATIO, DB_WAL_MAX_BYTES, CACHE_REFRESH_WAIT
+
+log = get_logger('db')
 
 path = os.path.dirname(DB_PATH)
 if not os.path.exists(path):
@@ -132,7 +137,23 @@ class KeyStore(Model):
         table_name = DB_TABLENAME
 
 tables = [KeyStore]
+
+def schema_fingerprint():
+    # built from the model definitions only so it's cheap enough for every dispatch
+    # get_checksum() remains the per-table source of truth when this changes
+    parts = [ADDON_VERSION]
+    for table in sorted(tables, key=lambda x: x.table_name()):
+        fields = [(x.column_name, x.field_type, x.null, x.unique, x.index, x.primary_key) for x in table._meta.sorted_fields]
+        parts.append([table.table_name(), table.checksum, fields, table._meta.indexes])
+
+    # user_version is a signed 32bit int, 0 is a new database
+    return int(hashlib.md5(u'{}'.format(parts).encode('utf8')).hexdigest()[:7], 16) or 1
+
 def check_tables():
+    fingerprint = schema_fingerprint()
+    if db.execute_sql('PRAGMA user_version').fetchone()[0] == fingerprint:
+        return
+
     with db.atomic():
         for table in tables:
             key      = table.table_name()
@@ -146,16 +167,74 @@ def check_tables():
 
             KeyStore.set(key=key, value=checksum)
 
+    db.execute_sql('PRAGMA user_version = {}'.format(fingerprint))
+
+@contextmanager
+def bulk_load(*models):
+    """Drops the secondary indexes of models and relaxes pragmas while loading lots of rows.
+    Must be used inside a transaction so the drop is rolled back with it if the load never finishes."""
+    if not db.in_transaction():
+        raise peewee.OperationalError('bulk_load must be used inside a transaction')
+
+    indexes = []
+    for model in models:
+        indexes.extend(db.execute_sql("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (model._meta.table_name,)).fetchall())
+
+    pragmas = {}
+    for key in DB_BULK_PRAGMAS:
+        pragmas[key] = db.execute_sql('PRAGMA {}'.format(key)).fetchone()[0]
+        db.execute_sql('PRAGMA {} = {}'.format(key, DB_BULK_PRAGMAS[key]))
+
+    for name, sql in indexes:
+        db.execute_sql('DROP INDEX IF EXISTS "{}"'.format(name))
+
+    try:
+        yield
+    finally:
+        for key in pragmas:
+            db.execute_sql('PRAGMA {} = {}'.format(key, pragmas[key]))
+
+        for name, sql in indexes:
+            # an error may have already rolled them back
+            if not db.execute_sql("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone():
+                db.execute_sql(sql)
+
 @signals.on(signals.AFTER_RESET)
 def delete():
     close()
     if os.path.exists(DB_PATH):
         os.remove(DB_PATH)
 
+def maintenance():
+    db.execute_sql('PRAGMA optimize')
+
+    page_count = db.execute_sql('PRAGMA page_count').fetchone()[0]
+    free_pages = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    if free_pages >= DB_VACUUM_MIN_PAGES and free_pages >= page_count * DB_VACUUM_FREE_RATIO:
+        if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            # the pragma frees one page per step, executescript runs it to completion
+            db.connection().executescript('PRAGMA incremental_vacuum;')
+            log.debug('DB: Incremental vacuum freed {} pages'.format(free_pages))
+        else:
+            # databases created before incremental auto vacuum need one full vacuum to switch
+            db.execute_sql('PRAGMA auto_vacuum = 2')
+            db.execute_sql('VACUUM')
+            log.debug('DB: Vacuumed {} free pages and enabled incremental vacuum'.format(free_pages))
+
+    wal_path = DB_PATH + '-wal'
+    if os.path.exists(wal_path) and os.path.getsize(wal_path) > DB_WAL_MAX_BYTES:
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        log.debug('DB: WAL checkpointed')
+
 @signals.on(signals.ON_CLOSE)
 def close():
-    try:  db.execute_sql('VACUUM')
-    except: log.debug('Failed to vacuum db')
+    # refreshes write through their own connection, don't vacuum underneath them
+    if wait_background_refresh(CACHE_REFRESH_WAIT):
+        try: maintenance()
+        except: log.debug('Failed to run db maintenance')
+    else:
+        log.debug('Skipping db maintenance while a background refresh is running')
+
     db.close()
 
 @signals.on(signals.BEFORE_DISPATCH)
@@ -0,0 +1,113 @@
+import os
+import json
+import sqlite3
+import threading
+from time import time
+
+from .log import get_logger
+from .constants import DNS_CACHE_PATH, DNS_NEGATIVE_TTL, DNS_STALE_TTL
+
+log = get_logger('session')
+
+# Resolver answers shared by all addons and the proxy (sqlite file in the common addon profile)
+# so each plugin call / proxy session doesn't have to re-resolve the same hosts.
+
+_lock = threading.Lock()
+_refreshing = set()
+_created = []
+
+def _connect():
+    if not _created:
+        path = os.path.dirname(DNS_CACHE_PATH)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    conn = sqlite3.connect(DNS_CACHE_PATH, timeout=5, isolation_level=None)
+    conn.execute('PRAGMA synchronous=0')
+
+    if not _created:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS dns (key TEXT PRIMARY KEY, ips TEXT, expires INTEGER)')
+        _created.append(True)
+
+    return conn
+
+def get(key):
+    try:
+        conn = _connect()
+        try:
+            row = conn.execute('SELECT ips, expires FROM dns WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+    except Exception as e:
+        log.debug('DNS Cache: get failed ({})'.format(e))
+        return None
+
+    if row:
+        return json.loads(row[0]), row[1]
+
+    return None
+
+def set(key, ips, ttl):
+    _time = int(time())
+
+    try:
+        conn = _connect()
+        try:
+            conn.execute('REPLACE INTO dns (key, ips, expires) VALUES (?, ?, ?)', (key, json.dumps(ips), _time + int(ttl)))
+            conn.execute('DELETE FROM dns WHERE expires < ?', (_time - DNS_STALE_TTL,))
+        finally:
+            conn.close()
+    except Exception as e:
+        log.debug('DNS Cache: set failed ({})'.format(e))
+
+def resolve(key, func):
+    """Returns the ips for key, calling func() -> (ips, ttl) when they aren't cached.
+
+    Expired answers are still returned (and refreshed in the background) for up to DNS_STALE_TTL,
+    so a slow resolver never holds up playback. Failed lookups are cached as an empty list for DNS_NEGATIVE_TTL.
+    """
+    row = get(key)
+
+    if row:
+        ips, expires = row
+        if expires > time():
+            log.debug('DNS Cache: %s %s', 'Hit' if ips else 'Negative hit', key)
+            return ips
+
+        if ips:
+            log.debug('DNS Cache: Stale %s', key)
+            _refresh_background(key, func)
+            return ips
+
+    return _refresh(key, func)
+
+def _refresh(key, func):
+    try:
+        ips, ttl = func()
+    except Exception as e:
+        log.debug('DNS Cache: Failed {} ({})'.format(key, e))
+        ips, ttl = [], DNS_NEGATIVE_TTL
+
+    if not ips:
+        ttl = DNS_NEGATIVE_TTL
+
+    set(key, ips, ttl)
+    return ips
+
+def _refresh_background(key, func):
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            _refresh(key, func)
+        finally:
+            with _lock:
+                _refreshing.discard(key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
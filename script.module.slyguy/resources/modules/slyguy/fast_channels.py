@@ -0,0 +1,374 @@
+import re
+import time
+import json
+import calendar
+from gzip import GzipFile
+
+import peewee
+from six import BytesIO
+
+from . import database, userdata
+from .log import get_logger
+from .session import Session
+from .constants import FAST_CHECK_INTERVAL, FAST_ALL, FAST_MY_CHANNELS, FAST_IN_BATCH
+
+log = get_logger('db')
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+ISO_PATTERN = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+# Free ad-supported (FAST) channel feeds from i.mjh.nz share a format.
+# They are parsed once into indexed tables and only rebuilt when the feed's ETag changes
+
+class FastFeed(database.Model):
+    url     = peewee.TextField(primary_key=True)
+    etag    = peewee.TextField(null=True)
+    checked = peewee.IntegerField(default=0)
+    headers = database.JSONField(null=True)
+
+class FastRegion(database.Model):
+    code    = peewee.TextField(primary_key=True)
+    name    = peewee.TextField()
+    logo    = peewee.TextField(null=True)
+    headers = database.JSONField(null=True)
+
+class FastChannel(database.Model):
+    id          = peewee.TextField(primary_key=True)
+    chno        = peewee.BareField(null=True)
+    name        = peewee.TextField()
+    sort_name   = peewee.TextField()
+    logo        = peewee.TextField(null=True)
+    art         = peewee.TextField(null=True)
+    description = peewee.TextField(null=True)
+    url         = peewee.TextField(null=True)
+    url_alt     = peewee.TextField(null=True)
+    license_url = peewee.TextField(null=True)
+    headers     = database.JSONField(null=True)
+    region      = peewee.TextField(null=True)
+    groups      = database.JSONField()
+
+class FastMember(database.Model):
+    region         = peewee.TextField()
+    group          = peewee.TextField()
+    channel        = peewee.TextField()
+    chno           = peewee.BareField(null=True)
+    groups         = database.JSONField()
+    channel_region = peewee.TextField(null=True)
+
+    class Meta:
+        primary_key = peewee.CompositeKey('region', 'group', 'channel')
+
+class FastProgramme(database.Model):
+    channel = peewee.TextField()
+    start   = peewee.IntegerField()
+    title   = peewee.TextField(null=True)
+
+    class Meta:
+        primary_key = False
+        indexes = ((('channel', 'start'), False),)
+
+class FastToken(database.Model):
+    token   = peewee.TextField()
+    channel = peewee.TextField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey('token', 'channel')
+
+# the feed etag is only valid for the schema it was built into
+FastFeed.checksum = [x.get_checksum() for x in (FastRegion, FastChannel, FastMember, FastProgramme, FastToken)]
+
+database.tables.extend([FastFeed, FastRegion, FastChannel, FastMember, FastProgramme, FastToken])
+
+def timestamp(value):
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    match = ISO_PATTERN.match(value)
+    if match:
+        parts = match.groups()
+        seconds = calendar.timegm([int(x) for x in parts[:6]])
+        offset = parts[6]
+        if offset and offset != 'Z':
+            offset = offset.replace(':', '')
+            seconds -= (1 if offset[0] == '+' else -1) * (int(offset[1:3])*3600 + int(offset[3:5])*60)
+        return seconds
+
+    import arrow
+    return arrow.get(value).timestamp
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class Provider(object):
+    def __init__(self, data_url, check_interval=FAST_CHECK_INTERVAL):
+        self._url = data_url
+        self._check_interval = check_interval
+        self._feed = None
+
+    def update(self, force=False):
+        feed = FastFeed.get_or_none(FastFeed.url == self._url)
+        if feed and not force and int(time.time()) - feed.checked < self._check_interval:
+            self._feed = feed
+            return False
+
+        headers = {'If-None-Match': feed.etag} if feed and feed.etag else {}
+        try:
+            resp = Session().get(self._url, headers=headers)
+            if resp.status_code != 304:
+                resp.raise_for_status()
+        except Exception as e:
+            if not feed:
+                raise
+            # keep serving the last good feed
+            log.debug('FAST: {} update failed ({})'.format(self._url, e))
+            self._feed = feed
+            return False
+
+        rebuild = resp.status_code != 304 or not feed
+        if rebuild:
+            data = json.loads(GzipFile(fileobj=BytesIO(resp.content)).read())
+            feed = self._build(data, resp.headers.get('ETag'))
+        else:
+            feed.checked = int(time.time())
+            feed.save()
+
+        self._feed = feed
+        return rebuild
+
+    def _build(self, data, etag):
+        start = time.time()
+
+        regions = {}
+        channels = {}
+        members = {}
+        programmes = []
+
+        def add_channel(id, channel, region=None):
+            groups = channel.get('groups') or ([channel['group']] if channel.get('group') else [])
+            chno = channel.get('chno')
+
+            # like before, a channel in multiple regions keeps its last seen details
+            if id not in channels:
+                for row in channel.get('programs') or []:
+                    programmes.append({'channel': id, 'start': timestamp(row[0]), 'title': row[1]})
+
+            channels[id] = {
+                'id': id,
+                'chno': chno,
+                'name': channel['name'],
+                'sort_name': channel['name'].strip().lower(),
+                'logo': channel.get('logo'),
+                'art': channel.get('art'),
+                'description': channel.get('description'),
+                'url': channel.get('url'),
+                'url_alt': channel.get('url_alt'),
+                'license_url': channel.get('license_url'),
+                'headers': channel.get('headers'),
+                'region': region or (channel.get('regions') or [None])[0],
+                'groups': groups,
+            }
+
+            # a region keeps its own details, all falls back to the last seen region
+            for code in ([region] if region else channel.get('regions') or []) + [FAST_ALL]:
+                channel_region = channels[id]['region'] if code == FAST_ALL else code
+                for group in groups or ['']:
+                    members[(code, group, id)] = {'region': code, 'group': group, 'channel': id, 'chno': chno, 'groups': groups, 'channel_region': channel_region}
+
+        for code in data.get('regions', {}):
+            region = data['regions'][code]
+            regions[code] = {'code': code, 'name': region['name'], 'logo': region.get('logo'), 'headers': region.get('headers')}
+            for id in region.get('channels', {}):
+                add_channel(id, region['channels'][id], region=code)
+
+        for id in data.get('channels', {}):
+            add_channel(id, data['channels'][id])
+
+        # ALL rows are rewritten so they point at the last seen group of each channel
+        for key in [x for x in members if x[0] == FAST_ALL and x[1] not in (channels[x[2]]['groups'] or [''])]:
+            members.pop(key)
+
+        tokens = set()
+        for channel in channels.values():
+            text = u'{} {} {}'.format(channel['name'], channel['chno'] or '', ' '.join(channel['groups']))
+            for token in tokenize(text):
+                tokens.add((token, channel['id']))
+
+        with database.db.atomic():
+            for model in (FastRegion, FastChannel, FastMember, FastProgramme, FastToken):
+                model.truncate()
+
+            self._insert(FastRegion, regions.values())
+            self._insert(FastChannel, channels.values())
+            self._insert(FastMember, members.values())
+            self._insert(FastProgramme, programmes)
+            self._insert(FastToken, [{'token': x[0], 'channel': x[1]} for x in tokens])
+
+            FastFeed.set(url=self._url, etag=etag, checked=int(time.time()), headers=data.get('headers'))
+
+        log.debug('FAST: Built {} channels / {} programmes in {:.2f}s'.format(len(channels), len(programmes), time.time() - start))
+        return FastFeed.get(FastFeed.url == self._url)
+
+    def _insert(self, model, rows):
+        rows = list(rows)
+        batch_size = max(1, int(999/len(model._meta.fields)))
+        for i in range(0, len(rows), batch_size):
+            model.insert_many(rows[i:i+batch_size]).execute()
+
+    def _ensure(self):
+        # the provider outlives a dispatch with reuselanguageinvoker.
+        # update() re-reads the feed row so a rebuild by another process is picked up
+        if self._feed is None or int(time.time()) - self._feed.checked >= self._check_interval:
+            self.update()
+
+    def _scope(self, region, ids=None):
+        # my channels is all channels filtered to the users favourites
+        if region == FAST_MY_CHANNELS:
+            favourites = self.favourites()
+            ids = favourites if ids is None else [x for x in ids if x in favourites]
+            region = FAST_ALL
+
+        query = FastMember.region == region
+        if ids is not None:
+            query &= FastMember.channel.in_(ids)
+
+        return query
+
+    def favourites(self):
+        return userdata.get('favourites') or []
+
+    def add_favourite(self, id):
+        favourites = self.favourites()
+        if id not in favourites:
+            favourites.append(id)
+            userdata.set('favourites', favourites)
+
+    def del_favourite(self, id):
+        favourites = self.favourites()
+        if id in favourites:
+            favourites.remove(id)
+            userdata.set('favourites', favourites)
+
+    def headers(self, channel=None):
+        self._ensure()
+        headers = dict(self._feed.headers or {})
+        if channel:
+            region = FastRegion.get_or_none(FastRegion.code == channel['region'])
+            if region:
+                headers.update(region.headers or {})
+            headers.update(channel['headers'] or {})
+        return headers
+
+    def regions(self):
+        self._ensure()
+        count = peewee.fn.COUNT(peewee.fn.DISTINCT(FastMember.channel))
+        counts = dict(FastMember.select(FastMember.region, count).group_by(FastMember.region).tuples())
+
+        regions = []
+        for region in FastRegion.select().dicts():
+            region['count'] = counts.get(region['code'], 0)
+            regions.append(region)
+
+        return sorted(regions, key=lambda x: x['name'])
+
+    def region(self, code):
+        self._ensure()
+        return FastRegion.select().where(FastRegion.code == code).dicts().first()
+
+    def count(self, region=FAST_ALL):
+        self._ensure()
+        return FastMember.select(peewee.fn.COUNT(peewee.fn.DISTINCT(FastMember.channel))).where(self._scope(region)).scalar()
+
+    def groups(self, region=FAST_ALL):
+        """(group, channel count) in name order"""
+        self._ensure()
+        return list(FastMember.select(FastMember.group, peewee.fn.COUNT(FastMember.channel))
+            .where(self._scope(region) & (FastMember.group != '')).group_by(FastMember.group).order_by(FastMember.group).tuples())
+
+    def channel(self, id):
+        self._ensure()
+        return FastChannel.select().where(FastChannel.id == id).dicts().first()
+
+    def channels(self, region=FAST_ALL, group=None, order_by='chno', where=None):
+        self._ensure()
+        # chno, groups and region come from the member row as they can differ between regions
+        fields = [x for x in FastChannel._meta.sorted_fields if x.name not in ('chno', 'groups', 'region')]
+        query = (FastMember.select(FastMember.chno, FastMember.groups, FastMember.channel_region.alias('region'), FastRegion.name.alias('region_name'), *fields)
+            .join(FastChannel, on=(FastChannel.id == FastMember.channel))
+            .join(FastRegion, peewee.JOIN.LEFT_OUTER, on=(FastRegion.code == FastMember.channel_region))
+            .where(self._scope(region)))
+
+        if group and group != FAST_ALL:
+            query = query.where(FastMember.group == group)
+
+        if where is not None:
+            query = query.where(where)
+
+        if order_by == 'chno':
+            query = query.order_by(FastMember.chno, FastChannel.sort_name)
+        else:
+            query = query.order_by(FastChannel.sort_name)
+
+        # a channel has a row per group
+        seen = set()
+        for channel in query.dicts():
+            if channel['id'] not in seen:
+                seen.add(channel['id'])
+                yield channel
+
+    def search(self, query, order_by='chno'):
+        where = None
+        for token in tokenize(query):
+            # prefix match on the token index, every token has to match
+            matches = FastToken.select(FastToken.channel).where((FastToken.token >= token) & (FastToken.token < token + u'\uffff'))
+            expr = FastMember.channel.in_(matches)
+            where = expr if where is None else where & expr
+
+        if where is None:
+            return []
+
+        return self.channels(where=where, order_by=order_by)
+
+    def programmes(self, ids, count=5, now=None):
+        """Current and upcoming (start, title) per channel id. start is epoch seconds"""
+        self._ensure()
+        now = int(now or time.time())
+        ids = list(ids)
+
+        current = {}
+        for i in range(0, len(ids), FAST_IN_BATCH):
+            current.update(FastProgramme.select(FastProgramme.channel, peewee.fn.MAX(FastProgramme.start))
+                .where(FastProgramme.channel.in_(ids[i:i+FAST_IN_BATCH]) & (FastProgramme.start <= now)).group_by(FastProgramme.channel).tuples())
+
+        programmes = {}
+        for id in ids:
+            rows = list(FastProgramme.select(FastProgramme.start, FastProgramme.title)
+                .where((FastProgramme.channel == id) & (FastProgramme.start >= current.get(id, now)))
+                .order_by(FastProgramme.start).limit(count+1).tuples())
+
+            # the last programme has no next start so is given an hour
+            if len(rows) == 1 and rows[0][0] + 3600 <= now:
+                rows = []
+
+            programmes[id] = rows[:count]
+
+        return programmes
+
+    def playlist(self, regions, order_by='chno'):
+        """Channels from each region in order, each channel only once"""
+        added = set()
+        for code in regions:
+            for channel in self.channels(region=code, order_by=order_by):
+                if channel['id'] in added:
+                    continue
+
+                added.add(channel['id'])
+                channel['playlist_region'] = code
+                yield channel
+
+def format_time(seconds):
+    value = time.localtime(seconds)
+    return u'{}:{:02d}{}'.format(value.tm_hour % 12 or 12, value.tm_min, 'am' if value.tm_hour < 12 else 'pm')
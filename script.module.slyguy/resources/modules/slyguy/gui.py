@@ -13,7 +13,6 @@ from .router import add_url_args
 from .language import _
 from .smart_urls import get_dns_rewrites
 from .util import fix_url, set_kodi_string, hash_6, get_url_headers, get_headers_from_url
-from .session import Session
 
 
 if KODI_VERSION >= 20:
@@ -390,6 +389,7 @@ class Item(object):
         def redirect_url(url):
             parse = urlparse(url.lower())
             if parse.netloc in REDIRECT_HOSTS and is_http(url):
+                from .session import Session
                 url = Session().head(url).headers.get('location') or url
             return url
 
@@ -519,6 +519,8 @@ class Item(object):
                     'ec3': settings.common_settings.getBool('ec3', False),
                     'verify': settings.common_settings.getBool('verify_ssl', True),
                     'timeout': settings.common_settings.getInt('http_timeout', 30),
+                    'adaptive_chunks': settings.common_settings.getBool('adaptive_chunks', True),
+                    'prefetch_segments': settings.common_settings.getInt('prefetch_segments', 0),
                     'dns_rewrites': get_dns_rewrites(self.dns_rewrites),
                     'proxy_server': settings.get('proxy_server') or settings.common_settings.get('proxy_server'),
                     'max_width': settings.common_settings.getInt('max_width', 0),
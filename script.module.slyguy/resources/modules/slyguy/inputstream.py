@@ -9,7 +9,6 @@ from kodi_six import xbmc
 
 from . import gui, settings
 from .settings import common_settings
-from .session import Session
 from .log import log
 from .constants import *
 from .language import _
@@ -246,6 +245,7 @@ def install_widevine(reinstall=False):
 
     ## DO INSTALL ##
     log.debug('Downloading wv versions: {}'.format(IA_MODULES_URL))
+    from .session import Session
     with Session() as session:
         widevine = session.gz_json(IA_MODULES_URL)['widevine']
     wv_versions = widevine['platforms'].get(system + arch, [])
@@ -331,6 +331,7 @@ def _download(url, dst_path, md5=None):
 
     tmp_path = dst_path + '.downloading'
     with gui.progress(_(_.IA_DOWNLOADING_FILE, url=filename), heading=_.IA_WIDEVINE_DRM) as progress:
+        from .session import Session
         with Session() as session:
             resp = session.get(url, stream=True)
             if resp.status_code != 200:
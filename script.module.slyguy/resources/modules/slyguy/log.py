@@ -1,8 +1,14 @@
+import atexit
 import logging
+import threading
 
+from six.moves import queue
 from kodi_six import xbmc
 
-from .constants import LOG_ID, LOG_FORMAT
+from .constants import LOG_ID, LOG_FORMAT, COMMON_ADDON, ADDON_DEV, LOG_SUBSYSTEMS, LOG_REFRESH_INTERVAL
+
+# common setting enum index -> level. default (0) inherits from the addon logger
+SUBSYSTEM_LEVELS = [logging.NOTSET, logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR]
 
 class Logger(logging.Logger):
     def __call__(self, *args, **kwargs):
@@ -23,13 +29,88 @@ class LoggerHandler(logging.StreamHandler):
         level = self.LEVELS.get(record.levelno, xbmc.LOGDEBUG)
         xbmc.log(msg, level)
 
+class QueueHandler(LoggerHandler):
+    """Callers only pay for a queue put, %-style args are formatted on the writer thread"""
+    def __init__(self):
+        super(QueueHandler, self).__init__()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def emit(self, record):
+        if self._thread is None:
+            self._start()
+
+        if record.exc_info:
+            # traceback objects can't wait for the writer thread
+            self.format(record)
+            record.exc_info = None
+
+        self._queue.put(record)
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=LOG_REFRESH_INTERVAL)
+            except queue.Empty:
+                refresh()
+                continue
+
+            if record is None:
+                break
+
+            try:
+                super(QueueHandler, self).emit(record)
+            except:
+                self.handleError(record)
+
+    def flush(self):
+        # drain and stop the writer. Kodi ends the interpreter once the script returns
+        with self._thread_lock:
+            if self._thread is None:
+                return
+
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+def _debug_enabled():
+    return ADDON_DEV or bool(xbmc.getCondVisibility('System.GetBool(debug.showloginfo)'))
+
+def get_logger(subsystem):
+    return log.getChild(subsystem)
+
+def refresh():
+    # debug records are dropped by Kodi when debug logging is off, so don't format them
+    level = logging.DEBUG if _debug_enabled() else logging.INFO
+    log.setLevel(level)
+
+    for subsystem in LOG_SUBSYSTEMS:
+        try: index = int(COMMON_ADDON.getSetting('log_level_{}'.format(subsystem)) or 0)
+        except ValueError: index = 0
+
+        sub_level = SUBSYSTEM_LEVELS[index] if 0 < index < len(SUBSYSTEM_LEVELS) else logging.NOTSET
+        get_logger(subsystem).setLevel(max(sub_level, level) if sub_level else logging.NOTSET)
+
+def flush():
+    handler.flush()
+
 logging.setLoggerClass(Logger)
 
 formatter = logging.Formatter(LOG_FORMAT)
 
-handler = LoggerHandler()
+handler = QueueHandler() if COMMON_ADDON.getSetting('log_async') == 'true' else LoggerHandler()
 handler.setFormatter(formatter)
 
 log = logging.getLogger(LOG_ID)
 log.handlers = [handler]
-log.setLevel(logging.DEBUG)
+refresh()
+
+atexit.register(flush)
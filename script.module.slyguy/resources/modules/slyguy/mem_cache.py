@@ -1,72 +1,79 @@
 import sys
 from time import time
 from functools import wraps
-from copy import deepcopy
 
 from six.moves import cPickle
 
 from . import signals, router
-from .log import log
-from .util import hash_6, set_kodi_string, get_kodi_string
+from .log import get_logger
+from .util import hash_6, set_kodi_string, get_kodi_string, MemoryCache, background_refresh
 from .constants import ADDON_ID, CACHE_EXPIRY, ROUTE_CLEAR_CACHE, ADDON_VERSION
 from .settings import common_settings as settings
 
-cache_key = 'cache.'+ADDON_ID+ADDON_VERSION
+log = get_logger('cache')
 
-class Cache(object):
-    data = {}
+cache_key = 'cache.'+ADDON_ID+ADDON_VERSION
 
-cache = Cache()
+cache = MemoryCache()
+_persisted = ['']
 
 @signals.on(signals.BEFORE_DISPATCH)
 def load():
-    if not cache.data and settings.getBool('persist_cache', True):
-        cache.data = {}
+    if not settings.getBool('persist_cache', True):
+        return
 
-        try:
-            data = get_kodi_string(cache_key)
-            cache.data = cPickle.loads(data.encode('latin1'))
-        except Exception as e:
-            log.debug('load cache failed')
-        else:
-            log.debug('Cache data loaded')
+    # cache stays loaded between dispatches (reuselanguageinvoker)
+    # only reload if another process has persisted since
+    data = get_kodi_string(cache_key)
+    if data == _persisted[0]:
+        return
 
-        set_kodi_string(cache_key, "{}")
+    _persisted[0] = data
+    try:
+        cache.loads(data)
+    except Exception as e:
+        log.debug('load cache failed')
+        cache.clear()
+    else:
+        log.debug('Cache data loaded')
 
-def set(key, value, expires=CACHE_EXPIRY):
+def set(key, value, expires=CACHE_EXPIRY, hard_expires=None):
     if expires == 0:
         return
 
     elif expires != None:
         expires = int(time() + expires)
 
-    log('Cache Set: {}'.format(key))
-    cache.data[key] = [deepcopy(value), expires]
+    # value is served stale (and refreshed) between expires and hard_expires
+    soft_expires = None
+    if hard_expires != None and expires != None:
+        soft_expires, expires = expires, int(time() + hard_expires)
+
+    log('Cache Set: %s', key)
+    cache.set(key, value, expires, soft_expires)
 
 def get(key, default=None):
-    try:
-        row = cache.data[key]
-    except KeyError:
-        return default
+    return get_stale(key, default)[0]
 
-    if row[1] != None and row[1] < time():
-        cache.data.pop(key, None)
-        return default
-    else:
-        log('Cache Hit: {}'.format(key))
-        return deepcopy(row[0])
+def get_stale(key, default=None):
+    value, stale = cache.get_stale(key, default)
+    if value is not default:
+        log('Cache %s: %s', 'Stale' if stale else 'Hit', key)
+    return value, stale
 
 def delete(key):
-    if int(cache.data.pop(key, None) != None):
-        log('Cache Delete: {}'.format(key))
+    if cache.delete(key):
+        log('Cache Delete: %s', key)
         return True
     return False
 
 def empty():
-    deleted = len(cache.data)
-    cache.data.clear()
+    deleted = cache.clear()
     log('Mem Cache: Deleted {} Rows'.format(deleted))
 
+def stats():
+    return cache.stats()
+
 def key_for(f, *args, **kwargs):
     func_name = f.__name__ if callable(f) else f
     return _build_key(func_name, *args, **kwargs)
@@ -99,7 +106,7 @@ def _build_key(func_name, *args, **kwargs):
     return hash_6(key)
 
 def cached(*args, **kwargs):
-    def decorator(f, expires=CACHE_EXPIRY, key=None):
+    def decorator(f, expires=CACHE_EXPIRY, key=None, hard_expires=None):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or kwargs.pop('_cache_key', None) or _build_key(f.__name__, *args, **kwargs)
@@ -107,14 +114,15 @@ def cached(*args, **kwargs):
                 _key = _key(*args, **kwargs)
 
             if not kwargs.pop('_skip_cache', False):
-                value = get(_key)
+                value, stale = get_stale(_key)
                 if value != None:
-                    log('Cache Hit: {}'.format(_key))
+                    if stale:
+                        background_refresh(_key, lambda: _refresh(_key, f, args, kwargs, expires, hard_expires))
                     return value
 
             value = f(*args, **kwargs)
             if value != None:
-                set(_key, value, expires)
+                set(_key, value, expires, hard_expires)
 
             return value
 
@@ -122,24 +130,25 @@ def cached(*args, **kwargs):
 
     return lambda f: decorator(f, *args, **kwargs)
 
+def _refresh(key, f, args, kwargs, expires, hard_expires):
+    value = f(*args, **kwargs)
+    if value != None:
+        set(key, value, expires, hard_expires)
+        _persist()
+
 @signals.on(signals.AFTER_DISPATCH)
 def remove_expired():
-    _time = time()
-    delete  = []
-
-    for key in cache.data.keys():
-        if cache.data[key][1] < _time:
-            delete.append(key)
-
-    for key in delete:
-        cache.data.pop(key, None)
+    deleted = cache.remove_expired()
+    if deleted:
+        log('Mem Cache: Deleted {} Expired Rows'.format(deleted))
 
-    if delete:
-        log('Mem Cache: Deleted {} Expired Rows'.format(len(delete)))
+    log.debug('Mem Cache: {}'.format(cache.stats()))
+    _persist()
 
-    if settings.getBool('persist_cache', True):
-        set_kodi_string(cache_key, cPickle.dumps(cache.data, protocol=0).decode('latin1'))
-        cache.data.clear()
+def _persist():
+    if cache.dirty and settings.getBool('persist_cache', True):
+        _persisted[0] = cache.dumps()
+        set_kodi_string(cache_key, _persisted[0])
 
 @router.route(ROUTE_CLEAR_CACHE)
 def clear_cache(key, **kwargs):
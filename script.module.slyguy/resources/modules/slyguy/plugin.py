@@ -11,7 +11,7 @@ from kodi_six import xbmc, xbmcplugin
 
 from . import router, gui, settings, userdata, inputstream, signals, migrate, bookmarks, mem_cache
 from .constants import *
-from .log import log
+from .log import log, flush as flush_log
 from .language import _
 from .exceptions import Error, PluginError, CancelDialog
 from .util import set_kodi_string, get_addon, remove_file, user_country
@@ -369,6 +369,7 @@ def reboot():
 @signals.on(signals.AFTER_DISPATCH)
 def _close():
     signals.emit(signals.ON_CLOSE)
+    flush_log()
 
 @route(ROUTE_SETTINGS)
 def _settings(**kwargs):
@@ -0,0 +1,83 @@
+import sys
+import time
+
+from six.moves import builtins
+
+from .log import log
+from .constants import COMMON_ADDON, ADDON_DEV, STARTUP_BUDGET, PROFILER_TOP_MODULES
+
+_state = {}
+
+def enabled():
+    return ADDON_DEV or COMMON_ADDON.getSetting('startup_profiler') == 'true'
+
+def start():
+    if _state or not enabled():
+        return
+
+    _state.update({
+        'start': time.time(),
+        'import': builtins.__import__,
+        'modules': {},
+        'stack': [],
+    })
+    builtins.__import__ = _import
+
+    from . import signals
+    signals.on(signals.AFTER_DISPATCH)(report)
+
+def _import(name, globals=None, locals=None, fromlist=(), level=0):
+    _import_func = _state['import']
+
+    module_name = name
+    if level and level > 0 and globals:
+        package = globals.get('__package__') or globals.get('__name__', '')
+        package = package.rsplit('.', level-1)[0]
+        module_name = package + '.' + name if name else package
+
+    # "from . import x" loads x as a submodule of an already loaded package
+    names = [module_name] + ['{}.{}'.format(module_name, x) for x in (fromlist or []) if x != '*']
+    names = [x for x in names if x not in sys.modules]
+    if not names:
+        return _import_func(name, globals, locals, fromlist, level)
+
+    stack = _state['stack']
+    stack.append(0)
+    start = time.time()
+    try:
+        return _import_func(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        loaded = [x for x in names if x in sys.modules]
+        if loaded:
+            # self time, nested imports are counted against their own module
+            key = ', '.join(loaded)
+            _state['modules'][key] = _state['modules'].get(key, 0) + (elapsed - children)
+
+def stop():
+    if not _state:
+        return
+
+    builtins.__import__ = _state['import']
+    _state.clear()
+
+def report():
+    if not _state:
+        return
+
+    total = time.time() - _state['start']
+    modules = _state['modules']
+    import_time = sum(modules.values())
+    stop()
+
+    top = sorted(modules.items(), key=lambda x: x[1], reverse=True)[:PROFILER_TOP_MODULES]
+    log.info('Startup Profiler: dispatch {:.3f}s, imports {:.3f}s ({} modules)'.format(total, import_time, len(modules)))
+    for module_name, seconds in top:
+        log.info('Startup Profiler: {:.3f}s {}'.format(seconds, module_name))
+
+    if total > STARTUP_BUDGET:
+        log.warning('Startup Profiler: dispatch took {:.3f}s which is over the {:.3f}s budget'.format(total, STARTUP_BUDGET))
@@ -53,7 +53,7 @@ def parse_url(url):
     if not function:
         raise RouterError(_(_.ROUTER_NO_FUNCTION, raw_url=url, parsed_url=path))
 
-    log('Router Parsed: \'{0}\' => {1} {2}'.format(url, function.__name__, params))
+    log('Router Parsed: \'%s\' => %s %s', url, function.__name__, params)
 
     return function, params
 
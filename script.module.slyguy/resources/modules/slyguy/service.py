@@ -3,11 +3,14 @@ import random
 
 from kodi_six import xbmc
 
-from . import settings
+from . import settings, profiler
+from .log import refresh as refresh_log
 from .router import url_for
 from .constants import ROUTE_SERVICE, ROUTE_SERVICE_INTERVAL
 
 def run(interval=ROUTE_SERVICE_INTERVAL):
+    profiler.report()
+
     url = url_for(ROUTE_SERVICE)
     cmd = 'RunPlugin({0})'.format(url)
     last_run = 0
@@ -22,4 +25,7 @@ def run(interval=ROUTE_SERVICE_INTERVAL):
             xbmc.executebuiltin(cmd)
             last_run = time.time()
             
-        monitor.waitForAbort(random.randint(5, 20))
\ No newline at end of file
+        monitor.waitForAbort(random.randint(5, 20))
+
+        # pick up kodi debug logging being toggled
+        refresh_log()
\ No newline at end of file
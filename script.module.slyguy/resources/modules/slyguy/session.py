@@ -4,6 +4,8 @@ import shutil
 import re
 import ssl
 import os
+import threading
+import time
 from gzip import GzipFile
 
 import requests
@@ -12,21 +14,22 @@ import six
 from urllib3.util.connection import allowed_gai_family, _set_socket_options
 from urllib3.exceptions import LocationParseError, ConnectTimeoutError, NewConnectionError
 from urllib3.connection import HTTPSConnection, HTTPConnection
-from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from socket import error as SocketError
 from socket import timeout as SocketTimeout
 from six import BytesIO
 from six.moves.urllib_parse import urlparse
 from kodi_six import xbmc
-import dns.resolver
 
-from . import userdata, settings, signals, mem_cache
-from .util import get_kodi_proxy
+from . import userdata, settings, signals, dns_cache
+from .util import get_kodi_proxy, LRUCache
 from .smart_urls import get_dns_rewrites
-from .log import log
+from .log import get_logger
 from .language import _
 from .exceptions import SessionError, Error
-from .constants import DEFAULT_USERAGENT, CHUNK_SIZE, KODI_VERSION
+from .constants import DEFAULT_USERAGENT, CHUNK_SIZE, KODI_VERSION, POOL_CONNECTIONS, POOL_MAXSIZE, POOL_IDLE_TIMEOUT, REWRITE_CACHE_SIZE
+
+log = get_logger('session')
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -41,7 +44,8 @@ DEFAULT_HEADERS = {
 
 SSL_CIPHERS = 'ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-RSA-AES256-GCM-SHA384:ECDHE-RSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES128-SHA:ECDHE-ECDSA-AES256-SHA:ECDHE-RSA-AES128-SHA:ECDHE-RSA-AES256-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:AES128-SHA:AES256-SHA'
 SSL_OPTIONS = ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
-DNS_CACHE = dns.resolver.Cache()
+DNS_CACHE = []
+HOST_PATTERN = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)*$')
 
 
 def json_override(func, error_msg):
@@ -58,6 +62,14 @@ def close_sessions():
         session.close()
 
 
+class DNSResultWrapper(object):
+    def __init__(self, answer):
+        self.answer = answer
+
+    def to_text(self):
+        return self.answer
+
+
 class DOHResolver(object):
     def __init__(self, adapter, nameservers=None):
         self._adapter = adapter
@@ -65,50 +77,61 @@ class DOHResolver(object):
         self._session = RawSession()
 
     def query(self, host):
-        class DNSResultWrapper(object):
-            def __init__(self, answer):
-                self.answer = answer
+        for server in self.nameservers:
+            ips = dns_cache.resolve('{} {}'.format(server, host), lambda server=server: self._query(server, host))
+            if ips:
+                return [DNSResultWrapper(ip) for ip in ips]
 
-            def to_text(self):
-                return self.answer
+        raise SessionError('Unable to resolve host: {} with nameservers: {}'.format(host, self.nameservers))
 
-        for server in self.nameservers:
-            key = (server, host)
-            ips = mem_cache.get(key)
+    def _query(self, server, host):
+        headers = {'accept': 'application/dns-json'}
 
-            if not ips:
-                headers = {'accept': 'application/dns-json'}
+        server_host = urlparse(server).hostname
+        info = self._adapter.getaddrinfo(server_host, 443 if server.lower().startswith('https') else 80)
+        families = [x[0] for x in info]
 
-                server_host = urlparse(server).netloc.lower()
-                info = self._adapter.getaddrinfo(server_host, 443 if server.lower().startswith('https') else 80)
-                families = [x[0] for x in info]
+        params = {'name': host, 'dns': host}
 
-                params = {'name': host, 'dns': host}
+        # prefer IPV4
+        if socket.AF_INET in families or socket.AF_INET6 not in families:
+            params['type'] = 'A'
+        else:
+            params['type'] = 'AAAA'
 
-                # prefer IPV4
-                if socket.AF_INET in families or socket.AF_INET6 not in families:
-                    params['type'] = 'A'
-                else:
-                    params['type'] = 'AAAA'
+        log.debug("DOH Request: %s for %s type %s", server, host, params['type'])
+        data = self._session.get(server, params=params, headers=headers).json()
 
-                log.debug("DOH Request: {} for {} type {}".format(server, host, params['type']))
+        suitable = [x for x in data['Answer'] if x['type'] in (1, 28)] #ipv4 or ipv6
+        ttl = min([x['TTL'] for x in suitable])
+        ips = [x['data'] for x in suitable]
+        return ips, ttl
 
-                try:
-                    data = self._session.get(server, params=params, headers=headers).json()
-                except Exception as e:
-                    log.debug(e)
-                    continue
 
-                suitable = [x for x in data['Answer'] if x['type'] in (1, 28)] #ipv4 or ipv6
-                ttl = min([x['TTL'] for x in suitable])
-                ips = [x['data'] for x in suitable]
-                mem_cache.set(key, ips, expires=ttl)
+class DNSResolver(object):
+    def __init__(self):
+        # dnspython is only loaded once a rule needs a nameserver
+        import dns.resolver
 
-            if ips:
-                return [DNSResultWrapper(ip) for ip in ips]
+        if not DNS_CACHE:
+            DNS_CACHE.append(dns.resolver.Cache())
+
+        self._resolver = dns.resolver.Resolver(configure=False)
+        self._resolver.cache = DNS_CACHE[0]
+        self.nameservers = []
+
+    def query(self, host):
+        ips = dns_cache.resolve('{} {}'.format(','.join(self.nameservers), host), lambda: self._query(host))
+        if ips:
+            return [DNSResultWrapper(ip) for ip in ips]
 
         raise SessionError('Unable to resolve host: {} with nameservers: {}'.format(host, self.nameservers))
 
+    def _query(self, host):
+        self._resolver.nameservers = self.nameservers
+        answer = self._resolver.query(host)
+        return [x.to_text() for x in answer], answer.rrset.ttl
+
 
 class RequestsDoHHTTPConnection(HTTPConnection):
     def __init__(self, *args, **kw):
@@ -189,14 +212,53 @@ class RequestsDoHHTTPSConnection(RequestsDoHHTTPConnection, HTTPSConnection):
         return retval
 
 
+class IdleCheckMixin(object):
+    # urllib3 only drops pooled sockets the server has already closed.
+    # Also drop ones that have been idle long enough for the server / nat to have silently forgotten them
+    def _get_conn(self, timeout=None):
+        conn = super(IdleCheckMixin, self)._get_conn(timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if conn.sock and idle_since and time.time() - idle_since > POOL_IDLE_TIMEOUT:
+            log.debug('Dropping idle connection: %s', self.host)
+            conn.close()
+        return conn
+
+    def _put_conn(self, conn):
+        if conn:
+            conn.idle_since = time.time()
+        return super(IdleCheckMixin, self)._put_conn(conn)
+
+
+class IdleCheckHTTPConnectionPool(IdleCheckMixin, HTTPConnectionPool):
+    pass
+
+
+class IdleCheckHTTPSConnectionPool(IdleCheckMixin, HTTPSConnectionPool):
+    pass
+
+
 class SessionAdapter(requests.adapters.HTTPAdapter):
-    def __init__(self):
-        self.session_data = {}
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+        # session_data is per thread as the proxy shares a session between threads
+        self._local = threading.local()
         self._context_cache = {}
-        super(SessionAdapter, self).__init__()
+        super(SessionAdapter, self).__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    @property
+    def session_data(self):
+        try:
+            return self._local.session_data
+        except AttributeError:
+            # thread that hasn't made a request through us (eg. DoH background refresh)
+            self._local.session_data = {'ssl_ciphers': None, 'ssl_options': None, 'proxy': None, 'interface_ip': None, 'rewrite': None, 'resolver': None}
+            return self._local.session_data
+
+    @session_data.setter
+    def session_data(self, session_data):
+        self._local.session_data = session_data
 
     def on_connect(self, https_connection):
-        log.debug('SSL Cipher: {} - {}'.format(https_connection.sock.server_hostname, https_connection.sock.cipher()))
+        log.debug('SSL Cipher: %s - %s', https_connection.sock.server_hostname, https_connection.sock.cipher())
 
     def connection_from_pool_key(self, pool_key, request_context):
         if self.session_data['ssl_ciphers'] or self.session_data['ssl_options']:
@@ -223,12 +285,12 @@ class SessionAdapter(requests.adapters.HTTPAdapter):
 
         if self.session_data['rewrite'] and self.session_data['rewrite'][0] == host:
             host = self.session_data['rewrite'][1]
-            log.debug("DNS Rewrite: {} -> {}".format(orig_host, host))
+            log.debug("DNS Rewrite: %s -> %s", orig_host, host)
 
         elif self.session_data['resolver'] and self.session_data['resolver'][0] == host:
             try:
                 host = self.session_data['resolver'][1].query(host)[0].to_text()
-                log.debug('DNS Resolver: {} -> {} -> {}'.format(orig_host, self.session_data['resolver'][1].nameservers[0], host))
+                log.debug('DNS Resolver: %s -> %s -> %s', orig_host, self.session_data['resolver'][1].nameservers[0], host)
             except Exception as e:
                 log.exception(e)
                 log.error('Failed to resolve. Falling back to dns lookup')
@@ -249,7 +311,7 @@ class SessionAdapter(requests.adapters.HTTPAdapter):
                 raise
 
         if addresses[0][4][0] != host:
-            log.debug('DNS Resolver: {} -> {}'.format(host, addresses[0][4][0]))
+            log.debug('DNS Resolver: %s -> %s', host, addresses[0][4][0])
 
         return addresses
 
@@ -257,6 +319,7 @@ class SessionAdapter(requests.adapters.HTTPAdapter):
         super(SessionAdapter, self).init_poolmanager(*args, **kwargs)
         self.poolmanager._connection_from_pool_key = self.poolmanager.connection_from_pool_key
         self.poolmanager.connection_from_pool_key = self.connection_from_pool_key
+        self.poolmanager.pool_classes_by_scheme = {'http': IdleCheckHTTPConnectionPool, 'https': IdleCheckHTTPSConnectionPool}
 
     def get_connection(self, url, proxies=None):
         conn = super(SessionAdapter, self).get_connection(url, proxies)
@@ -268,13 +331,104 @@ class SessionAdapter(requests.adapters.HTTPAdapter):
         return conn
 
 
+class RewriteRule(object):
+    __slots__ = ('index', 'pattern', 'url_sub', 'proxy', 'interface_ip', 'dns', 'nameserver')
+
+    def __init__(self, index, pattern, entries):
+        self.index = index
+        self.pattern = re.compile(re.escape(pattern).replace('\\*', '.*'), flags=re.IGNORECASE)
+        self.url_sub = None
+        self.proxy = None
+        self.interface_ip = None
+        self.dns = None
+        self.nameserver = None
+
+        # dns is applied last so it uses the host from any url_sub
+        for _type, entry in entries:
+            if _type == 'url_sub':
+                self.url_sub = entry
+            elif _type == 'proxy':
+                self.proxy = entry
+            elif _type == 'interface_ip':
+                self.interface_ip = entry
+            elif _type == 'dns':
+                self.dns, self.nameserver = entry, None
+            elif _type == 'resolver' and entry and not self.dns:
+                self.nameserver = entry
+
+
+class RewriteRules(object):
+    """Finds the first rewrite rule (in the order they were added) that matches a url.
+
+    Plain host patterns (dai.google.com) match that host and its sub domains and wildcard
+    host patterns (*.akamaized.net) match any sub domain. These are looked up by host
+    in a dict / suffix trie. Any other pattern, including a plain word without a dot (akamaized),
+    falls back to a regex search of the full url.
+    """
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._fallback = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, entries):
+        rule = RewriteRule(self._count, pattern, entries)
+        self._count += 1
+
+        host = pattern.lower()
+        wildcard = host.startswith('*.')
+        if wildcard:
+            host = host[2:]
+
+        # a plain word (akamaized) can match anywhere in the url, not just a whole host
+        if not host or not HOST_PATTERN.match(host) or (not wildcard and '.' not in host):
+            self._fallback.append(rule)
+            return
+
+        if not wildcard:
+            self._exact.setdefault(host, []).append(rule)
+
+        node = self._trie
+        for label in reversed(host.split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(rule)
+
+    def match_host(self, host):
+        host = host.lower()
+        matches = list(self._exact.get(host, []))
+
+        labels = host.split('.')
+        node = self._trie
+        for i in range(len(labels)-1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                break
+            matches.extend(node.get(None, []))
+
+        return min(matches, key=lambda rule: rule.index) if matches else None
+
+    def match_fallback(self, url, rule=None):
+        for fallback in self._fallback:
+            if rule and fallback.index > rule.index:
+                break
+
+            if fallback.pattern.search(url):
+                return fallback
+
+        return rule
+
+
 class RawSession(requests.Session):
-    def __init__(self, verify=None, timeout=None, auto_close=True, ssl_ciphers=SSL_CIPHERS, ssl_options=SSL_OPTIONS, proxy=None):
+    def __init__(self, verify=None, timeout=None, auto_close=True, ssl_ciphers=SSL_CIPHERS, ssl_options=SSL_OPTIONS, proxy=None, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
         super(RawSession, self).__init__()
         self._verify = verify
         self._timeout = timeout
-        self._rewrites = []
-        self._session_cache = {}
+        self._rewrites = RewriteRules()
+        self._host_cache = LRUCache(REWRITE_CACHE_SIZE)
+        self._resolvers = {}
         self._proxy = proxy
         self._cert = None
         self._ssl_ciphers = ssl_ciphers
@@ -283,18 +437,16 @@ class RawSession(requests.Session):
         if auto_close:
             OPEN_SESSIONS.append(self)
 
-        self._adapter = SessionAdapter()
+        self._adapter = SessionAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
         for prefix in ('http://', 'https://'):
             self.mount(prefix, self._adapter)
 
     def set_dns_rewrites(self, rewrites):
         for entries in rewrites:
-            pattern = entries.pop()
-            pattern = re.escape(pattern).replace('\*', '.*')
-            pattern = re.compile(pattern, flags=re.IGNORECASE)
+            pattern = entries[-1]
 
             new_entries = []
-            for entry in entries:
+            for entry in entries[:-1]:
                 _type = 'skip'
                 if entry.startswith('p:'):
                     _type = 'proxy'
@@ -311,7 +463,9 @@ class RawSession(requests.Session):
                     _type = 'url_sub'
                 new_entries.append([_type, entry])
 
-            self._rewrites.append([pattern, sorted(new_entries, key=lambda x: x[0] == 'dns')])
+            self._rewrites.add(pattern, new_entries)
+
+        self._host_cache.clear()
 
     def set_cert(self, cert):
         self._cert = cert
@@ -351,10 +505,7 @@ class RawSession(requests.Session):
     def __del__(self):
         self.close()
 
-    def request(self, method, url, **kwargs):
-        req = requests.Request(method, url, params=kwargs.pop('params', None))
-        url = req.prepare().url
-
+    def _get_session_data(self, url):
         session_data = {
             'ssl_ciphers': self._ssl_ciphers,
             'ssl_options': self._ssl_options,
@@ -365,37 +516,76 @@ class RawSession(requests.Session):
             'url': url,
         }
 
-        if url in self._session_cache:
-            session_data = self._session_cache[url]
-        elif self._rewrites:
-            for row in self._rewrites:
-                if not row[0].search(url):
-                    continue
+        if not self._rewrites:
+            return session_data
 
-                for entry in row[1]:
-                    if entry[0] == 'skip':
-                        continue
-                    if entry[0] == 'url_sub':
-                        session_data['url'] = re.sub(row[0], entry[1], url, count=1)
-                    elif entry[0] == 'proxy':
-                        session_data['proxy'] = entry[1]
-                    elif entry[0] == 'interface_ip':
-                        session_data['interface_ip'] = entry[1]
-                    elif entry[0] == 'dns':
-                        session_data['rewrite'] = [urlparse(session_data['url']).netloc.lower(), entry[1]]
-                    elif entry[0] == 'resolver' and entry[1]:
-                        if entry[1].lower().startswith('http'):
-                            resolver = DOHResolver(self._adapter)
-                        else:
-                            resolver = dns.resolver.Resolver(configure=False)
-                            resolver.cache = DNS_CACHE
-
-                        resolver.nameservers = [entry[1],]
-                        session_data['resolver'] = [urlparse(session_data['url']).netloc.lower(), resolver]
-                break
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+
+        rule = self._host_cache.get(key, False)
+        if rule is False:
+            rule = self._rewrites.match_host(parsed.hostname or '')
+            self._host_cache.set(key, rule)
+
+        rule = self._rewrites.match_fallback(url, rule)
+        if not rule:
+            return session_data
+
+        if rule.url_sub is not None:
+            session_data['url'] = rule.pattern.sub(rule.url_sub, url, count=1)
+
+        session_data['proxy'] = rule.proxy
+        session_data['interface_ip'] = rule.interface_ip
+
+        if rule.dns or rule.nameserver:
+            host = urlparse(session_data['url']).netloc.lower()
+            if rule.dns:
+                session_data['rewrite'] = [host, rule.dns]
+            else:
+                session_data['resolver'] = [host, self._get_resolver(rule.nameserver)]
+
+        return session_data
 
-            self._session_cache[url] = session_data
+    def _get_resolver(self, nameserver):
+        if nameserver not in self._resolvers:
+            if nameserver.lower().startswith('http'):
+                resolver = DOHResolver(self._adapter)
+            else:
+                resolver = DNSResolver()
+
+            resolver.nameservers = [nameserver,]
+            self._resolvers[nameserver] = resolver
+
+        return self._resolvers[nameserver]
+
+    def warm_up(self, url):
+        # open a connection to the host ahead of time so the first request doesn't pay for the tcp / tls handshake
+        if self._cert:
+            return False
+
+        session_data = self._get_session_data(url)
+        if session_data['proxy'] is None:
+            session_data['proxy'] = self._get_proxy()
+
+        if session_data['proxy']:
+            return False
+
+        self._adapter.session_data = session_data
+        pool = self._adapter.get_connection(session_data['url'])
+        if pool.num_connections:
+            return False
+
+        log.debug('Warm up: %s', pool.host)
+
+        # the kept alive connection is returned to the pool once the response is closed
+        self.request('HEAD', url, allow_redirects=False).close()
+        return True
+
+    def request(self, method, url, **kwargs):
+        req = requests.Request(method, url, params=kwargs.pop('params', None))
+        url = req.prepare().url
 
+        session_data = self._get_session_data(url)
         self._adapter.session_data = session_data
 
         if session_data['url'] != url:
@@ -491,7 +681,7 @@ class Session(RawSession):
             if self.before_request:
                 self.before_request()
 
-            log.debug('{}{} {}'.format(attempt, method, log_url or url))
+            log.debug('%s%s %s', attempt, method, log_url or url)
 
             try:
                 resp = super(Session, self).request(method, url, **kwargs)
@@ -5,7 +5,7 @@ from kodi_six import xbmc, xbmcaddon
 
 from .constants import ADDON, ADDON_ID, COMMON_ADDON
 from . import signals
-from .log import log
+from .log import log, refresh as refresh_log
 from .util import remove_file
 
 @signals.on(signals.BEFORE_DISPATCH)
@@ -15,6 +15,12 @@ def before_dispatch():
     ADDON = xbmcaddon.Addon(ADDON.getAddonInfo('id'))
     check_corrupt(ADDON)
     common_settings.reset()
+    refresh_log()
+
+@signals.on(signals.ON_SETTINGS_CHANGE)
+def settings_changed():
+    # subsystem log levels are common settings, kodi debug logging can change at any time
+    refresh_log()
 
 def open():
     ADDON.openSettings()
@@ -1,6 +1,5 @@
 import os
 
-import requests
 from kodi_six import xbmc, xbmcaddon
 
 from .log import log
@@ -29,6 +28,7 @@ def get_dns_rewrites(dns_rewrites=None, addon_id=ADDON_ID):
 @cached(expires=60*5)
 def _get_url(url):
     log.debug('Request DNS URL: {}'.format(url))
+    import requests
     return requests.get(url).text
 
 def _load_rewrites(addon_id):
@@ -1,56 +1,71 @@
-from . import settings
+import json
+from copy import deepcopy
+
+from . import settings, signals
 from .constants import ADDON, USERDATA_KEY
 
-def _get_data():
-    return settings.getDict(USERDATA_KEY, {})
+def _copy(value):
+    # callers could previously mutate what they got / set without it being saved
+    return deepcopy(value) if isinstance(value, (dict, list)) else value
 
-def get(key, default=None):
-    return _get_data().get(key, default)
+class Userdata(object):
+    """Parsed once and kept while the raw setting is unchanged.
+    When batching, writes are held until commit() and the setting is not re-read"""
+    def __init__(self, _addon=None, _settings=None):
+        self._settings = _settings or settings.Settings(_addon or ADDON)
+        self._batch = False
+        self._reset()
 
-def set(key, value):
-    data = _get_data()
-    data[key] = value
-    _set_data(data)
+    def _reset(self):
+        self._raw = None
+        self._data = None
+        self._dirty = False
 
-def _set_data(data):
-    settings.setDict(USERDATA_KEY, data)
+    def _get_data(self):
+        if self._data is not None and (self._batch or self._dirty):
+            return self._data
 
-def pop(key, default=None):
-    data = _get_data()
-    value = data.pop(key, default)
-    _set_data(data)
-    return value
+        raw = self._settings.get(USERDATA_KEY)
+        if self._data is None or raw != self._raw:
+            try: self._data = json.loads(raw)
+            except: self._data = {}
+            self._raw = raw
 
-def delete(key):
-    data = _get_data()
-    if key in data:
-        del data[key]
-        _set_data(data)
-    
-def clear():
-    _set_data({})
+        return self._data
 
-class Userdata(object):
-    def __init__(self, _addon=None):
-        self._settings = settings.Settings(_addon or ADDON)
+    def _set_data(self, data):
+        self._data = data
+        self._dirty = True
+        if not self._batch:
+            self.commit()
 
-    def _get_data(self):
-        return self._settings.getDict(USERDATA_KEY, {})
+    def commit(self):
+        if not self._dirty:
+            return
+
+        self._raw = json.dumps(self._data, separators=(',', ':'))
+        self._settings.set(USERDATA_KEY, self._raw)
+        self._dirty = False
+
+    def batch(self, enabled=True):
+        self.commit()
+        self._batch = enabled
+        self._reset()
 
     def get(self, key, default=None):
-        return self._get_data().get(key, default)
+        return _copy(self._get_data().get(key, default))
 
     def set(self, key, value):
         data = self._get_data()
-        data[key] = value
+        data[key] = _copy(value)
         self._set_data(data)
 
-    def _set_data(self, data):
-        self._settings.setDict(USERDATA_KEY, data)
-
     def pop(self, key, default=None):
         data = self._get_data()
-        value = data.pop(key, default)
+        if key not in data:
+            return default
+
+        value = data.pop(key)
         self._set_data(data)
         return value
 
@@ -59,6 +74,26 @@ class Userdata(object):
         if key in data:
             del data[key]
             self._set_data(data)
-        
+
     def clear(self):
-        self._set_data({})
\ No newline at end of file
+        self._set_data({})
+
+# the settings module follows the addon object that is refreshed every dispatch
+_userdata = Userdata(_settings=settings)
+
+get = _userdata.get
+set = _userdata.set
+pop = _userdata.pop
+delete = _userdata.delete
+clear = _userdata.clear
+commit = _userdata.commit
+
+@signals.on(signals.BEFORE_DISPATCH)
+def _before_dispatch():
+    _userdata.batch(True)
+
+@signals.on(signals.AFTER_DISPATCH)
+@signals.on(signals.ON_CLOSE)
+def _after_dispatch():
+    # flush before anything else (eg. the settings dialog) can read or overwrite the setting
+    _userdata.batch(False)
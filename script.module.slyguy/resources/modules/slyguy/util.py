@@ -13,14 +13,15 @@ import re
 import threading
 import socket
 import binascii
+import time
 from contextlib import closing
+from collections import OrderedDict
 
 from kodi_six import xbmc, xbmcgui, xbmcaddon, xbmcvfs
-from six.moves import queue, range
+from six.moves import queue, range, cPickle
 from six.moves.urllib.parse import urlparse, urlunparse, quote, parse_qsl
-from requests.models import PreparedRequest
 from six import PY2
-import requests
+import six
 
 if sys.version_info >= (3, 8):
     import html
@@ -47,6 +48,7 @@ def fix_url(url):
     return urlunparse(parse)
 
 def add_url_args(url, params=None):
+    from requests.models import PreparedRequest
     req = PreparedRequest()
     req.prepare_url(url, params)
     return req.url
@@ -160,6 +162,7 @@ def require_country(required=None, _raise=False):
 
 def user_country():
     try:
+        import requests
         country = requests.get('http://ip-api.com/json/?fields=countryCode').json()['countryCode'].upper()
         log.debug('fetched user country: {}'.format(country))
         return country
@@ -348,7 +351,12 @@ def md5sum(filepath):
     if not os.path.exists(filepath):
         return None
 
-    return hashlib.md5(open(filepath,'rb').read()).hexdigest()
+    h = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
 
 ## to find BCOV-POLICY. Open below url
 ## account_id / player_id / videoid can be found by right clicking player and selecting Player Information
@@ -735,3 +743,225 @@ def get_headers_from_url(url):
         headers[key.lower()] = _headers[key]
 
     return headers
+
+class LRUCache(object):
+    def __init__(self, size):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+IMMUTABLE_TYPES = six.string_types + six.integer_types + (six.binary_type, six.text_type, float, bool, type(None))
+
+def _is_immutable(value):
+    if isinstance(value, IMMUTABLE_TYPES):
+        return True
+
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(x) for x in value)
+
+    return False
+
+class MemoryCache(object):
+    """In-process LRU cache that can be bounded by item count and bytes.
+
+    Immutable values are stored and returned as is. Anything else is stored pickled,
+    so callers always get their own copy without the cost of a deepcopy.
+    """
+    def __init__(self, max_items=None, max_bytes=None):
+        self.data = OrderedDict()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.get_stale(key, default)[0]
+
+    def get_stale(self, key, default=None):
+        """Returns (value, stale). stale is True once the soft expiry of the row has passed."""
+        _time = time.time()
+
+        with self._lock:
+            try:
+                row = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default, False
+
+            if row[1] is not None and row[1] < _time:
+                self._size -= row[3]
+                self.dirty = True
+                self.misses += 1
+                return default, False
+
+            self.data[key] = row
+            self.hits += 1
+
+        value = cPickle.loads(row[0]) if row[2] else row[0]
+        return value, row[4] is not None and row[4] < _time
+
+    def set(self, key, value, expires=None, soft_expires=None):
+        if _is_immutable(value):
+            row = [value, expires, False, sys.getsizeof(value), soft_expires]
+        else:
+            data = cPickle.dumps(value, protocol=cPickle.HIGHEST_PROTOCOL)
+            row = [data, expires, True, len(data), soft_expires]
+
+        with self._lock:
+            self._pop(key)
+            self.data[key] = row
+            self._size += row[3]
+            self.dirty = True
+
+            while self.data and ((self.max_items and len(self.data) > self.max_items) or (self.max_bytes and self._size > self.max_bytes)):
+                self._size -= self.data.popitem(last=False)[1][3]
+                self.evictions += 1
+
+    def _pop(self, key):
+        row = self.data.pop(key, None)
+        if row:
+            self._size -= row[3]
+            self.dirty = True
+        return row
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def clear(self):
+        with self._lock:
+            count = len(self.data)
+            if count:
+                self.dirty = True
+            self.data.clear()
+            self._size = 0
+            return count
+
+    def remove_expired(self):
+        _time = time.time()
+        with self._lock:
+            delete = [key for key in self.data if self.data[key][1] is not None and self.data[key][1] < _time]
+            for key in delete:
+                self._pop(key)
+            return len(delete)
+
+    def dumps(self):
+        with self._lock:
+            self.dirty = False
+            return cPickle.dumps(list(self.data.items()), protocol=0).decode('latin1')
+
+    def loads(self, data):
+        rows = cPickle.loads(data.encode('latin1'))
+        if any(len(row) != 5 for key, row in rows):
+            raise ValueError('Unknown cache format')
+
+        with self._lock:
+            self.data = OrderedDict(rows)
+            self._size = sum(row[3] for row in self.data.values())
+            self.dirty = False
+
+    def stats(self):
+        return {'items': len(self.data), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class FileLock(object):
+    """Non-blocking lock shared between Kodi's python processes (O_EXCL create).
+    A lock file older than timeout is treated as abandoned."""
+    def __init__(self, path, timeout=60):
+        self._path = path
+        self._timeout = timeout
+        self._locked = False
+
+    def acquire(self):
+        for attempt in range(2):
+            try:
+                os.close(os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                self._locked = True
+                return True
+            except OSError:
+                try:
+                    if attempt or os.path.getmtime(self._path) > time.time() - self._timeout:
+                        return False
+                    os.remove(self._path)
+                except OSError:
+                    pass
+
+        return False
+
+    def release(self):
+        if self._locked:
+            self._locked = False
+            try: os.remove(self._path)
+            except OSError: pass
+
+_refresh_threads = []
+
+def background_refresh(key, func):
+    """Calls func in a background thread unless another thread / process is already refreshing key.
+    Returns True if the refresh was started."""
+    if not os.path.exists(ADDON_PROFILE):
+        os.makedirs(ADDON_PROFILE)
+
+    lock = FileLock(os.path.join(ADDON_PROFILE, '.refresh_{}.lock'.format(hash_6(key))), timeout=CACHE_LOCK_TIMEOUT)
+    if not lock.acquire():
+        return False
+
+    def refresh():
+        try:
+            func()
+        except Exception as e:
+            log.debug('Background refresh of {} failed: {}'.format(key, e))
+        finally:
+            lock.release()
+
+    # daemon so a short lived plugin process isn't kept alive by a refresh
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    _refresh_threads.append(thread)
+    return True
+
+def wait_background_refresh(timeout):
+    """Waits up to timeout seconds for background refreshes started by this process.
+    Returns True if none are still running."""
+    end = time.time() + timeout
+    for thread in list(_refresh_threads):
+        thread.join(max(0, end - time.time()))
+        if not thread.is_alive():
+            _refresh_threads.remove(thread)
+
+    return not _refresh_threads
@@ -1,13 +1,14 @@
 import codecs
 
-import arrow
-from slyguy import plugin, inputstream, mem_cache, settings, userdata, gui
-from slyguy.session import Session
+from slyguy import plugin, inputstream, settings, userdata, gui
 from slyguy.exceptions import PluginError
+from slyguy.fast_channels import Provider, format_time
 
 from .language import _
 from .constants import *
 
+provider = Provider(DATA_URL)
+
 @plugin.route('')
 def home(**kwargs):
     folder = plugin.Folder()
@@ -25,89 +26,48 @@ def home(**kwargs):
 
 @plugin.route()
 def add_favourite(id, **kwargs):
-    data = _app_data()
-    channel = data['regions'][ALL]['channels'].get(id)
+    channel = provider.channel(id)
     if not channel:
         return
 
-    favourites = userdata.get('favourites') or []
-    if id not in favourites:
-        favourites.append(id)
-
-    userdata.set('favourites', favourites)
+    provider.add_favourite(id)
     gui.notification(_.MY_CHANNEL_ADDED, heading=channel['name'], icon=channel['logo'])
 
 @plugin.route()
 def del_favourite(id, **kwargs):
-    favourites = userdata.get('favourites') or []
-    if id in favourites:
-        favourites.remove(id)
-
-    userdata.set('favourites', favourites)
+    provider.del_favourite(id)
     gui.refresh()
 
-@mem_cache.cached(60*15)
-def _data():
-    return Session().gz_json(DATA_URL)
-
-def _app_data():
-    data = _data()
-
-    favourites = userdata.get('favourites') or []
-    my_channels = {'logo': None, 'name': _.MY_CHANNELS, 'channels': {}, 'sort': 0}
-    all_channels = {'logo': None, 'name':_.ALL, 'channels': {}, 'sort': 1}
-    for key in data['regions']:
-        data['regions'][key]['sort'] = 2
-        for id in data['regions'][key]['channels']:
-            all_channels['channels'][id] = data['regions'][key]['channels'][id]
-            data['regions'][key]['channels'][id]['epg'] = key
-            data['regions'][key]['channels'][id]['region'] = data['regions'][key]['name']
-            if id in favourites:
-                my_channels['channels'][id] = data['regions'][key]['channels'][id]
-
-    data['regions'][ALL] = all_channels
-    data['regions'][MY_CHANNELS] = my_channels
-    return data
-
-def _process_channels(channels, group=ALL, region=ALL):
+def _regions():
+    regions = [{'code': ALL, 'name': _.ALL, 'logo': None, 'count': provider.count()}]
+    return regions + provider.regions()
+
+def _process_channels(channels, region=ALL):
     items = []
 
+    channels = list(channels)
     show_chno = settings.getBool('show_chno', True)
 
     if settings.getBool('show_epg', True):
-        now = arrow.now()
-        epg_count = 5
+        programmes = provider.programmes([x['id'] for x in channels])
     else:
-        epg_count = None
-
-    for id in sorted(channels.keys(), key=lambda x: channels[x]['chno'] if show_chno else channels[x]['name']):
-        channel = channels[id]
-        if group != ALL and channel['group'] != group:
-            continue
+        programmes = None
 
-        plot = u'[B]{} - {}[/B]\n'.format(channel['region'], channel['group'])
-        if not epg_count:
-            plot += channel.get('description', '')
+    for channel in channels:
+        plot = u'[B]{} - {}[/B]\n'.format(channel['region_name'], ' / '.join(channel['groups']))
+        if programmes is None:
+            plot += channel['description'] or ''
         else:
-            count = 0
-            for index, row in enumerate(channel.get('programs', [])):
-                start = arrow.get(row[0])
-                try: stop = arrow.get(channel['programs'][index+1][0])
-                except: stop = start.shift(hours=1)
-
-                if (now > start and now < stop) or start > now:
-                    plot += u'[{}] {}\n'.format(start.to('local').format('h:mma'), row[1])
-                    count += 1
-                    if count == epg_count:
-                        break
+            for start, title in programmes[channel['id']]:
+                plot += u'[{}] {}\n'.format(format_time(start), title)
 
         item = plugin.Item(
             label = u'{} | {}'.format(channel['chno'], channel['name']) if show_chno else channel['name'],
             info = {'plot': plot},
             art = {'thumb': channel['logo']},
             playable = True,
-            path = plugin.url_for(play, id=id, _is_live=True),
-            context = ((_.DEL_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(del_favourite, id=id))),) if region == MY_CHANNELS else ((_.ADD_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(add_favourite, id=id))),),
+            path = plugin.url_for(play, id=channel['id'], _is_live=True),
+            context = ((_.DEL_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(del_favourite, id=channel['id']))),) if region == MY_CHANNELS else ((_.ADD_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(add_favourite, id=channel['id']))),),
         )
         items.append(item)
 
@@ -115,8 +75,6 @@ def _process_channels(channels, group=ALL, region=ALL):
 
 @plugin.route()
 def live_tv(code=None, group=None, **kwargs):
-    data = _app_data()
-
     if not settings.getBool('show_countries', True) and code != MY_CHANNELS:
         code = ALL
 
@@ -125,54 +83,42 @@ def live_tv(code=None, group=None, **kwargs):
 
     if not code:
         folder = plugin.Folder(_.LIVE_TV)
-        data['regions'].pop(MY_CHANNELS)
-        for code in sorted(data['regions'], key=lambda x: (data['regions'][x]['sort'], data['regions'][x]['name'])):
-            region = data['regions'][code]
-            ch_count = len(region['channels'])
-
+        for region in _regions():
             item = plugin.Item(
-                label = _(u'{name} ({count})'.format(name=region['name'], count=ch_count)),
-                art = {'thumb': region.get('logo')},
+                label = _(u'{name} ({count})'.format(name=region['name'], count=region['count'])),
+                art = {'thumb': region['logo']},
                 info = {
-                    'plot': u'{}\n\n{}'.format(region['name'], _(_.CHANNEL_COUNT, count=ch_count)),
+                    'plot': u'{}\n\n{}'.format(region['name'], _(_.CHANNEL_COUNT, count=region['count'])),
                 },
-                path = plugin.url_for(live_tv, code=code),
+                path = plugin.url_for(live_tv, code=region['code']),
             )
 
             folder.add_items(item)
 
         return folder
 
-    region = data['regions'][code]
-    folder = plugin.Folder(region['name'])
-    channels = region['channels']
+    if code in (ALL, MY_CHANNELS):
+        region = {'name': _.ALL if code == ALL else _.MY_CHANNELS, 'logo': None}
+    else:
+        region = provider.region(code)
 
     if group is None:
-        groups = {}
-        all_count = 0
-        for id in channels:
-            channel = channels[id]
-            all_count += 1
-            if channel['group'] not in groups:
-                groups[channel['group']] = 1
-            else:
-                groups[channel['group']] += 1
-
         folder = plugin.Folder(region['name'])
 
+        all_count = provider.count(code)
         if all_count:
             folder.add_item(
                 label = _(u'{name} ({count})'.format(name=_.ALL, count=all_count)),
-                art = {'thumb': region.get('logo')},
+                art = {'thumb': region['logo']},
                 path = plugin.url_for(live_tv, code=code, group=ALL),
             )
 
-        for group in sorted(groups):
+        for group, count in provider.groups(code):
             folder.add_item(
-                label = _(u'{name} ({count})'.format(name=group, count=groups[group])),
-                art = {'thumb': region.get('logo')},
+                label = _(u'{name} ({count})'.format(name=group, count=count)),
+                art = {'thumb': region['logo']},
                 info = {
-                    'plot': u'{}\n\n{}'.format(group, _(_.CHANNEL_COUNT, count=groups[group])),
+                    'plot': u'{}\n\n{}'.format(group, _(_.CHANNEL_COUNT, count=count)),
                 },
                 path = plugin.url_for(live_tv, code=code, group=group)
             )
@@ -180,44 +126,30 @@ def live_tv(code=None, group=None, **kwargs):
         return folder
 
     folder = plugin.Folder(region['name'] if group == ALL else group, no_items_method='list')
-    items = _process_channels(channels, group=group, region=code)
+    channels = provider.channels(code, group=group, order_by='chno' if settings.getBool('show_chno', True) else 'name')
+    items = _process_channels(channels, region=code)
     folder.add_items(items)
     return folder
 
 @plugin.route()
 @plugin.search()
 def search(query, page, **kwargs):
-    data = _app_data()
-
-    results = {}
-    for id in data['regions'][ALL]['channels']:
-        channel = data['regions'][ALL]['channels'][id]
-        search_t = '{} {} {}'.format(channel['name'], channel['chno'], channel['group'])
-        if query.lower() in search_t.lower():
-            results[id] = channel
-
-    return _process_channels(results), False
-
-def _get_url(channel):
-    return channel['url']
+    channels = provider.search(query, order_by='chno' if settings.getBool('show_chno', True) else 'name')
+    return _process_channels(channels), False
 
 @plugin.route()
 def play(id, **kwargs):
-    data = _app_data()
-    channel = data['regions'][ALL]['channels'][id]
-
-    headers = data['headers']
-    headers.update(channel.get('headers', {}))
+    channel = provider.channel(id)
 
     item = plugin.Item(
         label = channel['name'],
-        info = {'plot': channel.get('description')},
+        info = {'plot': channel['description']},
         art = {'thumb': channel['logo']},
-        headers = headers,
-        path = _get_url(channel),
+        headers = provider.headers(channel),
+        path = channel['url'],
     )
 
-    if channel.get('license_url'):
+    if channel['license_url']:
         item.inputstream = inputstream.Widevine(
             license_key = channel['license_url'],
             manifest_type = 'hls',
@@ -231,30 +163,17 @@ def play(id, **kwargs):
 @plugin.route()
 @plugin.merge()
 def playlist(output, **kwargs):
-    data = _app_data()
-    regions = userdata.get('merge_regions', [])
-    regions = [x for x in regions if x in data['regions']]
+    avail_regions = [x['code'] for x in _regions()] + [MY_CHANNELS]
+    regions = [x for x in userdata.get('merge_regions', []) if x in avail_regions]
     if not regions:
         raise PluginError(_.NO_REGIONS)
 
-    _added = []
-    _channels = []
-    _epgs = []
-    for code in regions:
-        region = data['regions'][code]
-        channels = region['channels']
-        for id in sorted(channels.keys(), key=lambda x: channels[x]['chno']):
-            if id in _added:
-                continue
-
-            _added.append(id)
+    _channels = list(provider.playlist(regions))
 
-            channel = channels[id]
-            channel['id'] = id
-            if channel['epg'] not in _epgs:
-                _epgs.append(channel['epg'])
-
-            _channels.append(channel)
+    _epgs = []
+    for channel in _channels:
+        if channel['region'] not in _epgs:
+            _epgs.append(channel['region'])
 
     if len(_epgs) > 2:
         epg_urls = [EPG_URL.format(code=ALL)]
@@ -266,26 +185,24 @@ def playlist(output, **kwargs):
 
         for channel in _channels:
             f.write(u'\n#EXTINF:-1 tvg-id="{id}" tvg-chno="{chno}" tvg-name="{name}" tvg-logo="{logo}" group-title="{group}",{name}\n{url}'.format(
-                id=channel['id'], chno=channel['chno'], name=channel['name'], logo=channel['logo'], group=channel['group'], url=plugin.url_for(play, id=channel['id'], _is_live=True),
+                id=channel['id'], chno=channel['chno'], name=channel['name'], logo=channel['logo'], group=';'.join(channel['groups']), url=plugin.url_for(play, id=channel['id'], _is_live=True),
             ))
 
 @plugin.route()
 def configure_merge(**kwargs):
-    data = _app_data()
     user_regions = userdata.get('merge_regions', [])
-    avail_regions = sorted(data['regions'], key=lambda x: (data['regions'][x]['sort'], data['regions'][x]['name']))
+    avail_regions = [{'code': MY_CHANNELS, 'name': _.MY_CHANNELS, 'logo': None}] + _regions()
 
     options = []
     preselect = []
-    for index, code in enumerate(avail_regions):
-        region = data['regions'][code]
+    for index, region in enumerate(avail_regions):
         options.append(plugin.Item(label=region['name'], art={'thumb': region['logo']}))
-        if code in user_regions:
+        if region['code'] in user_regions:
             preselect.append(index)
 
     indexes = gui.select(heading=_.SELECT_REGIONS, options=options, multi=True, useDetails=False, preselect=preselect)
     if indexes is None:
         return
 
-    user_regions = [avail_regions[i] for i in indexes]
+    user_regions = [avail_regions[i]['code'] for i in indexes]
     userdata.set('merge_regions', user_regions)
@@ -1,12 +1,13 @@
 import codecs
 
-import arrow
-from slyguy import plugin, inputstream, mem_cache, settings, gui, userdata
-from slyguy.session import Session
+from slyguy import plugin, inputstream, settings, gui, userdata
+from slyguy.fast_channels import Provider, format_time
 
 from .language import _
 from .constants import *
 
+provider = Provider(DATA_URL)
+
 @plugin.route('')
 def home(**kwargs):
     folder = plugin.Folder()
@@ -24,88 +25,53 @@ def home(**kwargs):
 
 @plugin.route()
 def add_favourite(id, **kwargs):
-    data = _app_data()
-    channel = data['regions'][ALL]['channels'].get(id)
+    channel = provider.channel(id)
     if not channel:
         return
 
-    favourites = userdata.get('favourites') or []
-    if id not in favourites:
-        favourites.append(id)
-
-    userdata.set('favourites', favourites)
+    provider.add_favourite(id)
     gui.notification(_.MY_CHANNEL_ADDED, heading=channel['name'], icon=channel['logo'])
 
 @plugin.route()
 def del_favourite(id, **kwargs):
-    favourites = userdata.get('favourites') or []
-    if id in favourites:
-        favourites.remove(id)
-
-    userdata.set('favourites', favourites)
+    provider.del_favourite(id)
     gui.refresh()
 
-@mem_cache.cached(60*15)
-def _data():
-    return Session().gz_json(DATA_URL)
-
-def _app_data():
-    data = _data()
+def _regions():
+    return [
+        {'code': MY_CHANNELS, 'name': _.MY_CHANNELS, 'logo': None},
+        {'code': ALL, 'name': _.ALL, 'logo': None},
+    ]
 
-    favourites = userdata.get('favourites') or []
-    my_channels = {'logo': None, 'name': _.MY_CHANNELS, 'channels': {}, 'sort': 0}
-    all_channels = {'logo': None, 'name':_.ALL, 'channels': {}, 'sort': 1}
-    for id in data['channels']:
-        all_channels['channels'][id] = data['channels'][id]
-        if id in favourites:
-            my_channels['channels'][id] = data['channels'][id]
+def _order_by():
+    return 'chno' if settings.getBool('show_chno', True) else 'name'
 
-    data['regions'] = {
-        ALL: all_channels,
-        MY_CHANNELS: my_channels,
-    }
-
-    return data
-
-def _process_channels(channels, group=ALL, region=ALL):
+def _process_channels(channels, region=ALL):
     items = []
 
+    channels = list(channels)
     show_chno = settings.getBool('show_chno', True)
 
     if settings.getBool('show_epg', True):
-        now = arrow.now()
-        epg_count = 5
+        programmes = provider.programmes([x['id'] for x in channels])
     else:
-        epg_count = None
-
-    for id in sorted(channels.keys(), key=lambda x: channels[x]['chno'] if show_chno else channels[x]['name'].strip().lower()):
-        channel = channels[id]
-        if group != ALL and group not in channel['groups']:
-            continue
+        programmes = None
 
+    for channel in channels:
         plot = u'[B]{}[/B]\n'.format(' / '.join(channel['groups']))
-        if not epg_count:
-            plot += channel.get('description') or ''
+        if programmes is None:
+            plot += channel['description'] or ''
         else:
-            count = 0
-            for index, row in enumerate(channel.get('programs', [])):
-                start = arrow.get(row[0])
-                try: stop = arrow.get(channel['programs'][index+1][0])
-                except: stop = start.shift(hours=1)
-
-                if (now > start and now < stop) or start > now:
-                    plot += u'[{}] {}\n'.format(start.to('local').format('h:mma'), row[1])
-                    count += 1
-                    if count == epg_count:
-                        break
+            for start, title in programmes[channel['id']]:
+                plot += u'[{}] {}\n'.format(format_time(start), title)
 
         item = plugin.Item(
             label = u'{} | {}'.format(channel['chno'], channel['name']) if show_chno else channel['name'],
             info = {'plot': plot},
             art = {'thumb': channel['logo']},
             playable = True,
-            path = plugin.url_for(play, id=id, _is_live=True),
-            context = ((_.DEL_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(del_favourite, id=id))),) if region == MY_CHANNELS else ((_.ADD_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(add_favourite, id=id))),),
+            path = plugin.url_for(play, id=channel['id'], _is_live=True),
+            context = ((_.DEL_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(del_favourite, id=channel['id']))),) if region == MY_CHANNELS else ((_.ADD_MY_CHANNEL, 'RunPlugin({})'.format(plugin.url_for(add_favourite, id=channel['id']))),),
         )
         items.append(item)
 
@@ -113,90 +79,63 @@ def _process_channels(channels, group=ALL, region=ALL):
 
 @plugin.route()
 def live_tv(code=None, group=None, **kwargs):
-    data = _app_data()
-
     if not settings.getBool('show_groups', True):
         group = ALL
 
     if code is None:
         code = ALL
 
-    region = data['regions'][code]
-    folder = plugin.Folder(region['name'])
-    channels = region['channels']
+    region_name = _.ALL if code == ALL else _.MY_CHANNELS
 
     if group is None:
-        groups = {}
-        all_count = 0
-        for id in channels:
-            channel = channels[id]
-            all_count += 1
-            for group in channel['groups']:
-                if group not in groups:
-                    groups[group] = 1
-                else:
-                    groups[group] += 1
-
         folder = plugin.Folder(_.LIVE_TV)
 
+        all_count = provider.count(code)
         if all_count:
             folder.add_item(
                 label = _(u'{name} ({count})'.format(name=_.ALL, count=all_count)),
-                art = {'thumb': region.get('logo')},
                 path = plugin.url_for(live_tv, code=code, group=ALL),
             )
 
-        for group in sorted(groups):
+        for group, count in provider.groups(code):
             folder.add_item(
-                label = _(u'{name} ({count})'.format(name=group, count=groups[group])),
-                art = {'thumb': region.get('logo')},
+                label = _(u'{name} ({count})'.format(name=group, count=count)),
                 info = {
-                    'plot': u'{}\n\n{}'.format(group, _(_.CHANNEL_COUNT, count=groups[group])),
+                    'plot': u'{}\n\n{}'.format(group, _(_.CHANNEL_COUNT, count=count)),
                 },
                 path = plugin.url_for(live_tv, code=code, group=group)
             )
 
         return folder
 
-    folder = plugin.Folder(region['name'] if group == ALL else group, no_items_method='list')
-    items = _process_channels(channels, group=group, region=code)
+    folder = plugin.Folder(region_name if group == ALL else group, no_items_method='list')
+    items = _process_channels(provider.channels(code, group=group, order_by=_order_by()), region=code)
     folder.add_items(items)
     return folder
 
 @plugin.route()
 @plugin.search()
 def search(query, page, **kwargs):
-    data = _app_data()
-
-    results = {}
-    for id in data['regions'][ALL]['channels']:
-        channel = data['regions'][ALL]['channels'][id]
-        search_t = '{} {} {}'.format(channel['name'], channel['chno'], ' '.join(channel['groups']))
-        if query.lower() in search_t.lower():
-            results[id] = channel
-
-    return _process_channels(results), False
+    return _process_channels(provider.search(query, order_by=_order_by())), False
 
 @plugin.route()
 def play(id, **kwargs):
-    data = _app_data()
-    channel = data['regions'][ALL]['channels'][id]
+    channel = provider.channel(id)
 
     return plugin.Item(
         label = channel['name'],
         info = {'plot': channel['description']},
         art = {'thumb': channel['logo']},
         inputstream = inputstream.HLS(live=True),
-        headers = data['headers'],
+        headers = provider.headers(channel),
         path = channel['url'],
     )
 
 @plugin.route()
 @plugin.merge()
 def playlist(output, **kwargs):
-    data = _app_data()
-    regions = userdata.get('merge_regions', [])
-    regions = [x for x in regions if x in data['regions']]
+    avail_regions = [x['code'] for x in _regions()]
+    regions = [x for x in userdata.get('merge_regions', []) if x in avail_regions]
 
     if not regions:
         regions = [ALL]
@@ -204,39 +143,26 @@ def playlist(output, **kwargs):
     with codecs.open(output, 'w', encoding='utf8') as f:
         f.write(u'#EXTM3U x-tvg-url="{}"'.format(EPG_URL))
 
-        added = []
-        for code in regions:
-            region = data['regions'][code]
-            channels = region['channels']
-
-            for id in sorted(channels.keys(), key=lambda x: channels[x]['chno']):
-                if id in added:
-                    continue
-
-                added.append(id)
-                channel = channels[id]
-
-                f.write(u'\n#EXTINF:-1 tvg-id="{id}" tvg-chno="{chno}" tvg-name="{name}" tvg-logo="{logo}" group-title="{group}",{name}\n{url}'.format(
-                    id=id, chno=channel['chno'], name=channel['name'], logo=channel['logo'], group=';'.join(channel['groups']), url=plugin.url_for(play, id=id, _is_live=True),
-                ))
+        for channel in provider.playlist(regions):
+            f.write(u'\n#EXTINF:-1 tvg-id="{id}" tvg-chno="{chno}" tvg-name="{name}" tvg-logo="{logo}" group-title="{group}",{name}\n{url}'.format(
+                id=channel['id'], chno=channel['chno'], name=channel['name'], logo=channel['logo'], group=';'.join(channel['groups']), url=plugin.url_for(play, id=channel['id'], _is_live=True),
+            ))
 
 @plugin.route()
 def configure_merge(**kwargs):
-    data = _app_data()
     user_regions = userdata.get('merge_regions', [])
-    avail_regions = sorted(data['regions'], key=lambda x: (data['regions'][x]['sort'], data['regions'][x]['name']))
+    avail_regions = _regions()
 
     options = []
     preselect = []
-    for index, code in enumerate(avail_regions):
-        region = data['regions'][code]
+    for index, region in enumerate(avail_regions):
         options.append(plugin.Item(label=region['name'], art={'thumb': region['logo']}))
-        if code in user_regions:
+        if region['code'] in user_regions:
             preselect.append(index)
 
     indexes = gui.select(heading=_.SELECT_REGIONS, options=options, multi=True, useDetails=False, preselect=preselect)
     if indexes is None:
         return
 
-    user_regions = [avail_regions[i] for i in indexes]
+    user_regions = [avail_regions[i]['code'] for i in indexes]
     userdata.set('merge_regions', user_regions)